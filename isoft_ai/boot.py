@@ -0,0 +1,9 @@
+import frappe
+from frappe.utils import cint
+
+
+def boot_session(bootinfo):
+    """Expose the AI chat widget settings to the desk"""
+    bootinfo.isoft_ai = {
+        "background_jobs": cint(frappe.conf.get("isoft_ai_background_jobs")),
+    }
@@ -0,0 +1,934 @@
+"""
+Response cache for ask_ai.
+
+Answers are looked up in a bounded per-worker LRU, then in Redis (`frappe.cache()`),
+under a hash of the canonicalised question; a MinHash/LSH index finds cached
+near-duplicate phrasings. Validated SQL is cached separately and for longer than
+answers, and query results are cached by normalised SQL.
+Entries that read data are tagged with their DocTypes. `invalidate_for_doc` drops
+tagged answers and bumps per-DocType change counters that cached results are
+checked against. `single_flight` lets one request compute an answer that
+concurrent identical requests wait for. The `AI Cache` DocType optionally
+persists answers (`isoft_ai_persist_cache`).
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import frappe
+from frappe.utils import add_days, get_datetime, getdate, now_datetime
+
+# Cache settings
+CACHE_EXPIRY_HOURS = 24
+MAX_CACHE_ENTRIES = 1000
+MAX_CACHE_BYTES = 50 * 1024 * 1024
+
+# Writes over budget evict at most this many entries; the byte total is checked every Nth write
+EVICTION_BATCH = 4
+BYTES_CHECK_EVERY = 20
+
+# Per-worker LRU; entries live at most LOCAL_CACHE_TTL seconds so other workers' writes are picked up
+LOCAL_CACHE_SIZE = 256
+LOCAL_CACHE_TTL = 60
+
+REDIS_KEY_PREFIX = "isoft_ai_response"
+LSH_KEY_PREFIX = "isoft_ai_lsh"
+SQL_KEY_PREFIX = "isoft_ai_sql"
+TAG_KEY_PREFIX = "isoft_ai_tag"
+RESULT_KEY_PREFIX = "isoft_ai_result"
+
+# Hash of per-DocType change counters; cached query results keep the counters they were computed at
+VERSION_KEY = "isoft_ai_doctype_versions"
+
+# Sorted set of cache keys scored by last hit, and a hash of their sizes in bytes
+LRU_KEY = "isoft_ai_lru"
+SIZE_KEY = "isoft_ai_sizes"
+WRITE_COUNT_KEY = "isoft_ai_cache_writes"
+
+# Hash of counters: "<event>", "<event>|intent|<intent>" and "<event>|bucket|<bucket>"
+STATS_KEY = "isoft_ai_cache_stats"
+# Counters are kept per worker and flushed to Redis at most this often (seconds)
+STATS_FLUSH_INTERVAL = 5
+
+# Single-flight: the computing request holds FLIGHT_LOCK_PREFIX|key with its flight id as the value,
+# others poll FLIGHT_RESULT_PREFIX|key|flight id
+FLIGHT_LOCK_PREFIX = "isoft_ai_flight"
+FLIGHT_RESULT_PREFIX = "isoft_ai_flight_result"
+FLIGHT_RESULT_TTL = 60
+FLIGHT_POLL_INTERVAL = 0.25
+
+# Bumped on every invalidation; workers re-read it at most every EPOCH_CHECK_INTERVAL
+# seconds and drop their local copies when it moved
+EPOCH_KEY = "isoft_ai_cache_epoch"
+EPOCH_CHECK_INTERVAL = 1.0
+
+# Documents whose changes update other DocTypes without firing their doc events
+DERIVED_DOCTYPES = {
+    'Stock Ledger Entry': ['Bin'],
+    'Stock Entry': ['Bin'],
+    'Delivery Note': ['Bin', 'Sales Order'],
+    'Sales Invoice': ['Sales Order', 'Delivery Note'],
+    'Purchase Receipt': ['Bin', 'Purchase Order'],
+    'Purchase Invoice': ['Purchase Order', 'Purchase Receipt'],
+    'Material Request': ['Bin'],
+    'Work Order': ['Bin', 'Production Plan'],
+}
+
+# Fields naming another voucher whose status/outstanding amount the document updates
+REFERENCE_FIELDS = ('reference_doctype', 'reference_type', 'against_voucher_type', 'voucher_type')
+
+# DocTypes that never feed a cached answer
+SKIP_INVALIDATION = {
+    'AI Cache', 'AI Chat', 'AI Chat Message', 'ISOFT AI TEST', 'Version', 'Comment', 'Activity Log',
+    'Access Log', 'Error Log', 'Scheduled Job Log', 'Route History', 'View Log', 'Deleted Document',
+}
+
+# Generated SQL stays valid as long as the schema does; queries with literal dates only until midnight
+SQL_CACHE_EXPIRY_HOURS = 7 * 24
+
+# Near-duplicate matching: 64 MinHash permutations split into 16 LSH bands of 4 rows
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SIMILARITY_THRESHOLD = 0.8
+# A word with one of these in front is the opposite, not a misspelling (paid/unpaid, active/inactive)
+NEGATING_PREFIXES = ('un', 'in', 'non', 'dis', 'not')
+
+# Filler words that do not change what is being asked
+STOP_WORDS = {
+    'a', 'an', 'the', 'me', 'my', 'our', 'us', 'we', 'i', 'you', 'your', 'please', 'kindly',
+    'can', 'could', 'would', 'will', 'should', 'do', 'does', 'did', 'is', 'are', 'was', 'were', 'be',
+    'show', 'give', 'get', 'list', 'display', 'tell', 'find', 'fetch', 'see', 'let', 'want', 'need',
+    'what', 'which', 'whats', 'there', 'some', 'of', 'for', 'to', 'in', 'on', 'at', 'from', 'and',
+    'with', 'all', 'about', 'that', 'this', 'these', 'those', 'it', 'its', 'have', 'has', 'had',
+}
+
+# Words that change the answer even when everything else matches; they must agree exactly
+ANCHOR_WORDS = {
+    'today', 'yesterday', 'tomorrow', 'week', 'month', 'quarter', 'year', 'last', 'next', 'current',
+    'previous', 'ytd', 'mtd', 'january', 'february', 'march', 'april', 'may', 'june', 'july',
+    'august', 'september', 'october', 'november', 'december', 'jan', 'feb', 'mar', 'apr', 'jun',
+    'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'top', 'bottom', 'highest', 'lowest', 'most',
+    'least', 'best', 'worst', 'first', 'not', 'no', 'without', 'exclude', 'excluding', 'except',
+    'count', 'many', 'number', 'total', 'sum', 'average', 'avg', 'min', 'max', 'minimum', 'maximum',
+}
+
+# Words that bind the word after them; "not paid" and "by customer" must match in order
+RELATION_WORDS = {'not', 'no', 'without', 'exclude', 'excluding', 'except', 'by', 'per', 'than', 'vs', 'versus'}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (zlib.crc32(f"a{i}".encode()) | 1, zlib.crc32(f"b{i}".encode()))
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+
+class LRUCache:
+    """Thread-safe bounded LRU with a per-entry expiry (epoch seconds)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at: float):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_local_cache = LRUCache(LOCAL_CACHE_SIZE)
+_epochs = {}
+_pending_stats = {}
+_stats_lock = threading.Lock()
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def normalize_question(question: str) -> List[str]:
+    """Lowercased, accent- and punctuation-free tokens without stop words, lightly stemmed"""
+    text = unicodedata.normalize("NFKD", question).encode("ascii", "ignore").decode().lower()
+    text = text.replace("'s ", " ").replace("'", "")
+    tokens = []
+    for token in re.split(r"[^a-z0-9\-_.]+", text):
+        token = token.strip("-_.")
+        if not token or token in STOP_WORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss") and not any(c.isdigit() for c in token):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def get_anchors(tokens: List[str]) -> List[str]:
+    """Numbers, codes and period/ranking words that must match for two questions to be the same"""
+    return sorted({t for t in tokens if t in ANCHOR_WORDS or any(c.isdigit() for c in t)})
+
+
+def get_relations(tokens: List[str]) -> List[str]:
+    """Each relation word with the word it applies to, which a reordered phrasing must keep"""
+    return sorted({f"{word} {following}" for word, following in zip(tokens, tokens[1:]) if word in RELATION_WORDS})
+
+
+def get_cache_key(question: str) -> str:
+    """Generate cache key from the canonical form of the (context-resolved) question"""
+    tokens = normalize_question(question)
+    # Word order carries meaning ("paid but not delivered"); reordered phrasings are left to the MinHash lookup
+    canonical = " ".join(tokens) if tokens else question.strip().lower()
+    return hashlib.md5(canonical.encode()).hexdigest()
+
+
+def minhash_signature(tokens: List[str]) -> List[int]:
+    """MinHash over word and character-trigram shingles, so word order and typos matter little"""
+    shingles = set(tokens)
+    for token in tokens:
+        padded = f"#{token}#"
+        shingles.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    hashes = [zlib.crc32(shingle.encode()) for shingle in shingles] or [0]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _lsh_buckets(signature: List[int]) -> List[str]:
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        f"{LSH_KEY_PREFIX}|{band}|{hashlib.md5(str(signature[band * rows:(band + 1) * rows]).encode()).hexdigest()[:16]}"
+        for band in range(LSH_BANDS)
+    ]
+
+
+def question_fingerprint(tokens: List[str]) -> Dict:
+    """What a cache entry keeps of its question for near-duplicate matching"""
+    return {"tokens": sorted(set(tokens)), "anchors": get_anchors(tokens), "relations": get_relations(tokens),
+            "signature": minhash_signature(tokens)}
+
+
+def _is_near_duplicate(tokens: List[str], signature: List[int], entry: Dict) -> bool:
+    if get_anchors(tokens) != entry.get("anchors") or get_relations(tokens) != entry.get("relations"):
+        return False
+    other_signature = entry.get("signature") or []
+    if len(other_signature) != len(signature):
+        return False
+    similarity = sum(1 for x, y in zip(signature, other_signature) if x == y) / len(signature)
+    threshold = frappe.conf.get("isoft_ai_cache_similarity") or SIMILARITY_THRESHOLD
+    if similarity < threshold:
+        return False
+    # Every differing word must be a spelling variant of a word on the other side
+    mine, theirs = set(tokens), set(entry.get("tokens") or [])
+    for word in mine ^ theirs:
+        others = theirs if word in mine else mine
+        if not any(_is_spelling_variant(word, other) for other in others):
+            return False
+    return True
+
+
+def _is_spelling_variant(word: str, other: str) -> bool:
+    # "unpaid" is one edit per letter away from "paid" but means the opposite
+    if any(word == prefix + other or other == prefix + word for prefix in NEGATING_PREFIXES):
+        return False
+    return _edit_distance(word, other, 1 if max(len(word), len(other)) < 8 else 2) is not None
+
+
+def _edit_distance(a: str, b: str, limit: int) -> Optional[int]:
+    """Levenshtein distance between a and b, or None when it is over `limit`"""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+def _local_key(cache_key: str) -> str:
+    return f"{frappe.local.site}|{cache_key}"
+
+
+def _redis_key(cache_key: str) -> str:
+    return f"{REDIS_KEY_PREFIX}|{cache_key}"
+
+
+def _tag_key(doctype: str) -> str:
+    return f"{TAG_KEY_PREFIX}|{doctype}"
+
+
+def _persistence_enabled() -> bool:
+    return bool(frappe.conf.get("isoft_ai_persist_cache"))
+
+
+def _max_entries() -> int:
+    return frappe.conf.get("isoft_ai_cache_max_entries") or MAX_CACHE_ENTRIES
+
+
+def _max_bytes() -> int:
+    max_mb = frappe.conf.get("isoft_ai_cache_max_mb")
+    return int(max_mb * 1024 * 1024) if max_mb else MAX_CACHE_BYTES
+
+
+def _current_epoch() -> int:
+    """Site invalidation counter, read from Redis at most once per EPOCH_CHECK_INTERVAL"""
+    site = frappe.local.site
+    epoch, checked_at = _epochs.get(site, (0, 0))
+    if time.monotonic() - checked_at > EPOCH_CHECK_INTERVAL:
+        try:
+            epoch = int(frappe.cache().get(frappe.cache().make_key(EPOCH_KEY)) or 0)
+        except Exception:
+            pass
+        _epochs[site] = (epoch, time.monotonic())
+    return epoch
+
+
+def _local_get(cache_key: str) -> Optional[Dict]:
+    """Entry from this worker's LRU as {"response", "intent", "bucket"}"""
+    value = _local_cache.get(_local_key(cache_key))
+    if value is None:
+        return None
+    entry, epoch = value
+    if epoch != _current_epoch():
+        _local_cache.delete(_local_key(cache_key))
+        record_cache_stat("stale", entry.get("intent"), entry.get("bucket"))
+        return None
+    return entry
+
+
+def _local_set(cache_key: str, entry: Dict):
+    local_entry = {"response": entry["response"], "intent": entry.get("intent"), "bucket": entry.get("bucket")}
+    _local_cache.set(_local_key(cache_key), (local_entry, _current_epoch()),
+                     min(entry["expires_at"], time.time() + LOCAL_CACHE_TTL))
+
+
+def record_cache_stat(event: str, intent: Optional[str] = None, bucket: Optional[str] = None, amount: int = 1):
+    """Count a cache event overall, per intent and per expiry bucket"""
+    fields = [event]
+    if intent:
+        fields.append(f"{event}|intent|{intent}")
+    if bucket:
+        fields.append(f"{event}|bucket|{bucket}")
+    with _stats_lock:
+        pending = _pending_stats.setdefault(frappe.local.site, {"counts": Counter(), "flushed_at": time.monotonic()})
+        for field in fields:
+            pending["counts"][field] += amount
+    _flush_stats()
+
+
+def _flush_stats(force: bool = False):
+    site = frappe.local.site
+    with _stats_lock:
+        pending = _pending_stats.get(site)
+        if not pending or not pending["counts"]:
+            return
+        if not force and time.monotonic() - pending["flushed_at"] < STATS_FLUSH_INTERVAL:
+            return
+        counts, pending["counts"], pending["flushed_at"] = pending["counts"], Counter(), time.monotonic()
+    try:
+        redis = frappe.cache()
+        key = redis.make_key(STATS_KEY)
+        pipe = redis.pipeline()
+        pipe.hsetnx(key, "since", int(time.time()))
+        for field, amount in counts.items():
+            pipe.hincrby(key, field, amount)
+        pipe.execute()
+    except Exception as e:
+        frappe.logger().debug(f"Cache stats flush error: {str(e)}")
+
+
+def seconds_until_midnight() -> int:
+    midnight = get_datetime(add_days(getdate(), 1))
+    return int((midnight - now_datetime()).total_seconds())
+
+
+def get_sql_doctypes(sql: str) -> List[str]:
+    """DocTypes whose tables a query reads"""
+    names = re.findall(r"`tab([^`]+)`|\btab([A-Z][A-Za-z0-9_]*)", sql)
+    return sorted({quoted or bare for quoted, bare in names})
+
+
+def get_cached_response(cache_key: str, question: str = "") -> Optional[Dict]:
+    """
+    Get cached response if available and not expired. When `question` is given and the
+    exact key misses, a cached answer to a near-identical phrasing is returned instead.
+    """
+    entry = _local_get(cache_key)
+    if entry is not None:
+        record_cache_stat("hit", entry.get("intent"), entry.get("bucket"))
+        return dict(entry["response"])
+
+    try:
+        entry = _get_entry(cache_key)
+        if entry:
+            record_cache_stat("hit", entry.get("intent"), entry.get("bucket"))
+            return dict(entry["response"])
+        if question:
+            return _find_similar_response(cache_key, question)
+    except Exception as e:
+        record_cache_stat("error")
+        frappe.logger().debug(f"Cache get error (normal): {str(e)}")
+    return None
+
+
+def _get_entry(cache_key: str) -> Optional[Dict]:
+    entry = _read_entry(cache_key)
+    if not entry:
+        return None
+    if entry["expires_at"] <= time.time():
+        record_cache_stat("stale", entry.get("intent"), entry.get("bucket"))
+        return None
+    _local_set(cache_key, entry)
+    _touch(cache_key)
+    return entry
+
+
+def _read_entry(cache_key: str) -> Optional[Dict]:
+    """The stored entry, without refreshing its LRU position or copying it to the local cache"""
+    entry = frappe.cache().get_value(_redis_key(cache_key))
+    if not entry and _persistence_enabled():
+        entry = _load_persisted_entry(cache_key)
+    return entry
+
+
+def _touch(cache_key: str):
+    """Record a hit for LRU eviction (only for keys still tracked)"""
+    redis = frappe.cache()
+    redis.zadd(redis.make_key(LRU_KEY), {cache_key: time.time()}, xx=True)
+
+
+def _track_write(cache_key: str, size: int):
+    """Record a write and evict a bounded batch of least-recently-hit entries when over budget"""
+    redis = frappe.cache()
+    pipe = redis.pipeline()
+    pipe.zadd(redis.make_key(LRU_KEY), {cache_key: time.time()})
+    pipe.hset(redis.make_key(SIZE_KEY), cache_key, size)
+    pipe.zcard(redis.make_key(LRU_KEY))
+    pipe.incr(redis.make_key(WRITE_COUNT_KEY))
+    _, _, count, writes = pipe.execute()
+
+    excess = count - _max_entries()
+    if excess <= 0 and writes % BYTES_CHECK_EVERY == 0:
+        total_bytes = sum(int(v) for v in redis.hvals(redis.make_key(SIZE_KEY)))
+        if total_bytes > _max_bytes():
+            excess = EVICTION_BATCH
+    if excess > 0:
+        evict_least_recent(min(excess, EVICTION_BATCH))
+
+
+def evict_least_recent(count: int) -> int:
+    """Drop the `count` least recently hit entries from Redis and this worker"""
+    redis = frappe.cache()
+    cache_keys = [k.decode() if isinstance(k, bytes) else k
+                  for k in redis.zrange(redis.make_key(LRU_KEY), 0, count - 1)]
+    if cache_keys:
+        _drop_entries(cache_keys)
+        record_cache_stat("eviction", amount=len(cache_keys))
+    return len(cache_keys)
+
+
+def _drop_entries(cache_keys: List[str]):
+    redis = frappe.cache()
+    pipe = redis.pipeline()
+    for cache_key in cache_keys:
+        pipe.delete(redis.make_key(_redis_key(cache_key)))
+    pipe.zrem(redis.make_key(LRU_KEY), *cache_keys)
+    pipe.hdel(redis.make_key(SIZE_KEY), *cache_keys)
+    pipe.execute()
+    for cache_key in cache_keys:
+        _local_cache.delete(_local_key(cache_key))
+
+
+def _find_similar_response(cache_key: str, question: str) -> Optional[Dict]:
+    tokens = normalize_question(question)
+    if not tokens:
+        return None
+    signature = minhash_signature(tokens)
+    redis = frappe.cache()
+
+    pipe = redis.pipeline()
+    for bucket in _lsh_buckets(signature):
+        pipe.smembers(redis.make_key(bucket))
+    candidates = set()
+    for members in pipe.execute():
+        candidates.update(m.decode() if isinstance(m, bytes) else m for m in members)
+    candidates.discard(cache_key)
+
+    now = time.time()
+    for candidate in candidates:
+        # Rejected candidates are left as they are: only the match counts as a hit for eviction
+        entry = _read_entry(candidate)
+        if entry and entry["expires_at"] > now and _is_near_duplicate(tokens, signature, entry):
+            frappe.logger().info(f"Near-duplicate cache hit: {question[:50]}...")
+            record_cache_stat("near_hit", entry.get("intent"), entry.get("bucket"))
+            _touch(candidate)
+            _local_set(cache_key, entry)
+            return dict(entry["response"])
+    return None
+
+
+def _index_question(cache_key: str, question: str, entry: Dict, ttl: int):
+    """Record the question's MinHash signature and add the key to its LSH buckets"""
+    tokens = normalize_question(question)
+    if not tokens:
+        return
+    fingerprint = question_fingerprint(tokens)
+    entry.update(fingerprint)
+    signature = fingerprint["signature"]
+
+    redis = frappe.cache()
+    pipe = redis.pipeline()
+    for bucket in _lsh_buckets(signature):
+        key = redis.make_key(bucket)
+        pipe.sadd(key, cache_key)
+        pipe.expire(key, max(ttl, CACHE_EXPIRY_HOURS * 3600))
+    pipe.execute()
+
+
+def set_cached_response(cache_key: str, response_data: dict, expiry_minutes: int = CACHE_EXPIRY_HOURS * 60,
+                        question: str = "", doctypes: Optional[List[str]] = None, intent: str = "", bucket: str = ""):
+    """
+    Cache response with expiry. `question` makes the entry findable by near-duplicate
+    phrasings; `doctypes` tags it for invalidation when documents of those types change.
+    `intent` and `bucket` (the CACHE_EXPIRY_RULES key) only label the statistics.
+    Nothing is cached when `frappe.flags.isoft_ai_skip_cache` is set for the request
+    (e.g. the answer is a placeholder for a background export).
+    """
+    ttl = int(expiry_minutes * 60)
+    if ttl <= 0 or frappe.flags.get("isoft_ai_skip_cache"):
+        return
+    # Hits are shared by everyone asking the question; the chat belongs to the asker
+    response_data = {k: v for k, v in response_data.items() if k != "chat_name"}
+    entry = {
+        "response": response_data,
+        "expires_at": time.time() + ttl,
+        "doctypes": sorted(set(doctypes or [])),
+        "intent": intent,
+        "bucket": bucket,
+    }
+    try:
+        _local_set(cache_key, entry)
+        if question:
+            _index_question(cache_key, question, entry, ttl)
+        if entry["doctypes"]:
+            _tag_entry(cache_key, entry["doctypes"], ttl)
+        frappe.cache().set_value(_redis_key(cache_key), entry, expires_in_sec=ttl)
+        size = len(json.dumps(entry, default=str))
+        _track_write(cache_key, size)
+        record_cache_stat("store", intent, bucket)
+        record_cache_stat("bytes", intent, bucket, amount=size)
+        # Tags live in Redis only, so answers computed from data are not persisted
+        if _persistence_enabled() and not entry["doctypes"]:
+            frappe.enqueue(
+                "isoft_ai.cache.persist_cached_response",
+                queue="short",
+                enqueue_after_commit=True,
+                cache_key=cache_key,
+                response_data=response_data,
+                expiry_minutes=expiry_minutes,
+            )
+    except Exception as e:
+        record_cache_stat("error")
+        frappe.logger().debug(f"Cache set error: {str(e)}")
+
+
+def _tag_entry(cache_key: str, doctypes: List[str], ttl: int):
+    redis = frappe.cache()
+    pipe = redis.pipeline()
+    for doctype in doctypes:
+        key = redis.make_key(_tag_key(doctype))
+        pipe.sadd(key, cache_key)
+        pipe.expire(key, max(ttl, CACHE_EXPIRY_HOURS * 3600))
+    pipe.execute()
+
+
+def invalidate_for_doc(doc, method=None):
+    """doc_events hook: drop cached answers that read the changed document's DocTypes"""
+    if doc.doctype in SKIP_INVALIDATION or frappe.flags.in_install:
+        return
+
+    doctypes = {doc.doctype}
+    for row in [doc] + doc.get_all_children():
+        doctypes.add(row.doctype)
+        doctypes.update(DERIVED_DOCTYPES.get(row.doctype, []))
+        for fieldname in REFERENCE_FIELDS:
+            value = row.get(fieldname)
+            if value and isinstance(value, str):
+                doctypes.add(value)
+
+    # Until the writer commits, other requests still read the old rows and may cache them under
+    # the bumped counters, so the counters are bumped once the change is visible
+    if hasattr(frappe.db, "after_commit"):
+        frappe.db.after_commit.add(lambda: _invalidate_quietly(doctypes, doc.doctype))
+    else:
+        # Frappe v13 has no after-commit callbacks: bump now, and again from a job enqueued after the commit
+        _invalidate_quietly(doctypes, doc.doctype)
+        frappe.enqueue("isoft_ai.cache.invalidate_doctypes", queue="short", enqueue_after_commit=True,
+                       doctypes=sorted(doctypes))
+
+
+def _invalidate_quietly(doctypes, source: str):
+    try:
+        invalidate_doctypes(doctypes)
+    except Exception as e:
+        record_cache_stat("error")
+        frappe.logger().error(f"Cache invalidation error for {source}: {str(e)}")
+
+
+def invalidate_doctypes(doctypes) -> int:
+    """
+    Delete every cached answer tagged with one of `doctypes` and bump their change counters;
+    returns how many answers were dropped
+    """
+    redis = frappe.cache()
+    tag_keys = [redis.make_key(_tag_key(doctype)) for doctype in doctypes]
+    version_key = redis.make_key(VERSION_KEY)
+
+    pipe = redis.pipeline()
+    for key in tag_keys:
+        pipe.smembers(key)
+    for doctype in doctypes:
+        pipe.hincrby(version_key, doctype, 1)
+    cache_keys = set()
+    for members in pipe.execute()[:len(tag_keys)]:
+        cache_keys.update(m.decode() if isinstance(m, bytes) else m for m in members)
+    if not cache_keys:
+        return 0
+
+    _drop_entries(list(cache_keys))
+    pipe = redis.pipeline()
+    for key in tag_keys:
+        pipe.delete(key)
+    pipe.incr(redis.make_key(EPOCH_KEY))
+    pipe.execute()
+    _epochs.pop(frappe.local.site, None)
+    if _persistence_enabled():
+        frappe.db.sql("DELETE FROM `tabAI Cache` WHERE name IN %(names)s", {"names": tuple(cache_keys)})
+
+    record_cache_stat("invalidation", amount=len(cache_keys))
+    frappe.logger().debug(f"Invalidated {len(cache_keys)} cached answers for {sorted(doctypes)}")
+    return len(cache_keys)
+
+
+def single_flight(cache_key: str, compute: Callable[[], Dict], timeout: int) -> Tuple[Dict, bool]:
+    """
+    Run `compute()` once for concurrent callers with the same cache key, across threads
+    (in-process future) and workers (Redis lock). Returns `(result, computed)`; `computed`
+    is False when the result was produced by another request. Callers fall back to
+    computing themselves if the request they waited on fails or takes longer than `timeout`.
+    """
+    flight_key = f"{frappe.local.site}|{cache_key}"
+    with _flights_lock:
+        future = _flights.get(flight_key)
+        leader = future is None
+        if leader:
+            future = _flights[flight_key] = Future()
+
+    if not leader:
+        try:
+            result = future.result(timeout=timeout)
+            if result is not None:
+                record_cache_stat("coalesced")
+                return result, False
+        except Exception:
+            pass
+        return compute(), True
+
+    try:
+        result, computed = _run_flight(cache_key, compute, timeout)
+        future.set_result(result)
+        return result, computed
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(flight_key, None)
+
+
+def _run_flight(cache_key: str, compute: Callable[[], Dict], timeout: int) -> Tuple[Dict, bool]:
+    redis = frappe.cache()
+    lock_key = redis.make_key(f"{FLIGHT_LOCK_PREFIX}|{cache_key}")
+    flight_id = frappe.generate_hash(length=10)
+
+    try:
+        acquired = redis.set(lock_key, flight_id, nx=True, ex=timeout)
+    except Exception as e:
+        frappe.logger().debug(f"Single-flight lock error: {str(e)}")
+        return compute(), True
+
+    if not acquired:
+        # Another worker is computing this answer: wait for the result of that flight only,
+        # so a result left by an earlier flight (computed before data changed) is never reused
+        leader_id = (redis.get(lock_key) or b"").decode()
+        if leader_id:
+            result = _wait_for_flight(lock_key, leader_id, f"{FLIGHT_RESULT_PREFIX}|{cache_key}|{leader_id}", timeout)
+            if result is not None:
+                record_cache_stat("coalesced")
+                return result, False
+        return compute(), True
+
+    try:
+        result = compute()
+        redis.set_value(f"{FLIGHT_RESULT_PREFIX}|{cache_key}|{flight_id}", result, expires_in_sec=FLIGHT_RESULT_TTL)
+        return result, True
+    finally:
+        if (redis.get(lock_key) or b"").decode() == flight_id:
+            redis.delete(lock_key)
+
+
+def _wait_for_flight(lock_key: str, flight_id: str, result_key: str, timeout: int) -> Optional[Dict]:
+    redis = frappe.cache()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # expires=True keeps get_value from memoising the miss in frappe.local.cache
+        result = redis.get_value(result_key, expires=True)
+        if result is not None:
+            return result
+        if (redis.get(lock_key) or b"").decode() != flight_id:
+            # The flight ended (or failed and the lock expired): its result, if any, is there now
+            return redis.get_value(result_key, expires=True)
+        time.sleep(FLIGHT_POLL_INTERVAL)
+    return None
+
+
+def get_cached_sql(question: str) -> Optional[Dict]:
+    """Validated SQL previously generated for this question, as {"sql", "intent"}"""
+    try:
+        return frappe.cache().get_value(_sql_key(question))
+    except Exception as e:
+        frappe.logger().debug(f"SQL cache get error (normal): {str(e)}")
+    return None
+
+
+def set_cached_sql(question: str, intent: str, sql: str):
+    """Remember SQL that validated and executed for this question"""
+    ttl = int((frappe.conf.get("isoft_ai_sql_cache_hours") or SQL_CACHE_EXPIRY_HOURS) * 3600)
+    if re.search(r"'\d{4}-\d{2}-\d{2}|\b(19|20)\d{2}\b", sql):
+        # Literal dates were resolved from "today"/"this year" at generation time
+        ttl = min(ttl, seconds_until_midnight())
+    if ttl <= 0:
+        return
+    try:
+        frappe.cache().set_value(_sql_key(question), {"sql": sql, "intent": intent}, expires_in_sec=ttl)
+    except Exception as e:
+        frappe.logger().debug(f"SQL cache set error: {str(e)}")
+
+
+def delete_cached_sql(question: str):
+    try:
+        frappe.cache().delete_value(_sql_key(question))
+    except Exception as e:
+        frappe.logger().debug(f"SQL cache delete error: {str(e)}")
+
+
+def _sql_key(question: str) -> str:
+    return f"{SQL_KEY_PREFIX}|{get_cache_key(question)}"
+
+
+def get_doctype_versions(doctypes: List[str]) -> Dict[str, int]:
+    """Current change counter of each DocType (0 until its first change)"""
+    if not doctypes:
+        return {}
+    redis = frappe.cache()
+    values = redis.hmget(redis.make_key(VERSION_KEY), doctypes)
+    return {doctype: int(value or 0) for doctype, value in zip(doctypes, values)}
+
+
+def get_cached_result(sql: str) -> Optional[Dict]:
+    """Result cached for this normalised SQL, as {"columns", "rows"}, if none of its DocTypes changed since"""
+    try:
+        entry = frappe.cache().get_value(_result_key(sql))
+        if entry and entry["versions"] == get_doctype_versions(list(entry["versions"])):
+            record_cache_stat("result_hit")
+            return entry
+    except Exception as e:
+        frappe.logger().debug(f"Result cache get error (normal): {str(e)}")
+    record_cache_stat("result_miss")
+    return None
+
+
+def set_cached_result(sql: str, versions: Dict[str, int], columns: List[str], rows: List[tuple], ttl: int):
+    """Cache a query result with the DocType counters read before the query ran"""
+    try:
+        entry = {"versions": versions, "columns": columns, "rows": rows}
+        frappe.cache().set_value(_result_key(sql), entry, expires_in_sec=ttl)
+    except Exception as e:
+        frappe.logger().debug(f"Result cache set error: {str(e)}")
+
+
+def _result_key(sql: str) -> str:
+    return f"{RESULT_KEY_PREFIX}|{hashlib.md5(sql.encode()).hexdigest()}"
+
+
+def _load_persisted_entry(cache_key: str) -> Optional[Dict]:
+    """Read an entry from the AI Cache table and promote it to Redis"""
+    row = frappe.db.get_value('AI Cache', cache_key, ['response_data', 'expires_at'], as_dict=True)
+    if not row or row.expires_at <= datetime.now():
+        return None
+    ttl = int((row.expires_at - datetime.now()).total_seconds())
+    entry = {"response": json.loads(row.response_data), "expires_at": time.time() + ttl}
+    frappe.cache().set_value(_redis_key(cache_key), entry, expires_in_sec=ttl)
+    _track_write(cache_key, len(row.response_data))
+    frappe.db.sql("UPDATE `tabAI Cache` SET last_hit = %s WHERE name = %s", (datetime.now(), cache_key))
+    return entry
+
+
+def persist_cached_response(cache_key: str, response_data: dict, expiry_minutes: int):
+    """Background job: write a cached response to the AI Cache table"""
+    try:
+        expires_at = datetime.now() + timedelta(minutes=expiry_minutes)
+
+        # Check if cache already exists
+        if frappe.db.exists('AI Cache', cache_key):
+            cache_doc = frappe.get_doc('AI Cache', cache_key)
+            cache_doc.response_data = json.dumps(response_data)
+            cache_doc.expires_at = expires_at
+            cache_doc.last_hit = datetime.now()
+            cache_doc.save(ignore_permissions=True)
+        else:
+            # Create new cache entry
+            frappe.get_doc({
+                'doctype': 'AI Cache',
+                'name': cache_key,
+                'response_data': json.dumps(response_data),
+                'expires_at': expires_at,
+                'last_hit': datetime.now()
+            }).insert(ignore_permissions=True)
+    except Exception as e:
+        frappe.logger().debug(f"Cache persist error: {str(e)}")
+
+
+def cleanup_old_cache():
+    """
+    Scheduled (hourly): remove expired entries and enforce the entry/byte budgets,
+    evicting least recently hit entries first
+    """
+    try:
+        # Remove expired entries (expires_at is indexed)
+        frappe.db.sql("DELETE FROM `tabAI Cache` WHERE expires_at < %s", (datetime.now(),))
+
+        # Limit total entries
+        total_count = frappe.db.count('AI Cache')
+        if total_count > _max_entries():
+            excess = total_count - _max_entries()
+            frappe.db.sql("""
+                DELETE FROM `tabAI Cache`
+                ORDER BY last_hit ASC
+                LIMIT %s
+            """, (excess,))
+        frappe.db.commit()
+    except Exception as e:
+        frappe.logger().error(f"Cache cleanup error: {str(e)}")
+
+    try:
+        _cleanup_redis_index()
+    except Exception as e:
+        frappe.logger().error(f"Cache index cleanup error: {str(e)}")
+
+
+def _cleanup_redis_index():
+    """Forget keys Redis already expired, then evict until within budget"""
+    redis = frappe.cache()
+    lru_key, size_key = redis.make_key(LRU_KEY), redis.make_key(SIZE_KEY)
+    cache_keys = [k.decode() if isinstance(k, bytes) else k for k in redis.zrange(lru_key, 0, -1)]
+    if not cache_keys:
+        return
+
+    pipe = redis.pipeline()
+    for cache_key in cache_keys:
+        pipe.exists(redis.make_key(_redis_key(cache_key)))
+    expired = [cache_key for cache_key, exists in zip(cache_keys, pipe.execute()) if not exists]
+    if expired:
+        redis.zrem(lru_key, *expired)
+        redis.hdel(size_key, *expired)
+        record_cache_stat("expired", amount=len(expired))
+
+    excess = redis.zcard(lru_key) - _max_entries()
+    if excess > 0:
+        evict_least_recent(excess)
+
+    sizes = redis.hgetall(size_key)
+    total_bytes = sum(int(v) for v in sizes.values())
+    if total_bytes > _max_bytes():
+        to_evict = []
+        for cache_key in redis.zrange(lru_key, 0, -1):
+            if total_bytes <= _max_bytes():
+                break
+            total_bytes -= int(sizes.get(cache_key) or 0)
+            to_evict.append(cache_key.decode() if isinstance(cache_key, bytes) else cache_key)
+        if to_evict:
+            _drop_entries(to_evict)
+            record_cache_stat("eviction", amount=len(to_evict))
+    _flush_stats(force=True)
+
+
+@frappe.whitelist()
+def get_cache_stats() -> Dict:
+    """Cache counters since the last reset, overall and broken down by intent and expiry bucket"""
+    frappe.only_for("System Manager")
+    _flush_stats(force=True)
+
+    redis = frappe.cache()
+    totals, by_intent, by_bucket, since = {}, {}, {}, None
+    for field, value in redis.hgetall(redis.make_key(STATS_KEY)).items():
+        field, value = field.decode() if isinstance(field, bytes) else field, int(value)
+        if field == "since":
+            since = datetime.fromtimestamp(value)
+            continue
+        event, _, breakdown = field.partition("|")
+        if not breakdown:
+            totals[event] = value
+            continue
+        kind, _, label = breakdown.partition("|")
+        target = by_intent if kind == "intent" else by_bucket
+        target.setdefault(label, {})[event] = value
+
+    hits = totals.get("hit", 0) + totals.get("near_hit", 0)
+    lookups = hits + totals.get("miss", 0)
+    return {
+        "since": since,
+        "totals": totals,
+        "hit_rate": round(hits / lookups, 4) if lookups else None,
+        "by_intent": by_intent,
+        "by_bucket": by_bucket,
+        "entries": redis.zcard(redis.make_key(LRU_KEY)),
+        "bytes_stored": sum(int(v) for v in redis.hvals(redis.make_key(SIZE_KEY))),
+        "max_entries": _max_entries(),
+        "max_bytes": _max_bytes(),
+    }
+
+
+@frappe.whitelist()
+def reset_cache_stats():
+    frappe.only_for("System Manager")
+    with _stats_lock:
+        _pending_stats.pop(frappe.local.site, None)
+    frappe.cache().delete(frappe.cache().make_key(STATS_KEY))
@@ -0,0 +1,262 @@
+"""
+File exports of query results.
+
+Rows are consumed from a `QueryStream` and written straight into the site's
+public files directory; the `File` document is registered afterwards from the
+path, so no export is ever held in memory as a whole. Excel exports use
+openpyxl's write-only mode: header and note rows share named styles, data
+cells are written unstyled, and column widths are estimated from the first rows.
+Results too large for Excel to be useful go to CSV, gzip-compressed by default.
+Requests never build exports themselves: `schedule_export` answers with a
+placeholder and a long-queue job writes the file, then swaps the placeholder
+for the download link.
+"""
+import csv
+import gzip
+import hashlib
+import itertools
+import os
+from typing import Callable, List, Optional
+
+import frappe
+from frappe.utils import cint
+
+from isoft_ai.query import QueryStream, guard_query, run_query
+
+EXPORT_FILE_PREFIX = "erp_query_result"
+
+# Rows an export may hold; exports re-run the query with this LIMIT instead of the result-row cap
+MAX_EXPORT_ROWS = 100_000
+# Results expected to be larger than this many rows are exported as CSV, written in chunks
+CSV_EXPORT_ROWS = 20000
+CSV_CHUNK_ROWS = 1000
+
+# Background exports (long queue): job timeout in seconds, progress pushed every N rows
+EXPORT_JOB_TIMEOUT = 1800
+EXPORT_PROGRESS_ROWS = 5000
+
+# Column widths are estimated from this many leading rows, in characters between the bounds
+WIDTH_SAMPLE_ROWS = 200
+MIN_COLUMN_WIDTH = 10
+MAX_COLUMN_WIDTH = 50
+
+HEADER_STYLE = "isoft_ai_header"
+NOTE_STYLE = "isoft_ai_note"
+
+
+def schedule_export(sql: str) -> str:
+    """Hand a large export to a long-queue job; returns the placeholder answer the job later replaces"""
+    placeholder = enqueue_export("isoft_ai.tasks.run_export_job", sql=sql)
+    # The placeholder is only meaningful until the job finishes
+    frappe.flags.isoft_ai_skip_cache = True
+    return placeholder
+
+
+def enqueue_export(method: str, **kwargs) -> str:
+    """Enqueue an export job `method(export_id, **kwargs)` and return the placeholder it reports to"""
+    export_id = frappe.generate_hash(length=12)
+    frappe.enqueue(
+        method,
+        queue=frappe.conf.get("isoft_ai_export_queue") or "long",
+        timeout=EXPORT_JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        export_id=export_id,
+        **kwargs,
+    )
+    return (
+        f"<div class='alert alert-info ai-export' data-export-id='{export_id}'>⏳ Preparing your export. "
+        f"The download link will appear here when it is ready. <span class='ai-export-status'></span></div>"
+    )
+
+
+def complete_export(export_id: str, ai_response: str):
+    """Replace the placeholder of an export in every chat message that shows it"""
+    for name in frappe.get_all("AI Chat Message", filters={
+        "ai_response": ["like", f"%data-export-id='{export_id}'%"]
+    }, pluck="name"):
+        frappe.db.set_value("AI Chat Message", name, "ai_response", ai_response, update_modified=False)
+
+
+def export_query(sql: str, progress: Optional[Callable[[int], None]] = None) -> str:
+    """Guard and run a generated query with the export row cap, and export its rows"""
+    max_rows = frappe.conf.get("isoft_ai_max_export_rows") or MAX_EXPORT_ROWS
+    sql, estimated_rows = guard_query(sql, max_rows)
+    stream = run_query(sql, max_rows)
+    try:
+        return export_result(stream, estimated_rows, progress)
+    finally:
+        stream.close()
+
+
+def export_result(stream: QueryStream, estimated_rows: int = 0,
+                  progress: Optional[Callable[[int], None]] = None) -> str:
+    """
+    Excel for ordinary results; CSV (gzip-compressed unless `isoft_ai_csv_gzip` is 0) when the
+    EXPLAIN estimate, capped at the stream's row limit, exceeds the CSV threshold.
+    `progress` is called with the number of rows written every EXPORT_PROGRESS_ROWS rows.
+    """
+    threshold = frappe.conf.get("isoft_ai_csv_export_rows") or CSV_EXPORT_ROWS
+    if min(estimated_rows, stream.max_rows) > threshold:
+        return generate_csv_file(stream, compress=bool(cint(frappe.conf.get("isoft_ai_csv_gzip", 1))),
+                                 progress=progress)
+    return generate_excel_file(stream, progress)
+
+
+def generate_excel_file(stream: QueryStream, progress: Optional[Callable[[int], None]] = None) -> str:
+    """Write the stream to a new .xlsx in the public files directory and return its URL"""
+    sample = stream.peek(WIDTH_SAMPLE_ROWS)
+    if not sample:
+        frappe.throw("No results to export.")
+
+    try:
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+    except ImportError:
+        # Fallback to CSV if openpyxl is not available
+        return generate_csv_file(stream, progress=progress)
+
+    wb = openpyxl.Workbook(write_only=True)
+    for style in _named_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet("ERP Query Results")
+
+    # Write-only sheets take their column widths before the first row
+    for col_num, width in enumerate(_estimate_widths(stream.columns, sample), 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = width
+
+    ws.freeze_panes = "A2"
+
+    def styled(value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        return cell
+
+    # Data cells stay unstyled: openpyxl then picks date/number formats itself and writes no style per cell
+    ws.append([styled(header, HEADER_STYLE) for header in stream.columns])
+    row_count = 1
+    for row in stream:
+        ws.append([_excel_value(value) for value in row])
+        row_count += 1
+        if progress and (row_count - 1) % EXPORT_PROGRESS_ROWS == 0:
+            progress(row_count - 1)
+    ws.auto_filter.ref = f"A1:{get_column_letter(len(stream.columns))}{row_count}"
+    if stream.truncated:
+        ws.append([styled(truncation_note(stream), NOTE_STYLE)])
+
+    file_name, path = _new_export_path("xlsx")
+    try:
+        wb.save(path)
+    except Exception:
+        _remove(path)
+        raise
+    return register_export_file(file_name, path)
+
+
+def generate_csv_file(stream: QueryStream, compress: bool = False,
+                      progress: Optional[Callable[[int], None]] = None) -> str:
+    """Write the stream to a new .csv (or .csv.gz) in the public files directory, CSV_CHUNK_ROWS rows at a time"""
+    if not stream.peek(1):
+        frappe.throw("No results to export.")
+
+    def plain(v):
+        if v is None:
+            return ""
+        if isinstance(v, str) and v.isdigit() and v.startswith("0"):
+            # Preserve leading zeros in Excel
+            return f'="{v}"'
+        return v
+
+    file_name, path = _new_export_path("csv.gz" if compress else "csv")
+    opener = gzip.open if compress else open
+    try:
+        with opener(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(stream.columns)
+            rows = iter(stream)
+            written = 0
+            while True:
+                chunk = [[plain(v) for v in row] for row in itertools.islice(rows, CSV_CHUNK_ROWS)]
+                if not chunk:
+                    break
+                writer.writerows(chunk)
+                written += len(chunk)
+                if progress and written % EXPORT_PROGRESS_ROWS == 0:
+                    progress(written)
+            if stream.truncated:
+                writer.writerow([truncation_note(stream)])
+    except Exception:
+        _remove(path)
+        raise
+    return register_export_file(file_name, path)
+
+
+def truncation_note(stream: QueryStream) -> str:
+    return f"Only the first {stream.row_count:,} rows are included; narrow the question to see the rest."
+
+
+def register_export_file(file_name: str, path: str) -> str:
+    """Insert the File document for an export already on disk, without reading it into memory"""
+    content_hash = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            content_hash.update(chunk)
+
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "file_url": f"/files/{file_name}",
+        "file_size": os.path.getsize(path),
+        "content_hash": content_hash.hexdigest(),
+        "is_private": 0
+    }).insert(ignore_permissions=True)
+
+    if file_doc.file_url != f"/files/{file_name}":
+        # An identical export already exists and the File now points to it
+        _remove(path)
+    return file_doc.file_url
+
+
+def _new_export_path(extension: str):
+    file_name = f"{EXPORT_FILE_PREFIX}_{frappe.generate_hash(length=10)}.{extension}"
+    return file_name, frappe.get_site_path("public", "files", file_name)
+
+
+def _remove(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _named_styles() -> List:
+    from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+
+    thin = Side(style="thin")
+    return [
+        NamedStyle(
+            name=HEADER_STYLE,
+            font=Font(bold=True, color="FFFFFF"),
+            fill=PatternFill(start_color="366092", end_color="366092", fill_type="solid"),
+            alignment=Alignment(horizontal="center", vertical="center"),
+            border=Border(left=thin, right=thin, top=thin, bottom=thin),
+        ),
+        NamedStyle(name=NOTE_STYLE, font=Font(italic=True, color="808080")),
+    ]
+
+
+def _estimate_widths(columns: List[str], sample: List[tuple]) -> List[int]:
+    widths = []
+    for index, column in enumerate(columns):
+        longest = max([len(str(column))] + [len(str(row[index])) for row in sample if row[index] is not None])
+        widths.append(min(max(longest + 2, MIN_COLUMN_WIDTH), MAX_COLUMN_WIDTH))
+    return widths
+
+
+def _excel_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    if isinstance(value, str) and value.isdigit() and value.startswith("0"):
+        # Preserve leading zeros
+        return f'="{value}"'
+    return value
@@ -36,6 +36,12 @@ web_include_js = ['/assets/js/ai-chat.js','/assets/js/isoft-ai.js']
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
+# Boot
+# ----
+
+# extend bootinfo sent to the desk
+boot_session = "isoft_ai.boot.boot_session"
+
 # Home Pages
 # ----------
 
@@ -65,6 +71,11 @@ web_include_js = ['/assets/js/ai-chat.js','/assets/js/isoft-ai.js']
 # before_uninstall = "isoft_ai.uninstall.before_uninstall"
 # after_uninstall = "isoft_ai.uninstall.after_uninstall"
 
+# Migration
+# ------------
+
+after_migrate = ["isoft_ai.schema.clear_schema_cache"]
+
 # Desk Notifications
 # ------------------
 # See frappe.core.notifications.get_notification_config
@@ -103,6 +114,26 @@ web_include_js = ['/assets/js/ai-chat.js','/assets/js/isoft-ai.js']
 #	}
 # }
 
+# on_change runs after on_update, on_submit, on_cancel and on_update_after_submit
+doc_events = {
+	"*": {
+		"on_change": "isoft_ai.cache.invalidate_for_doc",
+		"on_trash": "isoft_ai.cache.invalidate_for_doc"
+	},
+	"DocType": {
+		"on_change": "isoft_ai.schema.invalidate_schema",
+		"on_trash": "isoft_ai.schema.invalidate_schema"
+	},
+	"Custom Field": {
+		"on_change": "isoft_ai.schema.invalidate_schema",
+		"on_trash": "isoft_ai.schema.invalidate_schema"
+	},
+	"Property Setter": {
+		"on_change": "isoft_ai.schema.invalidate_schema",
+		"on_trash": "isoft_ai.schema.invalidate_schema"
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -124,6 +155,12 @@ web_include_js = ['/assets/js/ai-chat.js','/assets/js/isoft-ai.js']
 #	]
 # }
 
+scheduler_events = {
+	"hourly": [
+		"isoft_ai.tasks.cleanup_ai_cache"
+	]
+}
+
 # Testing
 # -------
 
@@ -0,0 +1,169 @@
+"""
+Local intent classifier used ahead of the LLM intent stage.
+
+Questions are scored against the module DocType names and per-intent keyword
+vocabularies with a single compiled regex. Clear-cut questions get the same
+`intent_analysis` structure the LLM returns; anything below the confidence
+threshold returns None so the caller asks the LLM.
+"""
+import re
+from typing import Dict, List, Optional
+
+import frappe
+
+LOCAL_INTENT_THRESHOLD = 0.8
+# DocTypes suggested for the SQL prompt: the winning module's first, then other modules' hits
+MAX_SUGGESTED_DOCTYPES = 6
+
+# Weight of a DocType name match vs. a vocabulary keyword match
+DOCTYPE_WEIGHT = 2.0
+KEYWORD_WEIGHT = 1.0
+
+# Per-intent vocabulary: keyword -> DocType it points to (None when it names no single DocType)
+INTENT_KEYWORDS = {
+    'SELLING': {
+        'sales': 'Sales Invoice', 'sale': 'Sales Invoice', 'sold': 'Sales Invoice', 'selling': 'Sales Invoice',
+        'revenue': 'Sales Invoice', 'turnover': 'Sales Invoice', 'customers': 'Customer', 'sales order': 'Sales Order',
+        'quotations': 'Quotation', 'territory': 'Customer',
+    },
+    'ACCOUNTING': {
+        'outstanding': 'Sales Invoice', 'overdue': 'Sales Invoice', 'receivable': 'Sales Invoice',
+        'payable': 'Purchase Invoice', 'payment': 'Payment Entry', 'payments': 'Payment Entry', 'paid': 'Payment Entry',
+        'ledger': 'GL Entry', 'general ledger': 'GL Entry', 'journal': 'Journal Entry', 'accounts': 'Account',
+        'profit': 'GL Entry', 'expense': 'GL Entry', 'expenses': 'GL Entry', 'income': 'GL Entry', 'debit': 'GL Entry',
+        'credit': 'GL Entry', 'cash': 'GL Entry', 'bank': 'Payment Entry',
+    },
+    'BUYING': {
+        'purchase': 'Purchase Invoice', 'purchases': 'Purchase Invoice', 'bought': 'Purchase Invoice',
+        'buying': 'Purchase Invoice', 'suppliers': 'Supplier', 'vendor': 'Supplier', 'vendors': 'Supplier',
+        'purchase order': 'Purchase Order', 'purchase orders': 'Purchase Order',
+    },
+    'STOCK': {
+        'stock': 'Bin', 'inventory': 'Bin', 'warehouses': 'Warehouse', 'items': 'Item', 'products': 'Item',
+        'product': 'Item', 'qty': 'Bin', 'quantity': 'Bin', 'reorder': 'Bin', 'stock entries': 'Stock Entry',
+        'delivery note': 'Delivery Note', 'delivered': 'Delivery Note',
+    },
+    'MANUFACTURING': {
+        'work orders': 'Work Order', 'boms': 'BOM', 'bill of materials': 'BOM', 'production': 'Work Order',
+        'manufacturing': 'Work Order', 'manufactured': 'Work Order', 'job cards': 'Job Card',
+    },
+    'HR': {
+        'employees': 'Employee', 'staff': 'Employee', 'salary': 'Salary Slip', 'salaries': 'Salary Slip',
+        'payroll': 'Salary Slip', 'leave': 'Leave Application', 'leaves': 'Leave Application',
+        'absent': 'Attendance', 'present': 'Attendance',
+    },
+    'PROJECTS': {
+        'projects': 'Project', 'tasks': 'Task', 'timesheets': 'Timesheet', 'hours': 'Timesheet',
+        'issues': 'Issue', 'tickets': 'Issue',
+    },
+    'CRM': {
+        'leads': 'Lead', 'opportunities': 'Opportunity', 'contacts': 'Contact', 'prospects': 'Lead',
+        'pipeline': 'Opportunity',
+    },
+    'ASSETS': {
+        'assets': 'Asset', 'depreciation': 'Asset', 'fixed asset': 'Asset',
+    },
+    'QUALITY': {
+        'quality': 'Quality Inspection', 'inspections': 'Quality Inspection', 'goals': 'Quality Goal',
+    },
+}
+
+# Cues that the question asks for data rather than an explanation
+DATA_CUES = re.compile(
+    r"\b(top|bottom|list|show|get|find|count|how many|how much|total|sum|average|report|data|highest|lowest|"
+    r"most|least|best|worst|this (?:week|month|quarter|year)|last (?:week|month|quarter|year)|today|yesterday|"
+    r"per|by|between|since|outstanding|overdue|pending|balance|available|level|\d+)\b",
+    re.I
+)
+KNOWLEDGE_CUES = re.compile(
+    r"^\s*(what is|what are|what does|how (?:do|can|to|does)|explain|define|definition of|meaning of|why (?:do|does|is))\b",
+    re.I
+)
+STUDY_CUES = re.compile(
+    r"\b(make a study|study (?:on|of|for|about|this)|analy[sz]e|analysis of|investigate|examine|research|"
+    r"insights? (?:about|on|into)|tell me about|details about|information about)\b",
+    re.I
+)
+STUDY_ENTITIES = {'item': 'Item', 'product': 'Item', 'customer': 'Customer', 'supplier': 'Supplier'}
+
+_automata = {}
+
+
+def _get_automaton(modules: Dict[str, List[str]]):
+    """One compiled alternation over every DocType name and keyword, longest terms first"""
+    key = repr(sorted(modules.items()))
+    if key not in _automata:
+        terms = {}
+        for intent, doctypes in modules.items():
+            for doctype in doctypes:
+                terms.setdefault(doctype.lower(), []).append((intent, doctype, DOCTYPE_WEIGHT))
+        for intent, vocabulary in INTENT_KEYWORDS.items():
+            if intent not in modules:
+                continue
+            for keyword, doctype in vocabulary.items():
+                terms.setdefault(keyword, []).append((intent, doctype, KEYWORD_WEIGHT))
+        pattern = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+        _automata[key] = (re.compile(rf"\b(?:{pattern})s?\b", re.I), terms)
+    return _automata[key]
+
+
+def classify_intent(question: str, modules: Dict[str, List[str]]) -> Optional[Dict]:
+    """
+    Classify clear-cut questions locally. Returns the LLM's intent_analysis structure
+    (plus "source": "local"), or None when the LLM should decide.
+    """
+    if not frappe.conf.get("isoft_ai_local_intent", 1):
+        return None
+    threshold = frappe.conf.get("isoft_ai_local_intent_threshold") or LOCAL_INTENT_THRESHOLD
+
+    if STUDY_CUES.search(question):
+        entity = next((dt for word, dt in STUDY_ENTITIES.items() if re.search(rf"\b{word}s?\b", question, re.I)), None)
+        if entity is None:
+            return None
+        return _analysis("STUDY", 0.9, [entity], True)
+
+    automaton, terms = _get_automaton(modules)
+    scores, doctypes = {}, {}
+    for match in automaton.finditer(question):
+        term = match.group(0).lower()
+        entries = terms.get(term, []) + (terms.get(term[:-1], []) if term.endswith("s") else [])
+        # A term shared by several modules counts for each of them, split evenly
+        shared = len({intent for intent, _, _ in entries}) or 1
+        for intent, doctype, weight in entries:
+            scores[intent] = scores.get(intent, 0) + weight / shared
+            if doctype:
+                doctypes.setdefault(intent, [])
+                if doctype not in doctypes[intent]:
+                    doctypes[intent].append(doctype)
+
+    if KNOWLEDGE_CUES.search(question) and not DATA_CUES.search(question):
+        confidence = 0.85 if not scores else 0.7
+        return _analysis("KNOWLEDGE", confidence, [], False) if confidence >= threshold else None
+
+    if not scores or not DATA_CUES.search(question):
+        return None
+
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    intent, top = ranked[0]
+    second = ranked[1][1] if len(ranked) > 1 else 0
+    if top < DOCTYPE_WEIGHT:
+        return None
+    confidence = round(min(0.95, 0.6 + 0.35 * (top - second) / top + 0.05 * min(top, 4) / 4), 2)
+    if confidence < threshold:
+        return None
+    suggested = doctypes.get(intent, [])[:4]
+    # Weaker modules still name tables the query needs: "top items sold" also reads Sales Invoice
+    for other, _ in ranked[1:]:
+        suggested += [doctype for doctype in doctypes.get(other, []) if doctype not in suggested]
+    return _analysis(intent, confidence, suggested[:MAX_SUGGESTED_DOCTYPES], True)
+
+
+def _analysis(intent: str, confidence: float, suggested_doctypes: List[str], requires_sql: bool) -> Dict:
+    return {
+        "intent": intent,
+        "confidence": confidence,
+        "suggested_doctypes": suggested_doctypes,
+        "requires_sql": requires_sql,
+        "clarification_needed": False,
+        "source": "local",
+    }
@@ -1,9 +1,6 @@
 import frappe
-import openai
 import re
 import json
-import csv
-import io
 import os
 from typing import List, Dict, Optional
 import pdfkit
@@ -12,28 +9,63 @@ try:
 except ImportError:
     pdfkit = None
 from frappe.model.document import Document
-from frappe.utils import escape_html
+from frappe.utils import cint, escape_html, formatdate, format_datetime
+from isoft_ai import llm
+from isoft_ai.export import schedule_export
+from isoft_ai.intent import classify_intent
+from isoft_ai.preview import previews_enabled, store_preview
+from isoft_ai.query import QueryRejectedError, guard_query, read_sql, run_query
+from isoft_ai.schema import get_doctype_columns, get_doctype_schema, get_prompt_context
+from isoft_ai.cache import (
+    delete_cached_sql, get_cache_key, get_cached_response, get_cached_sql, get_sql_doctypes, record_cache_stat,
+    seconds_until_midnight, set_cached_response, set_cached_sql, single_flight
+)
 try:
     import sqlparse
 except ImportError:
     sqlparse = None
 import difflib
-import hashlib
-from datetime import datetime, timedelta
+import time
+from datetime import date, datetime
+from decimal import Decimal
 
-# Cache settings
-CACHE_EXPIRY_HOURS = 24
-MAX_CACHE_ENTRIES = 1000
-
-# Dynamic cache expiry based on query type
+# Dynamic cache expiry (minutes) based on query type
 CACHE_EXPIRY_RULES = {
     'REAL_TIME': 0,      # No caching for real-time data
     'HIGH_FREQ': 5,      # 5 minutes for frequently changing data
     'MEDIUM_FREQ': 30,   # 30 minutes for moderately changing data
     'LOW_FREQ': 120,     # 2 hours for slowly changing data
-    'STATIC': 1440       # 24 hours for static/reference data
+    'STATIC': 1440,      # 24 hours for static/reference data
+    'DATA': 1440         # 24 hours for answers computed by SQL, invalidated by doc_events on the DocTypes read
 }
 
+# Questions and queries whose answer changes with the date even when no document changes
+RELATIVE_DATE_KEYWORDS = ['today', 'yesterday', 'tomorrow', 'this week', 'this month', 'this year', 'this quarter',
+                          'last week', 'last month', 'last year', 'overdue', 'due', 'ageing', 'aging']
+RELATIVE_DATE_SQL = r"CURDATE|CURRENT_DATE|CURRENT_TIMESTAMP|NOW\(|SYSDATE|UTC_DATE|'\d{4}-\d{2}-\d{2}|\b(19|20)\d{2}\b"
+
+# Column-name hints for the local result renderer
+# Matched against whole words of a column name (split on "_" and spaces), in order
+CURRENCY_COLUMN_HINTS = ('amount', 'grand_total', 'net_total', 'rounded_total', 'price', 'rate', 'value', 'outstanding',
+                         'paid', 'balance', 'debit', 'credit', 'revenue', 'cost', 'purchase', 'salary', 'valuation')
+NON_ADDITIVE_COLUMN_HINTS = ('rate', 'price', 'avg', 'average', 'percent', 'pct', 'ratio', 'margin', 'year', 'month',
+                             'day', 'idx', 'docstatus', 'valuation')
+
+# Keywords that close the table list of a FROM clause
+SQL_FROM_END_KEYWORDS = {'WHERE', 'ON', 'USING', 'GROUP BY', 'ORDER BY', 'HAVING', 'LIMIT', 'UNION', 'UNION ALL',
+                         'WINDOW', 'FOR UPDATE'}
+
+# Larger results are exported to a file instead of rendered inline
+INLINE_MAX_ROWS = 10
+INLINE_MAX_COLUMNS = 5
+
+# Background ask_ai jobs (seconds)
+AI_JOB_TIMEOUT = 600
+
+# Streamed tokens are relayed to the browser in batches of this size/age
+STREAM_FLUSH_CHARS = 40
+STREAM_FLUSH_SECONDS = 0.15
+
 # ERPNext v13 Module Coverage
 ERPNEXT_MODULES = {
     'ACCOUNTING': ['GL Entry', 'Journal Entry', 'Payment Entry', 'Account'],
@@ -48,19 +80,21 @@ ERPNEXT_MODULES = {
     'QUALITY': ['Quality Inspection', 'Quality Goal']
 }
 
-def get_cache_key(question: str, chat_history: Optional[List] = None) -> str:
-    """Generate cache key for question and context"""
-    content = question
-    if chat_history:
-        # Include last 2 messages for context
-        recent_context = str(chat_history[-2:]) if len(chat_history) > 2 else str(chat_history)
-        content += recent_context
-    return hashlib.md5(content.encode()).hexdigest()
+# Schema given to SQL prompts when a question suggests no DocTypes of its own
+DEFAULT_SQL_DOCTYPES = ['Sales Invoice', 'Purchase Invoice', 'Bin', 'Stock Ledger Entry', 'GL Entry', 'Item']
 
-def determine_cache_expiry(question: str, intent: str, suggested_doctypes: list) -> int:
+def determine_cache_expiry(question: str, intent: str, suggested_doctypes: list, sql: str = "") -> int:
     """Determine appropriate cache expiry based on query characteristics"""
     
     question_lower = question.lower()
+
+    # Answers computed by SQL are tagged with the DocTypes they read and invalidated when those
+    # change, so they only need to expire when the date they were computed for rolls over
+    if sql:
+        expiry = frappe.conf.get("isoft_ai_data_cache_minutes") or CACHE_EXPIRY_RULES['DATA']
+        if any(keyword in question_lower for keyword in RELATIVE_DATE_KEYWORDS) or re.search(RELATIVE_DATE_SQL, sql, re.I):
+            expiry = min(expiry, seconds_until_midnight() // 60)
+        return expiry
     
     # Real-time indicators - NO CACHING
     real_time_keywords = [
@@ -118,71 +152,11 @@ def determine_cache_expiry(question: str, intent: str, suggested_doctypes: list)
     # Conservative default
     return CACHE_EXPIRY_RULES['HIGH_FREQ']
 
-def get_cached_response(cache_key: str) -> Optional[Dict]:
-    """Get cached response if available and not expired"""
-    try:
-        # Check if document exists first
-        if frappe.db.exists('AI Cache', cache_key):
-            cache_doc = frappe.get_doc('AI Cache', cache_key)
-            if cache_doc.expires_at > datetime.now():
-                return json.loads(cache_doc.response_data)
-    except Exception as e:
-        frappe.logger().debug(f"Cache get error (normal): {str(e)}")
-    return None
-
-def set_cached_response(cache_key: str, response_data: dict, expiry_hours: int = CACHE_EXPIRY_HOURS):
-    """Cache response with expiry"""
-    try:
-        expires_at = datetime.now() + timedelta(hours=expiry_hours)
-        
-        # Check if cache already exists
-        if frappe.db.exists('AI Cache', cache_key):
-            try:
-                cache_doc = frappe.get_doc('AI Cache', cache_key)
-                cache_doc.response_data = json.dumps(response_data)
-                cache_doc.expires_at = expires_at
-                cache_doc.save(ignore_permissions=True)
-            except Exception as e:
-                frappe.logger().debug(f"Cache update error: {str(e)}")
-        else:
-            # Create new cache entry
-            try:
-                cache_doc = frappe.get_doc({
-                    'doctype': 'AI Cache',
-                    'name': cache_key,
-                    'response_data': json.dumps(response_data),
-                    'expires_at': expires_at
-                })
-                cache_doc.insert(ignore_permissions=True)
-            except Exception as e:
-                frappe.logger().debug(f"Cache create error: {str(e)}")
-        
-        # Clean old cache entries if too many
-        cleanup_old_cache()
-    except Exception as e:
-        frappe.logger().debug(f"Cache set error: {str(e)}")
-
-def cleanup_old_cache():
-    """Remove expired cache entries and limit total entries"""
-    try:
-        # Check if table exists first
-        if not frappe.db.exists('DocType', 'AI Cache'):
-            return
-            
-        # Remove expired entries
-        frappe.db.sql("DELETE FROM `tabAI Cache` WHERE expires_at < %s", (datetime.now(),))
-        
-        # Limit total entries
-        total_count = frappe.db.count('AI Cache')
-        if total_count > MAX_CACHE_ENTRIES:
-            excess = total_count - MAX_CACHE_ENTRIES
-            frappe.db.sql("""
-                DELETE FROM `tabAI Cache` 
-                ORDER BY creation ASC 
-                LIMIT %s
-            """, (excess,))
-    except Exception as e:
-        frappe.logger().debug(f"Cache cleanup error: {str(e)}")
+def get_cache_bucket(expiry: int, sql: str = "") -> str:
+    """CACHE_EXPIRY_RULES key an expiry from determine_cache_expiry came from (for cache statistics)"""
+    if sql:
+        return 'DATA'
+    return next((bucket for bucket, minutes in CACHE_EXPIRY_RULES.items() if minutes == expiry), 'DATA')
 
 def generate_clarifying_question(question: str, chat_history: list, suggested_doctypes: list, token_usage: dict) -> str:
     """Generate a helpful clarifying question"""
@@ -209,57 +183,121 @@ def generate_clarifying_question(question: str, chat_history: list, suggested_do
         }
     ]
     
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=prompt,
+    return llm.chat_completion(
+        "clarify",
+        prompt,
         max_tokens=100,
         temperature=0.3,
+        token_usage=token_usage,
     )
-    
-    token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += response['usage']['completion_tokens']
-    token_usage["total_tokens"] += response['usage']['total_tokens']
-    
-    return response.choices[0].message["content"].strip()
 
-def handle_erpnext_module_query(intent: str, question: str, suggested_doctypes: list, confidence: float, token_usage: dict) -> str:
-    """Handle specific ERPNext module queries with enhanced functionality"""
+def handle_erpnext_module_query(intent: str, question: str, suggested_doctypes: list, confidence: float, token_usage: dict,
+                                query_meta: Optional[dict] = None) -> str:
+    """
+    Handle specific ERPNext module queries with enhanced functionality.
+    The executed SQL is recorded in `query_meta["sql"]` when given.
+    """
     
     if intent in ERPNEXT_MODULES and confidence > 0.7:
         # Generate module-specific response
         module_doctypes = ERPNEXT_MODULES[intent]
-        relevant_types = [dt for dt in suggested_doctypes if dt in module_doctypes] or module_doctypes[:3]
+        # The module's own DocTypes first, then those of other modules the question also needs (in order)
+        relevant_types = sorted(suggested_doctypes, key=lambda dt: dt not in module_doctypes) or module_doctypes[:3]
         
         try:
             # Try to generate SQL for the query
+            publish_ai_progress("Generating query...")
             sql_query = generate_enhanced_sql(question, intent, relevant_types, token_usage)
             if sql_query:
-                db_result = frappe.db.sql(sql_query, as_dict=True)
-                if db_result:
-                    if len(db_result) > 10 or len(db_result[0].keys()) > 5:
-                        return generate_excel_file(db_result)
-                    else:
-                        return polish_erp_answer_html(question, format_result(db_result), token_usage)
-                else:
-                    return f"<div class='alert alert-info'>🔍 No data found for your {intent.lower()} query. Try adjusting your criteria or time range.</div>"
+                result = run_sql_answer(question, sql_query, intent, token_usage)
+                set_cached_sql(question, intent, sql_query)
+                if query_meta is not None:
+                    query_meta["sql"] = sql_query
+                return result
             else:
                 return f"<div class='alert alert-warning'>⚠️ Could not generate a query for this {intent.lower()} request. Please be more specific about what data you need.</div>"
                 
+        except QueryRejectedError as e:
+            if query_meta is not None:
+                query_meta["rejected"] = True
+            return query_rejected_html(e)
         except Exception as e:
             return f"<div class='alert alert-danger'>❌ Error processing {intent.lower()} query: {str(e)}</div>"
     
     return f"<div class='alert alert-info'>🚧 {intent} module functionality is being enhanced. Please try a more specific query.</div>"
 
+def run_sql_answer(question: str, sql_query: str, intent: str, token_usage: dict) -> str:
+    """Execute a validated query and render its result as a file or a short HTML answer"""
+    publish_ai_progress("Running query...")
+    no_data = f"<div class='alert alert-info'>🔍 No data found for your {intent.lower()} query. Try adjusting your criteria or time range.</div>"
+    return render_query_answer(question, sql_query, token_usage, no_data)
+
+
+def render_query_answer(question: str, sql_query: str, token_usage: dict, no_data_html: str) -> str:
+    """
+    Guard a query and render its rows inline when the result is small, as a paged preview
+    when it fits a snapshot, and as a file otherwise
+    """
+    guarded_sql, _ = guard_query(sql_query)
+    stream = run_query(guarded_sql)
+    try:
+        head = stream.peek(INLINE_MAX_ROWS + 1)
+        if not head:
+            return no_data_html
+
+        publish_ai_progress("Preparing results...")
+        if len(head) <= INLINE_MAX_ROWS and len(stream.columns) <= INLINE_MAX_COLUMNS:
+            return render_erp_answer_html(question, [dict(zip(stream.columns, row)) for row in head], token_usage)
+
+        # The EXPLAIN estimate counts rows examined, not returned: let the snapshot's own caps decide
+        if previews_enabled():
+            result_id = store_preview(stream, guarded_sql)
+            if result_id:
+                return render_result_preview(result_id, stream, head[:INLINE_MAX_ROWS])
+    finally:
+        stream.close()
+
+    # Exports run the query again with the (higher) export row cap, in a background job
+    return schedule_export(sql_query)
+
+
+def render_result_preview(result_id: str, stream, head: list) -> str:
+    """First rows of a stored result; the chat widget turns it into a paged, sortable grid"""
+    total = f"{stream.row_count:,}+" if stream.truncated else f"{stream.row_count:,}"
+    table = render_result_table([dict(zip(stream.columns, row)) for row in head])
+    return (
+        f"<div class='ai-result-grid' data-result-id='{result_id}'>{table}"
+        f"<div class='text-muted small'>Showing {len(head)} of {total} rows.</div></div>"
+    )
+
+
+def query_rejected_html(error: QueryRejectedError) -> str:
+    return f"<div class='alert alert-warning'>⚠️ <b>Query not run:</b> {escape_html(str(error))}</div>"
+
+
+def answer_from_cached_sql(question: str, cached_query: dict, token_usage: dict) -> Optional[str]:
+    """
+    Re-run the SQL cached for this question against live data; None when it no longer works.
+    A QueryRejectedError propagates: regenerated SQL would be just as expensive.
+    """
+    try:
+        return run_sql_answer(question, cached_query["sql"], cached_query["intent"], token_usage)
+    except QueryRejectedError:
+        raise
+    except Exception as e:
+        frappe.logger().error(f"Cached SQL failed, regenerating: {str(e)}")
+        delete_cached_sql(question)
+        return None
+
+
 def generate_enhanced_sql(question: str, intent: str, suggested_doctypes: list, token_usage: dict) -> Optional[str]:
-    """Enhanced SQL generation with ERPNext v13 module-specific knowledge"""
-    
-    module_context = ""
-    if intent in ERPNEXT_MODULES:
-        relevant_doctypes = ERPNEXT_MODULES[intent]
-        module_context = f"Focus on {intent} module with doctypes: {relevant_doctypes}. "
+    """Enhanced SQL generation with the schema of the question's candidate DocTypes"""
     
+    candidates = list(dict.fromkeys(list(suggested_doctypes) + ERPNEXT_MODULES.get(intent, [])))
+    module_context = f"Focus on the {intent} module. " if intent in ERPNEXT_MODULES else ""
     if suggested_doctypes:
         module_context += f"Prioritize these doctypes: {suggested_doctypes}. "
+    schema_context = get_prompt_context(candidates or DEFAULT_SQL_DOCTYPES, question)
     
     messages = [
         {
@@ -269,22 +307,9 @@ def generate_enhanced_sql(question: str, intent: str, suggested_doctypes: list,
                 f"Generate ONLY a valid SELECT query for ERPNext v13 with 'tab' prefixed tables.\n\n"
                 f"ERPNext v13 Schema Rules:\n"
                 f"- All tables prefixed with 'tab' and use spaces (e.g., 'tabSales Invoice', 'tabSales Invoice Item')\n"
-                f"- Use docstatus=1 for submitted documents\n"
-                f"- Use is_cancelled=0 where applicable\n"
-                f"- Parent-child relations use 'parent' field\n"
-                f"- Common fields: name, creation, modified, owner\n\n"
-                f"ACCOUNTING MODULE:\n"
-                f"- tabSales Invoice: customer, posting_date, grand_total, docstatus, outstanding_amount, due_date\n"
-                f"- tabPayment Entry: party, posting_date, paid_amount, reference_no, reference_date\n"
-                f"- tabGL Entry: posting_date, account, debit, credit, voucher_type, party\n\n"
-                f"STOCK MODULE:\n"
-                f"- tabItem: item_code, item_name, item_group, brand, description\n"
-                f"- tabSales Invoice Item: item_code, qty, rate, amount, parent\n"
-                f"- tabSales Invoice: customer, posting_date, grand_total, docstatus\n\n"
-                f"SELLING MODULE:\n"
-                f"- tabSales Invoice: customer, posting_date, grand_total, docstatus, outstanding_amount\n"
-                f"- tabCustomer: customer_name, customer_type, territory\n\n"
-                f"Available modules: {ERPNEXT_MODULES}\n\n"
+                f"- Every table also has: name, creation, modified, owner, docstatus; child tables have parent, parenttype, parentfield, idx\n"
+                f"- Use only the columns listed below\n\n"
+                f"SCHEMA:\n{schema_context}\n\n"
                 f"FOLLOW-UP CONTEXT: If the question mentions 'include outstanding', 'add totals', 'show amounts', etc., make sure to include outstanding_amount, grand_total, or relevant financial fields.\n\n"
                 f"CRITICAL: You must return ONLY a valid SQL SELECT query. Do NOT provide explanations, instructions, or any other text.\n"
                 f"For 'top N' queries, use ORDER BY and LIMIT clauses.\n"
@@ -297,18 +322,13 @@ def generate_enhanced_sql(question: str, intent: str, suggested_doctypes: list,
     ]
     
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=messages,
+        sql = llm.chat_completion(
+            "sql",
+            messages,
             max_tokens=300,
             temperature=0,
-        )
-        
-        token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-        token_usage["completion_tokens"] += response['usage']['completion_tokens']
-        token_usage["total_tokens"] += response['usage']['total_tokens']
-        
-        sql = response.choices[0].message['content'].strip().rstrip(";")
+            token_usage=token_usage,
+        ).rstrip(";")
         
         if not sql.lower().startswith("select") or re.search(r";|insert|update|delete|drop|alter|truncate", sql, re.I):
             return None
@@ -354,66 +374,54 @@ def ask_enhanced_knowledge_question(chat_history: list, question: str, intent: s
     
     messages.append({"role": "user", "content": question})
     
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
-        max_tokens=500,
-        temperature=0.3,
-    )
-    
-    token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += response['usage']['completion_tokens']
-    token_usage["total_tokens"] += response['usage']['total_tokens']
-    
-    return response.choices[0].message['content'].strip()
+    return complete_with_stream("knowledge", messages, max_tokens=500, temperature=0.3, token_usage=token_usage)
 
 
-class ISOFTAITEST(Document):
-    pass
+class StreamRelay:
+    """Batches streamed tokens into `isoft_ai_stream` realtime events for the chat widget"""
 
+    def __init__(self, stream_id: str):
+        self.stream_id = stream_id
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time.monotonic()
 
-@frappe.whitelist()
-def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str = "") -> dict:
-    if not user_question or not user_question.strip():
-        return {"ai_response": "<div class='alert alert-warning'>💬 Please ask me something! I'm here to help with your ERPNext queries.</div>", "chat_name": None}
+    def __call__(self, delta: str):
+        self.buffer.append(delta)
+        self.size += len(delta)
+        if self.size >= STREAM_FLUSH_CHARS or time.monotonic() - self.last_flush >= STREAM_FLUSH_SECONDS:
+            self.flush()
 
-    if "AI User" not in frappe.get_roles(frappe.session.user):
-        return {"ai_response": "<div class='alert alert-danger'>🚫 Access denied. Please contact your administrator for AI access permissions.</div>", "chat_name": None}
+    def flush(self):
+        if self.buffer:
+            frappe.publish_realtime("isoft_ai_stream", {
+                "stream_id": self.stream_id,
+                "delta": "".join(self.buffer)
+            }, user=frappe.session.user)
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time.monotonic()
 
-    api_key = frappe.conf.get("openai_api_key")
-    if not api_key:
-        frappe.throw("OpenAI API key not configured in site_config.json")
-
-    openai.api_key = api_key
-    user_question = user_question.strip()
-
-    try:
-        chat_history = json.loads(chat_history_json)
-    except Exception:
-        chat_history = []
-
-    # Check cache first for similar questions
-    cache_key = get_cache_key(user_question, chat_history)
-    cached_response = get_cached_response(cache_key)
-    if cached_response:
-        frappe.logger().info(f"Cache hit for question: {user_question[:50]}...")
-        return cached_response
 
-    # Find the first user message for title generation
-    first_user_message = None
-    for msg in chat_history:
-        if msg.get("role") == "user" and msg.get("content") and msg["content"].strip():
-            first_user_message = msg["content"].strip()
-            break
-    if not first_user_message:
-        first_user_message = user_question
+def complete_with_stream(stage: str, messages: list, max_tokens: int, temperature: float, token_usage: dict) -> str:
+    """
+    Run a completion, relaying tokens to the chat widget as they arrive when the
+    request carries a stream id. The full answer is returned either way.
+    """
+    stream_id = frappe.flags.get("isoft_ai_stream_id")
+    if not stream_id:
+        return llm.chat_completion(stage, messages, max_tokens=max_tokens,
+                                   temperature=temperature, token_usage=token_usage)
 
-    ai_chat = get_or_create_ai_chat(ai_chat_name or "", first_user_message or "")
+    relay = StreamRelay(stream_id)
+    content = llm.stream_chat_completion(stage, messages, max_tokens=max_tokens,
+                                         temperature=temperature, token_usage=token_usage, on_delta=relay)
+    relay.flush()
+    return content
 
-    token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
-    user_question = preprocess_question(user_question, chat_history)
-    # --- ENHANCED INTENT DETECTION WITH ERPNext v13 MODULES ---
+def detect_intent(question: str, chat_history: list, token_usage: dict) -> str:
+    """Ask the LLM to classify the question; returns the raw JSON answer"""
     intent_and_action_prompt = [
         {
             "role": "system",
@@ -477,23 +485,143 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                 f"'Tell me more' -> {{'intent':'CLARIFY','confidence':0.9,'suggested_doctypes':[],'requires_sql':false,'clarification_needed':true}}"
             )
         },
-        {"role": "user", "content": f"Question: {user_question}\nChat context: {str(chat_history[-2:]) if len(chat_history) > 1 else 'None'}"}
+        {"role": "user", "content": f"Question: {question}\nChat context: {str(chat_history[-2:]) if len(chat_history) > 1 else 'None'}"}
     ]
 
-    intent_response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=intent_and_action_prompt,
+    return llm.chat_completion(
+        "intent",
+        intent_and_action_prompt,
         max_tokens=150,
         temperature=0,
+        token_usage=token_usage,
+    )
+
+
+class ISOFTAITEST(Document):
+    pass
+
+
+@frappe.whitelist()
+def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str = "", run_in_background: int = 0,
+           stream_id: str = "") -> dict:
+    if not user_question or not user_question.strip():
+        return {"ai_response": "<div class='alert alert-warning'>💬 Please ask me something! I'm here to help with your ERPNext queries.</div>", "chat_name": None}
+
+    if "AI User" not in frappe.get_roles(frappe.session.user):
+        return {"ai_response": "<div class='alert alert-danger'>🚫 Access denied. Please contact your administrator for AI access permissions.</div>", "chat_name": None}
+
+    if not llm.is_configured():
+        frappe.throw("OpenAI API key not configured in site_config.json")
+
+    user_question = user_question.strip()
+
+    try:
+        chat_history = json.loads(chat_history_json)
+    except Exception:
+        chat_history = []
+
+    # Resolve follow-ups against the history first, so the cache is keyed on what is
+    # actually being asked rather than on unrelated earlier turns
+    user_question = preprocess_question(user_question, chat_history)
+
+    # Check cache first for the same or a near-identical question
+    cache_key = get_cache_key(user_question)
+    cached_response = get_cached_response(cache_key, user_question)
+    if cached_response:
+        frappe.logger().info(f"Cache hit for question: {user_question[:50]}...")
+        return reply_in_chat(cached_response, user_question, chat_history, ai_chat_name)
+
+    if cint(run_in_background):
+        # Answer in a background job; progress and the final answer are pushed over realtime
+        job_id = frappe.generate_hash(length=12)
+        frappe.enqueue(
+            "isoft_ai.tasks.run_ask_ai_job",
+            queue=frappe.conf.get("isoft_ai_job_queue") or "default",
+            timeout=AI_JOB_TIMEOUT,
+            job_name=f"isoft_ai_{job_id}",
+            ai_job_id=job_id,
+            user_question=user_question,
+            chat_history=chat_history,
+            ai_chat_name=ai_chat_name,
+            cache_key=cache_key,
+            stream_id=stream_id,
+        )
+        return {"job_id": job_id, "chat_name": ai_chat_name or None}
+
+    frappe.flags.isoft_ai_stream_id = stream_id
+    return answer_coalesced(user_question, chat_history, ai_chat_name, cache_key)
+
+
+def answer_coalesced(user_question: str, chat_history: list, ai_chat_name: str, cache_key: str) -> dict:
+    """
+    Answer a question that missed the cache, sharing the work with concurrent requests for the
+    same cache key: one runs the pipeline, the others reuse its answer in their own chat
+    """
+    result_data, computed = single_flight(
+        cache_key,
+        lambda: answer_ai_question(user_question, chat_history, ai_chat_name, cache_key),
+        AI_JOB_TIMEOUT,
     )
+    if computed:
+        return result_data
+    return reply_in_chat(result_data, user_question, chat_history, ai_chat_name)
+
+
+def reply_in_chat(result_data: dict, user_question: str, chat_history: list, ai_chat_name: str) -> dict:
+    """Record an answer computed for another request (cache hit or coalesced miss) in the asker's own chat"""
+    ai_chat = get_or_create_ai_chat(ai_chat_name, get_first_user_message(chat_history, user_question))
+    token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    add_ai_message(ai_chat, user_question, result_data["ai_response"], token_usage)
+    return dict(result_data, chat_name=ai_chat.name)
+
+
+def publish_ai_progress(message: str):
+    """Push a progress update to the user when running as a background ask_ai job"""
+    job_id = frappe.flags.get("isoft_ai_job_id")
+    if job_id:
+        frappe.publish_realtime("isoft_ai_progress", {"job_id": job_id, "message": message}, user=frappe.session.user)
+
+
+def answer_ai_question(user_question: str, chat_history: list, ai_chat_name: str, cache_key: str) -> dict:
+    """Run the ask_ai pipeline for a (preprocessed) question that missed the cache"""
+    token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    frappe.flags.isoft_ai_skip_cache = False
+
+    # New chats start with a provisional title; the LLM title follows in a background job
+    ai_chat = get_or_create_ai_chat(ai_chat_name, get_first_user_message(chat_history, user_question))
+
+    # Questions answered from data before reuse their validated SQL: only the query runs again,
+    # intent detection and SQL generation are skipped
+    cached_query = get_cached_sql(user_question)
+    if cached_query:
+        record_cache_stat("miss", cached_query["intent"])
+        try:
+            result = answer_from_cached_sql(user_question, cached_query, token_usage)
+        except QueryRejectedError as e:
+            # Shown to the user but not cached, like any rejected query
+            result = query_rejected_html(e)
+            add_ai_message(ai_chat, user_question, result, token_usage)
+            return {"ai_response": result, "chat_name": ai_chat.name}
+        if result is not None:
+            add_ai_message(ai_chat, user_question, result, token_usage)
+            result_data = {"ai_response": result, "chat_name": ai_chat.name}
+            cache_expiry = determine_cache_expiry(user_question, cached_query["intent"], [], cached_query["sql"])
+            if cache_expiry > 0:
+                set_cached_response(cache_key, result_data, cache_expiry, user_question,
+                                    get_sql_doctypes(cached_query["sql"]), cached_query["intent"], 'DATA')
+            return result_data
 
-    token_usage["prompt_tokens"] += intent_response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += intent_response['usage']['completion_tokens']
-    token_usage["total_tokens"] += intent_response['usage']['total_tokens']
+    publish_ai_progress("Understanding your question...")
+    # Obvious questions are classified locally; the LLM only sees the ambiguous ones
+    local_intent = classify_intent(user_question, ERPNEXT_MODULES)
+    if local_intent:
+        intent_content = json.dumps(local_intent)
+    else:
+        intent_content = detect_intent(user_question, chat_history, token_usage)
 
     intent_analysis = {}
     try:
-        intent_analysis = json.loads(intent_response.choices[0].message["content"])
+        intent_analysis = json.loads(intent_content)
         intent = intent_analysis.get("intent", "KNOWLEDGE")
         confidence = intent_analysis.get("confidence", 0.5)
         suggested_doctypes = intent_analysis.get("suggested_doctypes", [])
@@ -507,6 +635,8 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
         requires_sql = False
         clarification_needed = False
 
+    if not cached_query:
+        record_cache_stat("miss", intent)
     frappe.logger().info(f"Detected intent: {intent} (confidence: {confidence}) for question: {user_question}")
     frappe.logger().info(f"Intent analysis: {intent_analysis}")
     frappe.logger().info(f"Requires SQL: {requires_sql}, Suggested doctypes: {suggested_doctypes}")
@@ -521,14 +651,19 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
     # Handle ERPNext module-specific queries
     elif intent in ERPNEXT_MODULES or intent == "GENERAL_REPORT":
         try:
-            result = handle_erpnext_module_query(intent, user_question, suggested_doctypes, confidence, token_usage)
+            query_meta = {}
+            result = handle_erpnext_module_query(intent, user_question, suggested_doctypes, confidence, token_usage,
+                                                 query_meta)
             add_ai_message(ai_chat, user_question, result, token_usage)
             result_data = {"ai_response": result, "chat_name": ai_chat.name}
             
-            # Smart caching based on data volatility
-            cache_expiry = determine_cache_expiry(user_question, intent, suggested_doctypes)
-            if cache_expiry > 0:  # Only cache if expiry > 0
-                set_cached_response(cache_key, result_data, cache_expiry)
+            # Smart caching: data answers are invalidated through the DocTypes they read
+            sql_query = query_meta.get("sql", "")
+            doctypes = get_sql_doctypes(sql_query) if sql_query else ERPNEXT_MODULES.get(intent, [])
+            cache_expiry = determine_cache_expiry(user_question, intent, suggested_doctypes, sql_query)
+            if cache_expiry > 0 and not query_meta.get("rejected"):  # Only cache if expiry > 0
+                set_cached_response(cache_key, result_data, cache_expiry, user_question, doctypes, intent,
+                                    get_cache_bucket(cache_expiry, sql_query))
             
             return result_data
         except Exception as e:
@@ -573,25 +708,22 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                 {"role": "user", "content": user_question}
             ]
             
-            entity_response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=entity_detection_prompt,
+            entity_content = llm.chat_completion(
+                "entity",
+                entity_detection_prompt,
                 max_tokens=200,
                 temperature=0.1,
+                token_usage=token_usage,
             )
             
             try:
-                entity_analysis = json.loads(entity_response.choices[0].message["content"].strip())
+                entity_analysis = json.loads(entity_content)
                 is_study = entity_analysis.get("is_study", False)
                 entities = entity_analysis.get("entities", [])
                 entity_types = entity_analysis.get("entity_types", [])
                 analysis_type = entity_analysis.get("analysis_type", "")
                 confidence = entity_analysis.get("confidence", 0.5)
                 
-                token_usage["prompt_tokens"] += entity_response['usage']['prompt_tokens']
-                token_usage["completion_tokens"] += entity_response['usage']['completion_tokens']
-                token_usage["total_tokens"] += entity_response['usage']['total_tokens']
-                
             except Exception as e:
                 frappe.logger().error(f"Entity detection failed: {str(e)}")
                 is_study = False
@@ -626,6 +758,7 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
             frappe.logger().info(f"STUDY: Extracted keywords: {keywords}")
             
             # Step 2: Get comprehensive study data
+            publish_ai_progress("Collecting study data...")
             summary_data = get_item_summary_for_study(keywords)
             
             # Step 3: Use OpenAI to generate a comprehensive analysis
@@ -639,13 +772,13 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                 )},
                 {"role": "user", "content": f"User request: {user_question}\n\nStudy data (JSON):\n{json.dumps(summary_data, indent=2)}"}
             ]
-            study_response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=study_prompt,
+            result = llm.chat_completion(
+                "study",
+                study_prompt,
                 max_tokens=1000,
                 temperature=0.3,
+                token_usage=token_usage,
             )
-            result = study_response.choices[0].message["content"].strip()
 
             # If result is longer than 2000 characters, convert to PDF and return a download link
             if len(result) > 2000:
@@ -730,22 +863,19 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
             ]
             
             try:
-                study_detection_response = openai.ChatCompletion.create(
-                    model="gpt-4",
-                    messages=dynamic_study_detection_prompt,
+                study_detection_content = llm.chat_completion(
+                    "intent",
+                    dynamic_study_detection_prompt,
                     max_tokens=100,
                     temperature=0.1,
+                    token_usage=token_usage,
                 )
                 
-                study_analysis = json.loads(study_detection_response.choices[0].message["content"].strip())
+                study_analysis = json.loads(study_detection_content)
                 is_study_request = study_analysis.get("is_study", False)
                 study_confidence = study_analysis.get("confidence", 0.5)
                 study_reason = study_analysis.get("reason", "")
                 
-                token_usage["prompt_tokens"] += study_detection_response['usage']['prompt_tokens']
-                token_usage["completion_tokens"] += study_detection_response['usage']['completion_tokens']
-                token_usage["total_tokens"] += study_detection_response['usage']['total_tokens']
-                
             except Exception as e:
                 frappe.logger().error(f"Dynamic study detection failed: {str(e)}")
                 is_study_request = False
@@ -776,23 +906,20 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                     {"role": "user", "content": user_question}
                 ]
                 
-                entity_response = openai.ChatCompletion.create(
-                    model="gpt-4",
-                    messages=entity_detection_prompt,
+                entity_content = llm.chat_completion(
+                    "entity",
+                    entity_detection_prompt,
                     max_tokens=200,
                     temperature=0.1,
+                    token_usage=token_usage,
                 )
                 
                 try:
-                    entity_analysis = json.loads(entity_response.choices[0].message["content"].strip())
+                    entity_analysis = json.loads(entity_content)
                     entities = entity_analysis.get("entities", [])
                     entity_types = entity_analysis.get("entity_types", [])
                     analysis_type = entity_analysis.get("analysis_type", "")
                     
-                    token_usage["prompt_tokens"] += entity_response['usage']['prompt_tokens']
-                    token_usage["completion_tokens"] += entity_response['usage']['completion_tokens']
-                    token_usage["total_tokens"] += entity_response['usage']['total_tokens']
-                    
                 except Exception as e:
                     frappe.logger().error(f"Entity detection failed in fallback: {str(e)}")
                     entities = []
@@ -811,6 +938,7 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                     frappe.logger().info(f"STUDY: Extracted keywords: {keywords}")
                     
                     # Step 2: Get comprehensive study data
+                    publish_ai_progress("Collecting study data...")
                     summary_data = get_item_summary_for_study(keywords)
                     
                     # Step 3: Use OpenAI to generate a comprehensive analysis
@@ -824,13 +952,13 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                         )},
                         {"role": "user", "content": f"User request: {user_question}\n\nStudy data (JSON):\n{json.dumps(summary_data, indent=2)}"}
                     ]
-                    study_response = openai.ChatCompletion.create(
-                        model="gpt-4",
-                        messages=study_prompt,
+                    result = llm.chat_completion(
+                        "study",
+                        study_prompt,
                         max_tokens=1000,
                         temperature=0.3,
+                        token_usage=token_usage,
                     )
-                    result = study_response.choices[0].message["content"].strip()
 
                     # If result is longer than 2000 characters, convert to PDF and return a download link
                     if len(result) > 2000:
@@ -896,6 +1024,8 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
             data_keywords = ['top', 'list', 'show', 'get', 'find', 'count', 'total', 'report', 'data', 'items', 'customers', 'sales', 'purchase', 'this year', 'this month']
             
             # More aggressive fallback for data queries
+            result_from_sql = False
+            query_rejected = False
             if any(keyword in question_lower for keyword in data_keywords):
                 frappe.logger().info(f"Attempting SQL generation as fallback for: {user_question}")
                 # Try multiple approaches
@@ -935,14 +1065,18 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
                 
                 if sql_query:
                     frappe.logger().info(f"Generated SQL: {sql_query}")
-                    db_result = frappe.db.sql(sql_query, as_dict=True)
-                    if db_result:
-                        if len(db_result) > 10 or len(db_result[0].keys()) > 5:
-                            result = generate_excel_file(db_result)
-                        else:
-                            result = polish_erp_answer_html(user_question, format_result(db_result), token_usage)
+                    publish_ai_progress("Running query...")
+                    try:
+                        result = render_query_answer(
+                            user_question, sql_query, token_usage,
+                            f"<div class='alert alert-info'>🔍 No data found for your query. Try adjusting your criteria.</div>"
+                        )
+                    except QueryRejectedError as e:
+                        result = query_rejected_html(e)
+                        query_rejected = True
                     else:
-                        result = f"<div class='alert alert-info'>🔍 No data found for your query. Try adjusting your criteria.</div>"
+                        set_cached_sql(user_question, "GENERAL_REPORT", sql_query)
+                        result_from_sql = True
                 else:
                     result = ask_enhanced_knowledge_question(chat_history, user_question, intent, confidence, token_usage)
             else:
@@ -951,10 +1085,13 @@ def ask_ai(user_question: str, chat_history_json: str = "[]", ai_chat_name: str
             add_ai_message(ai_chat, user_question, result, token_usage)
             result_data = {"ai_response": result, "chat_name": ai_chat.name}
             
-            # Cache knowledge questions longer (static content)
-            cache_expiry = determine_cache_expiry(user_question, intent, suggested_doctypes)
-            if cache_expiry > 0:
-                set_cached_response(cache_key, result_data, cache_expiry)
+            # Cache knowledge questions longer (static content); data answers until their DocTypes change
+            executed_sql = sql_query if result_from_sql else ""
+            cache_expiry = determine_cache_expiry(user_question, intent, suggested_doctypes, executed_sql)
+            if cache_expiry > 0 and not query_rejected:
+                set_cached_response(cache_key, result_data, cache_expiry, user_question,
+                                    get_sql_doctypes(executed_sql) if executed_sql else None, intent,
+                                    get_cache_bucket(cache_expiry, executed_sql))
             
             return result_data
         except Exception as e:
@@ -1002,6 +1139,8 @@ def preprocess_question(current_question: str, chat_history: list) -> str:
 def generate_sql_from_question(question: str, token_usage=None) -> Optional[str]:
     if token_usage is None:
         token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    analysis = classify_intent(question, ERPNEXT_MODULES)
+    schema_context = get_prompt_context((analysis or {}).get("suggested_doctypes") or DEFAULT_SQL_DOCTYPES, question)
     messages = [
     {
         "role": "system",
@@ -1014,43 +1153,15 @@ def generate_sql_from_question(question: str, token_usage=None) -> Optional[str]
 
             " ERP STRUCTURE AND CONVENTIONS:\n"
             "- Tables follow the ERPNext format: all table names are prefixed with `tab`.\n"
-            "- For transactional documents like Sales Invoice, Purchase Invoice, Delivery Note: filter with `docstatus = 1` (submitted).\n"
-            "- For Stock Ledger Entry, GL Entry, and other tables with `is_cancelled` field, filter with `is_cancelled = 0`.\n"
-            "- Some tables like `tabBin` do not have `docstatus` or `is_cancelled`.\n"
+            "- Every table also has `name`, `creation`, `modified`, `owner` and `docstatus`.\n"
             "- Parent and child documents are linked using `parent`, `parenttype`, and `parentfield`.\n"
             "- Use `JOIN` for parent-child queries (e.g., Invoice + Invoice Items).\n"
-            "- Use subqueries when you need filtering on aggregates, last values, or conditional logic.\n\n"
-
-            " STOCK MANAGEMENT:\n"
-            "- `tabBin`: current stock — `item_code`, `warehouse`, `actual_qty`, `valuation_rate`, `reserved_qty`, etc.\n"
-            "- `tabStock Ledger Entry`: detailed movements — `posting_date`, `item_code`, `actual_qty`, `stock_value_difference`, `voucher_type`, `voucher_no`, etc.\n"
-            "- For valuation, use: `actual_qty * valuation_rate`.\n\n"
-            "- `tabItem Price`: item price — `item_code`, `uom`, `selling`, `buying`, `price_list`, `price_list_rate`, `creation`, etc. it's not has posting_date"
-
-            " SALES MODULE:\n"
-            "- `tabSales Invoice`: `customer`, `grand_total`, `posting_date`, `is_return`, `return_against`.\n"
-            "- `tabSales Invoice Item`: `item_code`, `qty`, `rate`, `amount`, `parent`.\n"
-            "- `is_return = 1` means this is a return or credit note (negative invoice).\n\n"
-
-            " PURCHASE MODULE:\n"
-            "- `tabPurchase Invoice` and `tabPurchase Receipt`: `supplier`, `posting_date`, `grand_total`, `is_return`, `return_against`.\n"
-            "- `is_return = 1` indicates a returned or reversed purchase.\n"
-            "- Use `return_against` to trace the original document.\n\n"
-
-            " DELIVERY MODULE:\n"
-            "- `tabDelivery Note`: `customer`, `posting_date`, `is_return`, `return_against`.\n"
-            "- If `is_return = 1`, this is a returned delivery.\n\n"
-
-            " ACCOUNTING:\n"
-            "- `tabGL Entry`: `posting_date`, `account`, `debit`, `credit`, `voucher_type`, `party`.\n"
-            "- Use to trace financial transactions from all modules.\n\n"
+            "- Use subqueries when you need filtering on aggregates, last values, or conditional logic.\n"
+            "- `is_return = 1` marks returns and credit notes; `return_against` names the original document.\n"
+            "- For stock valuation, use: `actual_qty * valuation_rate`.\n\n"
 
-            " HR & PAYROLL:\n"
-            "- `tabEmployee`, `tabSalary Slip`: `net_pay`, `employee`, `posting_date`, `salary_structure`.\n\n"
-
-            " MANUFACTURING:\n"
-            "- `tabWork Order`: `production_item`, `qty`, `status`, `actual_start_date`, `actual_end_date`.\n"
-            "- `tabBOM`, `tabBOM Item`: `item_code`, `qty`, `rate`.\n\n"
+            " SCHEMA (use only these columns):\n"
+            f"{schema_context}\n\n"
 
             " QUERY LOGIC GUIDELINES:\n"
             "- Use `JOIN` when pulling from both parent and child tables.\n"
@@ -1079,18 +1190,13 @@ def generate_sql_from_question(question: str, token_usage=None) -> Optional[str]
 ]
 
 
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
+    sql = llm.chat_completion(
+        "sql",
+        messages,
         max_tokens=300,
         temperature=0,
-    )
-
-    token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += response['usage']['completion_tokens']
-    token_usage["total_tokens"] += response['usage']['total_tokens']
-    
-    sql = (response.choices[0].message['content'].strip()).rstrip(";")
+        token_usage=token_usage,
+    ).rstrip(";")
     if not sql.lower().startswith("select") or re.search(r";|insert|update|delete|drop|alter|truncate", sql, re.I):
         return None
 
@@ -1104,67 +1210,105 @@ def generate_sql_from_question(question: str, token_usage=None) -> Optional[str]
 
 def validate_sql_fields(sql: str) -> Optional[str]:
     """
-    Parses the SQL SELECT query, extracts table and field names, and checks them against DocType metadata.
-    Returns None if valid, or an error message string if invalid.
+    Checks the tables and columns of a generated SELECT against DocType metadata in one pass over
+    the token stream. Qualified columns are checked against the table their alias names, bare
+    columns against every table in the query. Returns None if valid, or all errors in one message.
     """
     if sqlparse is None:
         return "SQL validation requires the 'sqlparse' library. Please install it."
     try:
-        parsed = sqlparse.parse(sql)
-        if not parsed:
-            return "Could not parse SQL."
-        stmt = parsed[0]
-        # Find all table names (FROM, JOIN)
-        tables = set()
-        fields = set()
-        from_seen = False
-        for token in stmt.tokens:
-            if token.ttype is None and token.is_group:
-                for sub in token.tokens:
-                    if sub.ttype is None and sub.is_group:
-                        for subsub in sub.tokens:
-                            if subsub.ttype is None and subsub.is_group:
-                                continue
-                            if subsub.value.upper() == 'FROM' or subsub.value.upper() == 'JOIN':
-                                from_seen = True
-                            elif from_seen and subsub.ttype is None:
-                                table_name = subsub.value.strip('`')
-                                if table_name.startswith('tab'):
-                                    tables.add(table_name)
-                                from_seen = False
-            # Find fields in SELECT
-            if token.ttype is None and token.is_group:
-                for sub in token.tokens:
-                    if sub.ttype is None and sub.is_group:
-                        for subsub in sub.tokens:
-                            if subsub.ttype is None and subsub.is_group:
-                                continue
-                            if subsub.value.upper() == 'SELECT':
-                                continue
-                            if subsub.value.upper() == 'FROM':
-                                break
-                            if subsub.ttype is None:
-                                field_expr = subsub.value.strip()
-                                if '.' in field_expr:
-                                    fields.add(field_expr.split('.')[-1].strip('`, '))
-                                else:
-                                    fields.add(field_expr.strip('`, '))
-        # Validate tables and fields
-        for table in tables:
-            doctype = table[3:] if table.startswith('tab') else table
-            try:
-                meta = frappe.get_meta(doctype)
-            except Exception:
-                return f"Table {table} (DocType {doctype}) does not exist."
-            valid_fields = {f.fieldname for f in meta.fields}
-            valid_fields.add('name')
-            for field in fields:
-                if field not in valid_fields:
-                    return f"Field '{field}' does not exist in {doctype}."
-        return None
+        tables, column_refs, aliases = _scan_sql_references(sql)
     except Exception as e:
         return f"SQL validation error: {str(e)}"
 
+    errors = []
+    columns_by_alias = {}
+    derived_tables = False
+    for alias, table in tables.items():
+        if not table.lower().startswith('tab'):
+            derived_tables = True
+            continue
+        columns = get_doctype_columns(table[3:])
+        if columns is None:
+            errors.append(f"Table `{table}` (DocType {table[3:]}) does not exist.")
+            derived_tables = True
+        columns_by_alias[alias] = columns
+
+    for qualifier, column in column_refs:
+        column_key = column.lower()
+        if qualifier is None:
+            if column_key in aliases or derived_tables or not columns_by_alias:
+                continue
+            if not any(column_key in columns for columns in columns_by_alias.values() if columns):
+                doctypes = ', '.join(sorted({table[3:] for table in tables.values()}))
+                errors.append(f"Field '{column}' does not exist in {doctypes}.")
+        elif qualifier in columns_by_alias:
+            columns = columns_by_alias[qualifier]
+            if columns is not None and column_key not in columns:
+                errors.append(f"Field '{column}' does not exist in {tables[qualifier][3:]} ({qualifier}).")
+        elif qualifier not in tables and qualifier.lower() not in aliases:
+            errors.append(f"Unknown table or alias '{qualifier}' in {qualifier}.{column}.")
+
+    return " ".join(dict.fromkeys(errors)) or None
+
+
+DERIVED_TABLE = "(subquery)"
+
+
+def _scan_sql_references(sql: str):
+    """
+    Single pass over the lexer tokens. Returns ({alias or table: table}, [(qualifier, column)],
+    {lower-cased column aliases}). Subqueries in FROM map to DERIVED_TABLE.
+    """
+    stream = [(ttype, value) for ttype, value in sqlparse.lexer.tokenize(sql)
+              if ttype not in sqlparse.tokens.Whitespace and ttype not in sqlparse.tokens.Comment]
+    tables, column_refs, aliases = {}, [], set()
+    in_from, from_stack, last_table = False, [], None
+    previous = (None, "")
+
+    for i, (ttype, value) in enumerate(stream):
+        upper = value.upper()
+        next_value = stream[i + 1][1] if i + 1 < len(stream) else ""
+
+        if ttype in sqlparse.tokens.Keyword:
+            if upper == 'FROM' or upper.endswith('JOIN'):
+                in_from = True
+            elif upper in SQL_FROM_END_KEYWORDS or ttype in sqlparse.tokens.DML:
+                in_from = False
+            if upper != 'AS':
+                last_table = None
+        elif value == '(':
+            from_stack.append(in_from)
+            in_from = False
+        elif value == ')':
+            in_from = from_stack.pop() if from_stack else False
+        elif ttype is sqlparse.tokens.Name and next_value != '(':
+            name = value.strip('`')
+            prev_type, prev_value = previous
+            if prev_value == '.':
+                pass
+            elif next_value == '.':
+                qualified = stream[i + 2] if i + 2 < len(stream) else (None, "")
+                if qualified[0] is not sqlparse.tokens.Wildcard and qualified[1]:
+                    column_refs.append((name, qualified[1].strip('`')))
+            elif in_from and (prev_type in sqlparse.tokens.Keyword and prev_value.upper() != 'AS' or prev_value == ','):
+                tables[name] = name
+                last_table = name
+            elif last_table or prev_value == ')' or prev_value.upper() in ('AS', 'END') or \
+                    prev_type in sqlparse.tokens.Name or prev_type in sqlparse.tokens.Literal:
+                if last_table and in_from:
+                    tables[name] = tables[last_table]
+                elif in_from and prev_value == ')':
+                    tables[name] = DERIVED_TABLE
+                else:
+                    aliases.add(name.lower())
+                last_table = None
+            else:
+                column_refs.append((None, name))
+        previous = (ttype, value)
+
+    return tables, column_refs, aliases
+
 
 def format_result(results: list) -> str:
     max_rows = 10
@@ -1181,174 +1325,101 @@ def format_result(results: list) -> str:
     return "\n".join(formatted_rows)
 
 
-def generate_excel_file(results: list) -> str:
-    if not results:
-        frappe.throw("No results to export.")
-
+def render_erp_answer_html(question: str, results: list, token_usage=None) -> str:
+    """
+    Render a small result set as an HTML table, optionally preceded by a one-line
+    LLM summary (site_config `isoft_ai_answer_summary`)
+    """
+    table = render_result_table(results)
+    if not cint(frappe.conf.get("isoft_ai_answer_summary")):
+        return table
     try:
-        import openpyxl
-        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-        from openpyxl.utils import get_column_letter
-    except ImportError:
-        # Fallback to CSV if openpyxl is not available
-        return generate_csv_file(results)
-
-    # Create a new workbook and select the active sheet
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    if ws is not None:
-        ws.title = "ERP Query Results"
-
-        # Get column headers from the first result
-        headers = list(results[0].keys())
-        
-        # Write headers with formatting
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num, value=header)
-            if cell is not None:
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.alignment = header_alignment
-
-        # Write data rows
-        for row_num, row_data in enumerate(results, 2):
-            for col_num, header in enumerate(headers, 1):
-                value = row_data.get(header, "")
-                
-                # Handle different data types
-                if value is None:
-                    value = ""
-                elif isinstance(value, (int, float)):
-                    # Keep numbers as numbers
-                    pass
-                elif isinstance(value, str) and value.isdigit() and value.startswith("0"):
-                    # Preserve leading zeros
-                    value = f'="{value}"'
-                
-                cell = ws.cell(row=row_num, column=col_num, value=value)
-                if cell is not None:
-                    # Add borders and alignment
-                    thin_border = Border(
-                        left=Side(style='thin'),
-                        right=Side(style='thin'),
-                        top=Side(style='thin'),
-                        bottom=Side(style='thin')
-                    )
-                    cell.border = thin_border
-                    cell.alignment = Alignment(horizontal="left", vertical="center")
-
-        # Auto-adjust column widths
-        for column in ws.columns:
-            max_length = 0
-            if column and column[0] and column[0].column is not None:
-                column_letter = get_column_letter(column[0].column)
-                
-                for cell in column:
-                    try:
-                        if cell and cell.value and len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                
-                # Set column width (min 10, max 50)
-                adjusted_width = min(max(max_length + 2, 10), 50)
-                ws.column_dimensions[column_letter].width = adjusted_width
-
-        # Save to temporary file
-        import tempfile
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx')
-        wb.save(temp_file.name)
-        temp_file.close()
-
-        # Read the file and create Frappe File document
-        with open(temp_file.name, 'rb') as f:
-            file_content = f.read()
-
-        # Clean up temporary file
-        import os
-        os.unlink(temp_file.name)
-
-        # Create file document
-        file_doc = frappe.get_doc({
-            "doctype": "File",
-            "file_name": "erp_query_result.xlsx",
-            "content": file_content,
-            "is_private": 0
-        }).insert(ignore_permissions=True)
-
-        return file_doc.file_url
-    else:
-        # Fallback to CSV if worksheet creation failed
-        return generate_csv_file(results)
-
-def generate_csv_file(results: list) -> str:
-    """Fallback function for CSV generation when Excel is not available"""
-    if not results:
-        frappe.throw("No results to export.")
-
-    normalized_results = []
-    for row in results:
-        plain_row = {}
-        for k, v in row.items():
-            if v is None:
-                plain_row[k] = ""
-            elif isinstance(v, str) and v.isdigit() and v.startswith("0"):
-                # Preserve leading zeros in Excel
-                plain_row[k] = f'="{v}"'
-            else:
-                plain_row[k] = str(v)
-        normalized_results.append(plain_row)
+        summary = summarize_erp_answer(question, results, token_usage)
+    except Exception as e:
+        frappe.logger().error(f"Answer summary failed: {str(e)}")
+        return table
+    return f"<p>{escape_html(summary)}</p>{table}"
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=normalized_results[0].keys())
-    writer.writeheader()
-    writer.writerows(normalized_results)
-    csv_content = output.getvalue()
-    output.close()
 
-    file_doc = frappe.get_doc({
-        "doctype": "File",
-        "file_name": "erp_query_result.csv",
-        "content": csv_content,
-        "is_private": 0
-    }).insert(ignore_permissions=True)
+def column_matches(column: str, hints: tuple) -> bool:
+    """Whether a hint appears as whole words in the column name: 'rate' matches exchange_rate, not generated"""
+    words = f"_{'_'.join(re.findall(r'[a-z0-9]+', column.lower()))}_"
+    return any(f"_{hint}_" in words for hint in hints)
 
-    return file_doc.file_url
 
+def render_result_table(results: list) -> str:
+    """Type-aware HTML table: formatted numbers, currency and dates, right-aligned numeric columns, totals row"""
+    columns = list(results[0].keys())
+    currency = frappe.db.get_default("currency") or ""
+    numeric = {
+        col: all(v is None or (isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)) for v in (r.get(col) for r in results))
+        and any(r.get(col) is not None for r in results)
+        for col in columns
+    }
+    is_currency = {col: numeric[col] and column_matches(col, CURRENCY_COLUMN_HINTS) for col in columns}
+
+    def format_cell(col, value):
+        if value is None:
+            return ""
+        if numeric[col]:
+            if is_currency[col]:
+                return f"{currency} {float(value):,.2f}".strip()
+            if float(value).is_integer():
+                return f"{int(value):,}"
+            return f"{float(value):,.2f}"
+        if isinstance(value, datetime):
+            return escape_html(format_datetime(value))
+        if isinstance(value, date):
+            return escape_html(formatdate(value))
+        return escape_html(str(value))
+
+    def cell(tag, col, content):
+        align = " style='text-align:right'" if numeric[col] else ""
+        return f"<{tag}{align}>{content}</{tag}>"
+
+    header = "".join(cell("th", col, escape_html(col.replace("_", " ").title())) for col in columns)
+    body = "".join(
+        "<tr>" + "".join(cell("td", col, format_cell(col, row.get(col))) for col in columns) + "</tr>"
+        for row in results
+    )
 
+    footer = ""
+    additive = [col for col in columns if numeric[col] and not column_matches(col, NON_ADDITIVE_COLUMN_HINTS)]
+    if len(results) > 1 and additive:
+        totals = {col: sum(row.get(col) or 0 for row in results) for col in additive}
+        cells = [
+            cell("td", col, f"<b>{format_cell(col, totals[col])}</b>") if col in totals else "<td></td>"
+            for col in columns
+        ]
+        if columns[0] not in totals:
+            cells[0] = "<td><b>Total</b></td>"
+        footer = f"<tfoot><tr>{''.join(cells)}</tr></tfoot>"
+
+    return (
+        "<table class='table table-bordered table-condensed ai-result-table'>"
+        f"<thead><tr>{header}</tr></thead><tbody>{body}</tbody>{footer}</table>"
+    )
 
-def polish_erp_answer_html(question: str, db_result: str, token_usage=None) -> str:
-    if token_usage is None:
-        token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-    max_len = 600  # Lowered from 1000 for efficiency
-    truncated_result = db_result[:max_len] + "\n... (truncated)" if len(db_result) > max_len else db_result
-    # --- SHORTER SYSTEM PROMPT FOR ERP FORMATTING ---
+
+def summarize_erp_answer(question: str, results: list, token_usage=None) -> str:
+    """One-sentence narrative summary of a small result set"""
     messages = [
         {
             "role": "system",
-            "content": (
-                "Format ERP query results as readable text table."
-            )
+            "content": "Summarize the ERP query result in one short sentence answering the question. No tables, no lists."
         },
         {
             "role": "user",
-            "content": f"Q: {question}\nResult:\n{truncated_result}"
+            "content": f"Q: {question}\nResult:\n{format_result(results)}"
         }
     ]
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
-        max_tokens=700,  # Lowered from 1000 for efficiency
+    return llm.chat_completion(
+        "polish",
+        messages,
+        max_tokens=60,
         temperature=0.3,
+        token_usage=token_usage,
     )
-    token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += response['usage']['completion_tokens']
-    token_usage["total_tokens"] += response['usage']['total_tokens']
-    return response.choices[0].message['content'].strip()
 
 
 def ask_knowledge_question_html(chat_history, current_question: str, token_usage=None) -> str:
@@ -1368,16 +1439,13 @@ def ask_knowledge_question_html(chat_history, current_question: str, token_usage
             )
         })
     trimmed_history.append({"role": "user", "content": current_question})
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=trimmed_history,
+    return complete_with_stream(
+        "knowledge",
+        trimmed_history,
         max_tokens=700,  # Lowered from 1000 for efficiency
         temperature=0.3,
+        token_usage=token_usage,
     )
-    token_usage["prompt_tokens"] += response['usage']['prompt_tokens']
-    token_usage["completion_tokens"] += response['usage']['completion_tokens']
-    token_usage["total_tokens"] += response['usage']['total_tokens']
-    return response.choices[0].message['content'].strip()
 
 def clean_intent(raw_intent: str) -> str:
     cleaned = raw_intent.strip().strip("'\"").upper()
@@ -1389,29 +1457,55 @@ def clean_intent(raw_intent: str) -> str:
 
 def generate_ai_chat_title(first_message: str) -> str:
     """Generate a concise AI chat title based on the first user message using OpenAI."""
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
+    return llm.chat_completion(
+        "title",
+        [
             {"role": "system", "content": "Generate a short, clear chat title for this user message. Do not use quotes."},
             {"role": "user", "content": first_message}
         ],
         max_tokens=12,
         temperature=0.2,
     )
-    return response.choices[0].message["content"].strip()
 
-def get_or_create_ai_chat(ai_chat_name: str = "", first_message: str = "") -> Document:
-    """
-    If ai_chat_name is provided and exists, return that chat.
-    Otherwise, create a new AI Chat with a generated title based on the first message.
-    """
+def get_first_user_message(chat_history: list, fallback: str) -> str:
+    """First non-empty user message of the chat, used for its title"""
+    for msg in chat_history:
+        if msg.get("role") == "user" and msg.get("content") and msg["content"].strip():
+            return msg["content"].strip()
+    return fallback
+
+
+def provisional_chat_title(first_message: str, max_length: int = 60) -> str:
+    """Local title for a new chat: the message's first sentence, cut at a word boundary"""
+    text = " ".join((first_message or "").split())
+    text = re.split(r"(?<=[.?!])\s", text, maxsplit=1)[0].rstrip(".?!")
+    if len(text) > max_length:
+        text = text[:max_length].rsplit(" ", 1)[0] + "…"
+    return (text[:1].upper() + text[1:]) or "AI Chat"
+
+
+def schedule_chat_title(ai_chat_name: str, first_message: str):
+    """Generate the LLM title in a background job; it is pushed to the sidebar as `isoft_ai_chat_title`"""
+    frappe.enqueue(
+        "isoft_ai.tasks.update_chat_title",
+        queue="short",
+        enqueue_after_commit=True,
+        ai_chat_name=ai_chat_name,
+        first_message=first_message,
+    )
+
+
+def get_existing_ai_chat(ai_chat_name: str = "") -> Optional[Document]:
+    """Return the AI Chat if ai_chat_name is provided and exists, else None."""
     if ai_chat_name:
         try:
             return frappe.get_doc("AI Chat", ai_chat_name)
         except Exception:
-            pass  # If not found, fall through to create new
-    # Generate title if not provided
-    title = generate_ai_chat_title(first_message) if first_message else "AI Chat"
+            pass  # If not found, caller creates a new one
+    return None
+
+
+def create_ai_chat(title: str) -> Document:
     doc = frappe.new_doc("AI Chat")
     doc.title = title
     doc.owner = frappe.session.user
@@ -1419,6 +1513,21 @@ def get_or_create_ai_chat(ai_chat_name: str = "", first_message: str = "") -> Do
     return doc
 
 
+def get_or_create_ai_chat(ai_chat_name: str = "", first_message: str = "") -> Document:
+    """
+    If ai_chat_name is provided and exists, return that chat.
+    Otherwise, create a new AI Chat with a provisional title based on the first message
+    and schedule the generated title.
+    """
+    ai_chat = get_existing_ai_chat(ai_chat_name)
+    if ai_chat:
+        return ai_chat
+    ai_chat = create_ai_chat(provisional_chat_title(first_message))
+    if first_message:
+        schedule_chat_title(ai_chat.name, first_message)
+    return ai_chat
+
+
 def add_ai_message(ai_chat, user_question, ai_response, token_usage):
     ai_chat.append("messages", {
         "user_question": user_question,
@@ -1521,15 +1630,15 @@ def get_item_summary_for_study(keywords: List[str]) -> Dict:
     ORDER BY month_year DESC
     """
 
-    items = frappe.db.sql(query, as_dict=True)
+    items = read_sql(query)
     item_codes = list({item.get('item_code', item.get('name')) for item in items})
     stock_by_item = {}
     if item_codes:
-        stock_rows = frappe.db.sql(f"""
+        stock_rows = read_sql(f"""
             SELECT item_code, warehouse, actual_qty
             FROM tabBin
             WHERE item_code IN ({', '.join(['%s']*len(item_codes))})
-        """, item_codes, as_dict=True)
+        """, item_codes)
         for row in stock_rows:
             stock_by_item.setdefault(row['item_code'], []).append({
                 'warehouse': row['warehouse'],
@@ -1544,12 +1653,6 @@ def get_child_tables_for_parent(parent_doctype: str):
     """
     Returns a list of (child_table, link_field) for all child tables of the given parent DocType.
     """
-    meta = frappe.get_meta(parent_doctype)
-    child_tables = []
-    for field in meta.fields:
-        if field.fieldtype == 'Table' and field.options:
-            # The link field in the child table is always 'parent' (ERPNext convention)
-            child_tables.append((field.options, 'parent'))
-    return child_tables
-
-
+    schema = get_doctype_schema(parent_doctype) or {"children": []}
+    # The link field in the child table is always 'parent' (ERPNext convention)
+    return [(child, 'parent') for child, _ in schema["children"]]
@@ -1,8 +1,92 @@
 # Copyright (c) 2025, Abbass Chokor and Contributors
 # See license.txt
 
-# import frappe
 import unittest
+from unittest.mock import patch
 
-class TestISOFTAITEST(unittest.TestCase):
-	pass
+import frappe
+
+from isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test import (
+	column_matches, handle_erpnext_module_query, render_result_table, validate_sql_fields, CURRENCY_COLUMN_HINTS
+)
+
+
+COLUMNS = {
+	"User": frozenset({"name", "first_name", "enabled", "email"}),
+	"Has Role": frozenset({"name", "parent", "role"}),
+}
+
+
+class TestValidateSqlFields(unittest.TestCase):
+	def setUp(self):
+		columns = patch("isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test.get_doctype_columns", COLUMNS.get)
+		columns.start()
+		self.addCleanup(columns.stop)
+
+	def test_valid_join_with_aliases(self):
+		self.assertIsNone(validate_sql_fields(
+			"SELECT u.name, u.first_name, hr.role FROM `tabUser` u "
+			"JOIN `tabHas Role` hr ON hr.parent = u.name WHERE u.enabled = 1"
+		))
+
+	def test_column_aliases_may_be_reused(self):
+		self.assertIsNone(validate_sql_fields(
+			"SELECT first_name, COUNT(name) AS user_count FROM `tabUser` GROUP BY first_name ORDER BY user_count DESC"
+		))
+
+	def test_unknown_qualified_column(self):
+		error = validate_sql_fields("SELECT u.no_such_field FROM `tabUser` u")
+		self.assertIn("no_such_field", error)
+		self.assertIn("User", error)
+
+	def test_unknown_bare_column(self):
+		self.assertIn("no_such_field", validate_sql_fields("SELECT no_such_field FROM `tabUser`"))
+
+	def test_unknown_table(self):
+		self.assertIn("does not exist", validate_sql_fields("SELECT name FROM `tabNo Such DocType`"))
+
+	def test_unknown_alias(self):
+		self.assertIn("Unknown table or alias 'x'", validate_sql_fields("SELECT x.name FROM `tabUser` u"))
+
+
+class TestRenderResultTable(unittest.TestCase):
+	def render(self, results):
+		with patch.object(frappe.db, "get_default", return_value="USD"):
+			return render_result_table(results)
+
+	def test_currency_quantities_and_totals(self):
+		html = self.render([
+			{"item_code": "A", "total_qty": 1234, "grand_total": 10.5},
+			{"item_code": "B", "total_qty": 1, "grand_total": 2},
+		])
+		self.assertIn("<td style='text-align:right'>1,234</td>", html)
+		self.assertIn("USD 10.50", html)
+		self.assertNotIn("USD 1,234", html)
+		self.assertIn("<b>1,235</b>", html)
+		self.assertIn("<b>USD 12.50</b>", html)
+		self.assertIn("<td><b>Total</b></td>", html)
+
+	def test_text_is_escaped_and_rates_are_not_summed(self):
+		html = self.render([
+			{"customer": "<b>ACME</b>", "exchange_rate": 1.5},
+			{"customer": "Beta", "exchange_rate": 2},
+		])
+		self.assertIn("&lt;b&gt;ACME&lt;/b&gt;", html)
+		self.assertNotIn("<tfoot>", html)
+
+	def test_hints_match_whole_words(self):
+		self.assertTrue(column_matches("base_grand_total", CURRENCY_COLUMN_HINTS))
+		self.assertTrue(column_matches("Paid Amount", CURRENCY_COLUMN_HINTS))
+		for column in ("total_qty", "generated", "separate", "sales_count"):
+			self.assertFalse(column_matches(column, CURRENCY_COLUMN_HINTS), column)
+
+
+class TestModuleQueryContext(unittest.TestCase):
+	def test_other_modules_doctypes_reach_the_prompt(self):
+		module = "isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test"
+		with patch(f"{module}.get_prompt_context", return_value="") as get_prompt_context, \
+				patch("isoft_ai.llm.chat_completion", return_value="no query") as chat_completion:
+			handle_erpnext_module_query("STOCK", "top items sold last month", ["Sales Invoice", "Item"], 0.9, {})
+
+		self.assertEqual(get_prompt_context.call_args[0][0][:2], ["Item", "Sales Invoice"])
+		self.assertIn("['Item', 'Sales Invoice']", chat_completion.call_args[0][1][0]["content"])
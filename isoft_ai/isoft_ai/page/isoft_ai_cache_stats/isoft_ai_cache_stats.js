@@ -0,0 +1,68 @@
+frappe.pages['isoft-ai-cache-stats'].on_page_load = function (wrapper) {
+	const page = frappe.ui.make_app_page({
+		parent: wrapper,
+		title: 'ISOFT AI Cache Stats',
+		single_column: true
+	});
+
+	const $body = $(`<div class="ai-cache-stats" style="padding: 15px;"></div>`).appendTo(page.main);
+	const events = ['hit', 'near_hit', 'coalesced', 'miss', 'stale', 'store', 'bytes', 'eviction', 'invalidation', 'expired',
+		'result_hit', 'result_miss', 'error'];
+
+	const breakdown_table = (title, rows) => {
+		const labels = Object.keys(rows).sort();
+		if (!labels.length) return '';
+		return `
+			<h5 style="margin-top: 25px;">${title}</h5>
+			<table class="table table-bordered table-condensed">
+				<thead><tr><th></th>${events.map(e => `<th class="text-right">${e}</th>`).join('')}</tr></thead>
+				<tbody>
+					${labels.map(label => `
+						<tr>
+							<td>${frappe.utils.escape_html(label)}</td>
+							${events.map(e => `<td class="text-right">${format_value(e, rows[label][e])}</td>`).join('')}
+						</tr>`).join('')}
+				</tbody>
+			</table>`;
+	};
+
+	const format_value = (event, value) => {
+		if (value === undefined) return '';
+		return event === 'bytes' ? frappe.form.formatters.FileSize(value) : format_number(value, null, 0);
+	};
+
+	const render = (stats) => {
+		const totals = stats.totals || {};
+		const hit_rate = stats.hit_rate === null ? '-' : `${(stats.hit_rate * 100).toFixed(1)}%`;
+		$body.html(`
+			<div class="row">
+				${[
+					[__('Hit rate'), hit_rate],
+					[__('Entries'), `${format_number(stats.entries, null, 0)} / ${format_number(stats.max_entries, null, 0)}`],
+					[__('Stored'), `${frappe.form.formatters.FileSize(stats.bytes_stored)} / ${frappe.form.formatters.FileSize(stats.max_bytes)}`],
+					[__('Since'), stats.since ? frappe.datetime.str_to_user(stats.since) : '-']
+				].map(([label, value]) => `
+					<div class="col-sm-3">
+						<div class="text-muted small">${label}</div>
+						<div style="font-size: 1.4em; font-weight: 600;">${value}</div>
+					</div>`).join('')}
+			</div>
+			${breakdown_table(__('Totals'), {[__('All')]: totals})}
+			${breakdown_table(__('By intent'), stats.by_intent || {})}
+			${breakdown_table(__('By expiry bucket'), stats.by_bucket || {})}
+		`);
+	};
+
+	const refresh = () => {
+		frappe.call('isoft_ai.cache.get_cache_stats').then(r => render(r.message || {}));
+	};
+
+	page.set_primary_action(__('Refresh'), refresh, 'refresh');
+	page.set_secondary_action(__('Reset'), () => {
+		frappe.confirm(__('Reset all cache counters?'), () => {
+			frappe.call('isoft_ai.cache.reset_cache_stats').then(refresh);
+		});
+	});
+
+	refresh();
+};
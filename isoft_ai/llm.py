@@ -0,0 +1,327 @@
+"""
+Single entry point for every LLM call made by iSoft AI.
+
+All pipeline stages (title, intent, entity detection, SQL generation, polishing,
+knowledge answers, studies) go through `chat_completion` so that per-stage timeouts,
+retries and the offline mock backend live in one place (openai 0.27 already reuses
+a keep-alive HTTP session per thread).
+Each stage is routed to its own model, and downgraded to a cheaper, faster one
+while it runs over its latency or hourly token budget.
+"""
+import hashlib
+import json
+import random
+import time
+from typing import Dict, List, Optional
+
+import frappe
+import openai
+from frappe.utils import escape_html
+
+DEFAULT_MODEL = "gpt-4"
+FALLBACK_MODEL = "gpt-3.5-turbo"
+
+# Per-stage call settings: timeout in seconds, number of retries after the first attempt,
+# model, and budgets: average latency in seconds and tokens per hour (0 = unlimited)
+# beyond which the stage is downgraded to `fallback_model`
+STAGE_SETTINGS = {
+    'title': {'timeout': 10, 'retries': 1, 'model': 'gpt-3.5-turbo', 'latency_budget': 3, 'token_budget': 0},
+    'intent': {'timeout': 20, 'retries': 2, 'model': 'gpt-4', 'latency_budget': 8, 'token_budget': 0},
+    'entity': {'timeout': 20, 'retries': 2, 'model': 'gpt-3.5-turbo', 'latency_budget': 6, 'token_budget': 0},
+    'clarify': {'timeout': 20, 'retries': 1, 'model': 'gpt-3.5-turbo', 'latency_budget': 6, 'token_budget': 0},
+    'sql': {'timeout': 30, 'retries': 2, 'model': 'gpt-4', 'latency_budget': 15, 'token_budget': 0},
+    'polish': {'timeout': 30, 'retries': 1, 'model': 'gpt-3.5-turbo', 'latency_budget': 8, 'token_budget': 0},
+    'knowledge': {'timeout': 45, 'retries': 1, 'model': 'gpt-4', 'latency_budget': 20, 'token_budget': 0},
+    'study': {'timeout': 60, 'retries': 1, 'model': 'gpt-4', 'latency_budget': 40, 'token_budget': 0},
+}
+DEFAULT_STAGE_SETTINGS = {'timeout': 30, 'retries': 1, 'model': DEFAULT_MODEL, 'latency_budget': 0, 'token_budget': 0}
+
+# Latency is tracked as an exponentially weighted moving average per stage and model;
+# a stage over its latency budget uses the fallback model for DOWNGRADE_COOLDOWN seconds
+LATENCY_EWMA_ALPHA = 0.3
+DOWNGRADE_COOLDOWN = 300
+TOKEN_USAGE_KEY_PREFIX = "isoft_ai_llm_tokens"
+
+# Exponential backoff with full jitter between retries (seconds)
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+_latency = {}
+_downgraded_until = {}
+
+
+def get_backend() -> str:
+    """Return the configured backend: 'openai' (default) or 'mock'"""
+    return (frappe.conf.get("isoft_ai_llm_backend") or "openai").lower()
+
+
+def is_configured() -> bool:
+    """True when the active backend can serve requests"""
+    return get_backend() == "mock" or bool(frappe.conf.get("openai_api_key"))
+
+
+def get_stage_settings(stage: str) -> Dict:
+    """Stage settings merged with overrides from site_config `isoft_ai_llm_stages`"""
+    settings = dict(STAGE_SETTINGS.get(stage, DEFAULT_STAGE_SETTINGS))
+    overrides = (frappe.conf.get("isoft_ai_llm_stages") or {}).get(stage)
+    if overrides:
+        settings.update(overrides)
+    return settings
+
+
+def select_model(stage: str, settings: Optional[Dict] = None) -> str:
+    """Model for a stage: its configured model, or the fallback while a budget is exceeded"""
+    settings = settings or get_stage_settings(stage)
+    model = settings.get("model") or frappe.conf.get("isoft_ai_default_model") or DEFAULT_MODEL
+    fallback = select_fallback(settings)
+    if fallback == model:
+        return model
+
+    if _downgraded_until.get((frappe.local.site, stage), 0) > time.monotonic():
+        return fallback
+    token_budget = settings.get("token_budget")
+    if token_budget and get_hourly_tokens(stage) >= token_budget:
+        return fallback
+    return model
+
+
+def select_fallback(settings: Dict) -> str:
+    return settings.get("fallback_model") or frappe.conf.get("isoft_ai_fallback_model") or FALLBACK_MODEL
+
+
+def get_hourly_tokens(stage: str) -> int:
+    try:
+        return int(frappe.cache().get(frappe.cache().make_key(_token_usage_key(stage))) or 0)
+    except Exception:
+        return 0
+
+
+def _token_usage_key(stage: str) -> str:
+    return f"{TOKEN_USAGE_KEY_PREFIX}|{stage}|{time.strftime('%Y%m%d%H')}"
+
+
+def _record_call(stage: str, model: str, settings: Dict, elapsed: float, usage: Dict):
+    """Update the latency average and hourly token count used for routing"""
+    site = frappe.local.site
+    key = (site, stage, model)
+    average = _latency.get(key)
+    average = elapsed if average is None else LATENCY_EWMA_ALPHA * elapsed + (1 - LATENCY_EWMA_ALPHA) * average
+    _latency[key] = average
+
+    latency_budget = settings.get("latency_budget")
+    if latency_budget and average > latency_budget and model != select_fallback(settings):
+        frappe.logger().info(
+            f"LLM {stage} averages {average:.1f}s on {model} (budget {latency_budget}s), "
+            f"downgrading for {DOWNGRADE_COOLDOWN}s"
+        )
+        _downgraded_until[(site, stage)] = time.monotonic() + DOWNGRADE_COOLDOWN
+        _latency.pop(key, None)
+
+    tokens = (usage or {}).get("total_tokens")
+    if tokens and settings.get("token_budget"):
+        try:
+            redis = frappe.cache()
+            pipe = redis.pipeline()
+            pipe.incrby(redis.make_key(_token_usage_key(stage)), tokens)
+            pipe.expire(redis.make_key(_token_usage_key(stage)), 7200)
+            pipe.execute()
+        except Exception as e:
+            frappe.logger().debug(f"LLM token budget update failed: {str(e)}")
+
+
+def add_usage(token_usage: Optional[Dict], usage: Dict):
+    if token_usage is None or not usage:
+        return
+    token_usage["prompt_tokens"] += usage.get("prompt_tokens", 0)
+    token_usage["completion_tokens"] += usage.get("completion_tokens", 0)
+    token_usage["total_tokens"] += usage.get("total_tokens", 0)
+
+
+def chat_completion(stage: str, messages: List[Dict], model: Optional[str] = None, max_tokens: int = 256,
+                    temperature: float = 0, token_usage: Optional[Dict] = None) -> str:
+    """
+    Run a chat completion for a pipeline stage and return the stripped message content.
+    The model is routed per stage unless given. Token usage is accumulated into
+    `token_usage` when given.
+    """
+    settings = get_stage_settings(stage)
+    model = model or select_model(stage, settings)
+    backend = _mock_completion if get_backend() == "mock" else _openai_completion
+
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            content, usage = backend(stage, messages, model, max_tokens, temperature, settings["timeout"])
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt >= settings["retries"]:
+                frappe.logger().error(f"LLM {stage} failed after {attempt + 1} attempts: {str(e)}")
+                raise
+            _backoff(stage, attempt, e)
+            attempt += 1
+
+    elapsed = time.monotonic() - started
+    frappe.logger().debug(f"LLM {stage} ({model}) took {elapsed:.2f}s")
+    _record_call(stage, model, settings, elapsed, usage)
+    add_usage(token_usage, usage)
+    return (content or "").strip()
+
+
+def stream_chat_completion(stage: str, messages: List[Dict], model: Optional[str] = None, max_tokens: int = 256,
+                           temperature: float = 0, token_usage: Optional[Dict] = None, on_delta=None) -> str:
+    """
+    Streaming variant of `chat_completion`: `on_delta(text)` is called as tokens arrive and
+    the full stripped content is returned at the end. Streams carry no usage block, so
+    token usage is estimated from text length.
+    """
+    settings = get_stage_settings(stage)
+    model = model or select_model(stage, settings)
+    backend = _mock_stream if get_backend() == "mock" else _openai_stream
+
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        parts = []
+        try:
+            for delta in backend(stage, messages, model, max_tokens, temperature, settings["timeout"]):
+                parts.append(delta)
+                if on_delta:
+                    on_delta(delta)
+            break
+        except RETRYABLE_ERRORS as e:
+            # Once tokens have been relayed a retry would duplicate them
+            if parts or attempt >= settings["retries"]:
+                frappe.logger().error(f"LLM {stage} stream failed after {attempt + 1} attempts: {str(e)}")
+                raise
+            _backoff(stage, attempt, e)
+            attempt += 1
+
+    content = "".join(parts)
+    elapsed = time.monotonic() - started
+    usage = estimate_usage(messages, content)
+    frappe.logger().debug(f"LLM {stage} ({model}) streamed in {elapsed:.2f}s")
+    _record_call(stage, model, settings, elapsed, usage)
+    add_usage(token_usage, usage)
+    return content.strip()
+
+
+def estimate_usage(messages: List[Dict], content: str) -> Dict:
+    """Rough token counts (~4 characters per token) for responses without a usage block"""
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4 + 4 * len(messages)
+    completion_tokens = len(content) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
+def _backoff(stage, attempt, error):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    frappe.logger().info(f"LLM {stage} attempt {attempt + 1} failed ({type(error).__name__}), retrying in {delay:.2f}s")
+    time.sleep(delay)
+
+
+def _prepare_openai():
+    openai.api_key = frappe.conf.get("openai_api_key")
+
+
+def _openai_completion(stage, messages, model, max_tokens, temperature, timeout):
+    _prepare_openai()
+    response = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        request_timeout=timeout,
+    )
+    return response.choices[0].message["content"], dict(response.get("usage") or {})
+
+
+def _openai_stream(stage, messages, model, max_tokens, temperature, timeout):
+    _prepare_openai()
+    chunks = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        request_timeout=timeout,
+        stream=True,
+    )
+    for chunk in chunks:
+        delta = chunk.choices[0].get("delta", {}).get("content")
+        if delta:
+            yield delta
+
+
+# Canned answers of the mock backend, overridable per stage via site_config `isoft_ai_mock_responses`
+MOCK_RESPONSES = {
+    'intent': json.dumps({
+        "intent": "SELLING",
+        "confidence": 0.9,
+        "suggested_doctypes": ["Sales Invoice", "Customer"],
+        "requires_sql": True,
+        "clarification_needed": False
+    }),
+    'entity': json.dumps({
+        "is_study": False,
+        "entities": [],
+        "entity_types": [],
+        "analysis_type": "list_query",
+        "confidence": 0.8
+    }),
+    'sql': (
+        "SELECT customer, SUM(grand_total) AS total_sales FROM `tabSales Invoice` "
+        "WHERE docstatus = 1 GROUP BY customer ORDER BY total_sales DESC LIMIT 10"
+    ),
+}
+
+
+def _mock_completion(stage, messages, model, max_tokens, temperature, timeout):
+    """Deterministic offline backend used to measure latency and throughput without the real API"""
+    latency_ms = frappe.conf.get("isoft_ai_mock_latency_ms") or 0
+    if latency_ms:
+        time.sleep(min(latency_ms / 1000.0, timeout))
+
+    content = _mock_content(stage, messages)
+    prompt_tokens = len("\n".join(str(m.get("content", "")) for m in messages).split())
+    completion_tokens = min(len(content.split()), max_tokens)
+    return content, {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+
+def _mock_stream(stage, messages, model, max_tokens, temperature, timeout):
+    """Mock backend streaming word by word, spreading the configured latency over the chunks"""
+    words = _mock_content(stage, messages).split(" ")
+    latency_ms = frappe.conf.get("isoft_ai_mock_latency_ms") or 0
+    for i, word in enumerate(words):
+        if latency_ms:
+            time.sleep(latency_ms / 1000.0 / len(words))
+        yield word if i == 0 else " " + word
+
+
+def _mock_content(stage, messages):
+    prompt_text = "\n".join(str(m.get("content", "")) for m in messages)
+    overrides = frappe.conf.get("isoft_ai_mock_responses") or {}
+    content = overrides.get(stage) or MOCK_RESPONSES.get(stage)
+    if content is None:
+        user_text = next((str(m.get("content", "")) for m in reversed(messages) if m.get("role") == "user"), "")
+        digest = hashlib.md5(prompt_text.encode()).hexdigest()[:8]
+        if stage == "title":
+            content = " ".join(user_text.split()[:5]) or "AI Chat"
+        else:
+            content = f"<p>Mock {stage} answer [{digest}] for: {escape_html(user_text[:200])}</p>"
+    return content
@@ -0,0 +1,204 @@
+"""
+Server-side result previews.
+
+Results too large to answer inline are kept for a short time as a columnar
+snapshot (one list of values per column, JSON, zlib-compressed) in Redis under
+a result id. The chat widget pages, sorts and filters the snapshot through
+`get_result_page` instead of asking the question again to see more rows.
+The guarded SQL of a preview is kept much longer than the snapshot, so an
+expired snapshot is rebuilt by re-running the query (usually from the result
+cache) rather than by regenerating it. Like cached answers, a preview is shared
+by every AI User who received its (unguessable) result id.
+"""
+import json
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+import frappe
+from frappe.utils import cint
+
+from isoft_ai.cache import SQL_CACHE_EXPIRY_HOURS
+from isoft_ai.export import enqueue_export, export_result
+from isoft_ai.query import QueryStream, rows_stream, run_query
+
+PREVIEW_KEY_PREFIX = "isoft_ai_preview"
+PREVIEW_SQL_KEY_PREFIX = "isoft_ai_preview_sql"
+
+# Snapshots live PREVIEW_MINUTES; results over PREVIEW_MAX_ROWS or PREVIEW_MAX_MB are exported instead
+PREVIEW_MINUTES = 30
+PREVIEW_MAX_ROWS = 5000
+PREVIEW_MAX_MB = 4
+
+PAGE_LENGTH = 50
+MAX_PAGE_LENGTH = 200
+
+
+def previews_enabled() -> bool:
+    return bool(cint(frappe.conf.get("isoft_ai_result_preview", 1)))
+
+
+def store_preview(stream: QueryStream, sql: str) -> Optional[str]:
+    """Consume the stream into a new snapshot and return its result id; None when it is too large"""
+    max_rows = frappe.conf.get("isoft_ai_preview_max_rows") or PREVIEW_MAX_ROWS
+    rows = []
+    for row in stream:
+        if len(rows) >= max_rows:
+            return None
+        rows.append(row)
+
+    snapshot = build_snapshot(stream.columns, rows, stream.truncated)
+    result_id = frappe.generate_hash(length=16)
+    if not _save_snapshot(result_id, snapshot):
+        return None
+    frappe.cache().set_value(_sql_key(result_id), sql, expires_in_sec=SQL_CACHE_EXPIRY_HOURS * 3600)
+    return result_id
+
+
+def build_snapshot(columns: List[str], rows: List[tuple], truncated: bool = False) -> Dict:
+    data = [[_plain(row[index]) for row in rows] for index in range(len(columns))]
+    return {
+        "columns": columns,
+        "types": [_column_type(values) for values in data],
+        "data": data,
+        "row_count": len(rows),
+        "truncated": truncated,
+    }
+
+
+@frappe.whitelist()
+def get_result_page(result_id: str, start: int = 0, page_length: int = PAGE_LENGTH, sort_by: str = None,
+                    sort_order: str = "asc", search: str = None) -> Dict:
+    """
+    One page of a result preview, sorted by `sort_by` and filtered to rows containing
+    `search` in any column
+    """
+    snapshot = load_snapshot(result_id)
+    columns, data = snapshot["columns"], snapshot["data"]
+    indexes = list(range(snapshot["row_count"]))
+
+    if search and search.strip():
+        needle = search.strip().lower()
+        texts = [[str(v).lower() if v is not None else "" for v in values] for values in data]
+        indexes = [i for i in indexes if any(needle in column[i] for column in texts)]
+
+    if sort_by in columns:
+        values = data[columns.index(sort_by)]
+        # Empty values go last in either direction
+        present = [i for i in indexes if values[i] is not None]
+        present.sort(key=lambda i: _sort_key(values[i]), reverse=(sort_order or "").lower() == "desc")
+        indexes = present + [i for i in indexes if values[i] is None]
+
+    start = max(cint(start), 0)
+    page_length = min(max(cint(page_length), 1), MAX_PAGE_LENGTH)
+    page = indexes[start:start + page_length]
+    return {
+        "columns": columns,
+        "types": snapshot["types"],
+        "rows": [[values[i] for values in data] for i in page],
+        "start": start,
+        "total": len(indexes),
+        "row_count": snapshot["row_count"],
+        "truncated": snapshot["truncated"],
+    }
+
+
+@frappe.whitelist()
+def export_preview(result_id: str) -> str:
+    """Start a background export of a whole result preview; returns the placeholder the job reports to"""
+    _check_access()
+    if not frappe.cache().get_value(_sql_key(result_id)):
+        frappe.throw("This result has expired. Ask the question again to see it.")
+    return enqueue_export("isoft_ai.tasks.run_preview_export_job", result_id=result_id)
+
+
+def export_snapshot(result_id: str, progress: Optional[Callable[[int], None]] = None) -> str:
+    """Excel (or CSV) file of a whole result preview; returns the file URL"""
+    snapshot = load_snapshot(result_id)
+    rows = list(zip(*snapshot["data"]))
+    stream = rows_stream(snapshot["columns"], rows)
+    try:
+        return export_result(stream, len(rows), progress)
+    finally:
+        stream.close()
+
+
+def load_snapshot(result_id: str) -> Dict:
+    """The snapshot of a result id, rebuilt from its SQL once it expired"""
+    _check_access()
+    snapshot = None
+    try:
+        blob = frappe.cache().get(_snapshot_key(result_id))
+        if blob:
+            snapshot = json.loads(zlib.decompress(blob))
+    except Exception as e:
+        frappe.logger().debug(f"Result preview load error: {str(e)}")
+
+    return snapshot if snapshot is not None else _rebuild_snapshot(result_id)
+
+
+def _check_access():
+    # Same access rule as ask_ai
+    if "AI User" not in frappe.get_roles(frappe.session.user):
+        frappe.throw("Not permitted", frappe.PermissionError)
+
+
+def _rebuild_snapshot(result_id: str) -> Dict:
+    sql = frappe.cache().get_value(_sql_key(result_id))
+    if not sql:
+        frappe.throw("This result has expired. Ask the question again to see it.")
+
+    # The SQL was guarded when the preview was created
+    stream = run_query(sql)
+    try:
+        snapshot = build_snapshot(stream.columns, list(stream), stream.truncated)
+    finally:
+        stream.close()
+    _save_snapshot(result_id, snapshot)
+    return snapshot
+
+
+def _save_snapshot(result_id: str, snapshot: Dict) -> bool:
+    payload = json.dumps(snapshot, separators=(",", ":")).encode()
+    max_mb = frappe.conf.get("isoft_ai_preview_max_mb") or PREVIEW_MAX_MB
+    if len(payload) > max_mb * 1024 * 1024:
+        return False
+    minutes = frappe.conf.get("isoft_ai_preview_minutes") or PREVIEW_MINUTES
+    frappe.cache().set(_snapshot_key(result_id), zlib.compress(payload), ex=int(minutes * 60))
+    return True
+
+
+def _snapshot_key(result_id: str) -> str:
+    return frappe.cache().make_key(f"{PREVIEW_KEY_PREFIX}|{result_id}")
+
+
+def _sql_key(result_id: str) -> str:
+    return f"{PREVIEW_SQL_KEY_PREFIX}|{result_id}"
+
+
+def _plain(value):
+    """JSON-safe value that still sorts like the original"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    if isinstance(value, timedelta):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def _column_type(values: list) -> str:
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return "number"
+    return "text"
+
+
+def _sort_key(value):
+    # Numbers before text, so a column mixing both still sorts
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    return (1, 0, str(value).lower())
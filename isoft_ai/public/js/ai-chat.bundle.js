@@ -6,6 +6,13 @@ frappe.AI_Chat = class {
         this.autoSuggestions = [];
         this.voiceRecognition = null;
         this.isListening = false;
+        this.pending_job_id = null;
+        this.early_responses = {};
+        this.chat_titles = {};
+        this.ready_exports = {};
+        this.pending_stream_id = null;
+        this.$stream_message = null;
+        this.stream_buffer = '';
         this.setup_app();
         this.initializeAutomation();
     }
@@ -186,6 +193,8 @@ frappe.AI_Chat = class {
         </div>`);
 
         chatBox.append(msgDiv);
+        this.apply_ready_exports(msgDiv);
+        this.init_result_grids(msgDiv);
         
         // Smooth scroll animation
         this.smoothScrollToBottom(chatBox[0]);
@@ -195,6 +204,131 @@ frappe.AI_Chat = class {
         setTimeout(() => msgDiv.removeClass('message-enter'), 300);
     }
 
+    // Swap background export placeholders for the download link (or the error) once their job is done
+    apply_ready_exports($scope) {
+        $scope.find('.ai-export[data-export-id]').each((i, el) => {
+            const data = this.ready_exports[$(el).attr('data-export-id')];
+            if (!data) return;
+            if (data.file_url) {
+                const file_url = window.location.origin + data.file_url;
+                $(el).replaceWith(`📁 <a href="${file_url}" target="_blank" download>Download your file</a>`);
+            } else {
+                $(el).replaceWith(data.error || '');
+            }
+        });
+    }
+
+    // Result previews stored on the server: rows are paged in as the grid scrolls, sorted and filtered server-side
+    init_result_grids($scope) {
+        const me = this;
+        $scope.find('.ai-result-grid[data-result-id]').each((i, el) => {
+            const $grid = $(el);
+            const state = {
+                result_id: $grid.attr('data-result-id'), sort_by: null, sort_order: 'asc', search: '',
+                loaded: 0, total: 0, request: 0, loading: false
+            };
+            $grid.removeAttr('data-result-id').html(`
+                <div class="ai-grid-toolbar">
+                    <input type="search" class="form-control input-xs ai-grid-search" placeholder="Filter rows">
+                    <button class="btn btn-xs btn-default ai-grid-download">📁 Download</button>
+                </div>
+                <div class="ai-grid-scroll">
+                    <table class="table table-bordered table-condensed ai-result-table"><thead></thead><tbody></tbody></table>
+                </div>
+                <div class="ai-grid-footer text-muted small"></div>
+                <div class="ai-grid-export"></div>`);
+
+            const format_cell = (value, type) => {
+                if (value === null || value === undefined) return '';
+                if (type === 'number') return Number(value).toLocaleString(undefined, { maximumFractionDigits: 2 });
+                return frappe.utils.escape_html(String(value));
+            };
+
+            const load_page = (reset) => {
+                if (reset) {
+                    state.loaded = 0;
+                    state.request += 1;
+                } else if (state.loading || state.loaded >= state.total) {
+                    return;
+                }
+                const request = state.request;
+                state.loading = true;
+                frappe.call({
+                    method: 'isoft_ai.preview.get_result_page',
+                    args: {
+                        result_id: state.result_id, start: state.loaded, sort_by: state.sort_by,
+                        sort_order: state.sort_order, search: state.search
+                    },
+                    callback: (r) => {
+                        if (request !== state.request || !r.message) return;
+                        const page = r.message;
+                        if (reset) {
+                            $grid.find('thead').html('<tr>' + page.columns.map((col, index) => {
+                                const arrow = col === state.sort_by ? (state.sort_order === 'asc' ? ' ▲' : ' ▼') : '';
+                                const align = page.types[index] === 'number' ? ' style="text-align:right"' : '';
+                                return `<th data-column="${frappe.utils.escape_html(col)}"${align}>${frappe.utils.escape_html(col)}${arrow}</th>`;
+                            }).join('') + '</tr>');
+                            $grid.find('tbody').empty();
+                        }
+                        $grid.find('tbody').append(page.rows.map(row => '<tr>' + row.map((value, index) => {
+                            const align = page.types[index] === 'number' ? ' style="text-align:right"' : '';
+                            return `<td${align}>${format_cell(value, page.types[index])}</td>`;
+                        }).join('') + '</tr>').join(''));
+                        state.loaded = page.start + page.rows.length;
+                        state.total = page.total;
+                        const of_total = page.truncated ? `${page.row_count.toLocaleString()}+` : page.row_count.toLocaleString();
+                        $grid.find('.ai-grid-footer').text(state.search
+                            ? `${state.loaded.toLocaleString()} of ${page.total.toLocaleString()} matching rows (${of_total} in total)`
+                            : `${state.loaded.toLocaleString()} of ${of_total} rows`);
+                    },
+                    error: () => {
+                        $grid.find('.ai-grid-footer').text('This result is no longer available. Ask the question again to see it.');
+                    },
+                    always: () => {
+                        if (request === state.request) state.loading = false;
+                    }
+                });
+            };
+
+            $grid.find('.ai-grid-scroll').on('scroll', function() {
+                if (this.scrollTop + this.clientHeight >= this.scrollHeight - 40) load_page(false);
+            });
+
+            $grid.on('click', 'th[data-column]', function() {
+                const column = $(this).attr('data-column');
+                state.sort_order = state.sort_by === column && state.sort_order === 'asc' ? 'desc' : 'asc';
+                state.sort_by = column;
+                load_page(true);
+            });
+
+            let search_timer = null;
+            $grid.find('.ai-grid-search').on('input', function() {
+                clearTimeout(search_timer);
+                search_timer = setTimeout(() => {
+                    state.search = $(this).val();
+                    load_page(true);
+                }, 300);
+            });
+
+            // The export runs as a background job: its placeholder turns into the link when the job is done
+            $grid.find('.ai-grid-download').on('click', function() {
+                const $button = $(this).prop('disabled', true);
+                frappe.call({
+                    method: 'isoft_ai.preview.export_preview',
+                    args: { result_id: state.result_id },
+                    callback: (r) => {
+                        if (!r.message) return;
+                        $grid.find('.ai-grid-export').html(r.message);
+                        me.apply_ready_exports($grid);
+                    },
+                    always: () => $button.prop('disabled', false)
+                });
+            });
+
+            load_page(true);
+        });
+    }
+
     smoothScrollToBottom(element) {
         if (!element) return;
         
@@ -373,42 +507,44 @@ frappe.AI_Chat = class {
             </div>`);
             $('#ai-chat-history').append(typingDiv);
 
+            const settings = (frappe.boot && frappe.boot.isoft_ai) || {};
+            me.pending_question = user_input;
+            me.pending_stream_id = frappe.realtime ? frappe.utils.get_random(12) : null;
+
             frappe.call({
                 method: 'isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test.ask_ai',
                 args: {
                     user_question: user_input,
                     chat_history_json: JSON.stringify(me.chat_history),
-                    ai_chat_name: me.is_new_chat ? '' : (me.selected_chat_name || '')
+                    ai_chat_name: me.is_new_chat ? '' : (me.selected_chat_name || ''),
+                    run_in_background: (settings.background_jobs && frappe.realtime) ? 1 : 0,
+                    stream_id: me.pending_stream_id || ''
                 },
                 callback: function (r) {
+                    if (r.message && r.message.job_id) {
+                        // Answer will arrive over realtime (isoft_ai_response)
+                        me.pending_job_id = r.message.job_id;
+                        const early = me.early_responses[r.message.job_id];
+                        if (early) {
+                            delete me.early_responses[r.message.job_id];
+                            me.handle_ai_response(early);
+                        }
+                        return;
+                    }
+                    me.handle_ai_response(r.message);
+                },
+                error: function () {
+                    me.pending_job_id = null;
+                    me.reset_stream();
                     $('#ai-typing-indicator').closest('.typing').remove();
                     me.isTyping = false;
                     $('#ai-send-btn').removeClass('loading');
-                    
-                    if (r.message) {
-                        if (me.is_new_chat && r.message.chat_name) {
-                            me.selected_chat_name = r.message.chat_name;
-                            me.is_new_chat = false;
-                            
-                            const chatTitle = user_input.length > 30 ? user_input.substring(0, 30) + '...' : user_input;
-                            me.add_chat_to_sidebar(r.message.chat_name, chatTitle);
-                            
-                            me.$chat_list.find('.ai-chat-list-item').removeClass('active');
-                            me.$chat_list.find(`[data-chat-name="${r.message.chat_name}"]`).addClass('active');
-                        }
-                        
-                        if (typeof r.message.ai_response === 'string' && r.message.ai_response.startsWith('/files/')) {
-                            const file_url = window.location.origin + r.message.ai_response;
-                            me.append_message('assistant', `📁 <a href="${file_url}" target="_blank" download>Download your file</a>`);
-                        } else {
-                            me.chat_history.push({ role: 'assistant', content: r.message.ai_response });
-                            me.simulateTyping(r.message.ai_response);
-                        }
-                    }
                 }
             });
         });
 
+        this.setup_realtime();
+
         // New Chat button with enhanced animation
         this.$new_chat_btn.on('click', function () {
             $(this).addClass('clicked');
@@ -522,6 +658,115 @@ frappe.AI_Chat = class {
         });
     }
 
+    handle_ai_response(message) {
+        const me = this;
+        const user_input = me.pending_question || '';
+        $('#ai-typing-indicator').closest('.typing').remove();
+        me.isTyping = false;
+        me.pending_job_id = null;
+        $('#ai-send-btn').removeClass('loading');
+
+        if (message) {
+            if (me.is_new_chat && message.chat_name) {
+                me.selected_chat_name = message.chat_name;
+                me.is_new_chat = false;
+
+                // The generated title may already have arrived over realtime
+                const chatTitle = me.chat_titles[message.chat_name]
+                    || (user_input.length > 30 ? user_input.substring(0, 30) + '...' : user_input);
+                me.add_chat_to_sidebar(message.chat_name, chatTitle);
+
+                me.$chat_list.find('.ai-chat-list-item').removeClass('active');
+                me.$chat_list.find(`[data-chat-name="${message.chat_name}"]`).addClass('active');
+            }
+
+            if (typeof message.ai_response === 'string' && message.ai_response.startsWith('/files/')) {
+                const file_url = window.location.origin + message.ai_response;
+                me.append_message('assistant', `📁 <a href="${file_url}" target="_blank" download>Download your file</a>`);
+            } else if (me.$stream_message) {
+                // Tokens were already shown as they arrived; settle on the final answer
+                me.$stream_message.removeClass('streaming').find('.bubble').html(message.ai_response);
+                me.chat_history.push({ role: 'assistant', content: message.ai_response });
+            } else {
+                me.chat_history.push({ role: 'assistant', content: message.ai_response });
+                me.simulateTyping(message.ai_response);
+            }
+        }
+        me.reset_stream();
+    }
+
+    reset_stream() {
+        this.pending_stream_id = null;
+        this.$stream_message = null;
+        this.stream_buffer = '';
+    }
+
+    append_stream_delta(delta) {
+        const chatBox = $('#ai-chat-history');
+        if (!this.$stream_message) {
+            $('#ai-typing-indicator').closest('.typing').remove();
+            this.$stream_message = $(`<div class="message assistant streaming">
+                <div class="sender">Pulsar AI:</div>
+                <div class="bubble"></div>
+                <div class="message-timestamp">${new Date().toLocaleTimeString()}</div>
+            </div>`);
+            chatBox.append(this.$stream_message);
+        }
+        this.stream_buffer += delta;
+        this.$stream_message.find('.bubble').html(this.stream_buffer);
+        chatBox[0].scrollTop = chatBox[0].scrollHeight;
+    }
+
+    // Background ask_ai jobs push progress and the final answer over socket.io
+    setup_realtime() {
+        const me = this;
+        if (!frappe.realtime) return;
+
+        frappe.realtime.on('isoft_ai_progress', (data) => {
+            if (!data || data.job_id !== me.pending_job_id) return;
+            const $indicator = $('#ai-typing-indicator');
+            let $status = $indicator.find('.ai-progress-text');
+            if (!$status.length) {
+                $status = $('<span class="ai-progress-text"></span>');
+                $indicator.append($status);
+            }
+            $status.text(data.message);
+        });
+
+        frappe.realtime.on('isoft_ai_stream', (data) => {
+            if (!data || !me.pending_stream_id || data.stream_id !== me.pending_stream_id) return;
+            me.append_stream_delta(data.delta || '');
+        });
+
+        frappe.realtime.on('isoft_ai_response', (data) => {
+            if (!data || !data.job_id) return;
+            if (data.job_id !== me.pending_job_id) {
+                // The job can finish before the ask_ai call returns its job id
+                if (me.isTyping && !me.pending_job_id) me.early_responses[data.job_id] = data;
+                return;
+            }
+            me.handle_ai_response(data);
+        });
+
+        frappe.realtime.on('isoft_ai_export_progress', (data) => {
+            if (!data || !data.export_id) return;
+            $(`#ai-chat-history .ai-export[data-export-id="${data.export_id}"] .ai-export-status`)
+                .text(`${Number(data.rows).toLocaleString()} rows written…`);
+        });
+
+        frappe.realtime.on('isoft_ai_export_ready', (data) => {
+            if (!data || !data.export_id) return;
+            me.ready_exports[data.export_id] = data;
+            me.apply_ready_exports($('#ai-chat-history'));
+        });
+
+        frappe.realtime.on('isoft_ai_chat_title', (data) => {
+            if (!data || !data.chat_name || !data.title) return;
+            me.chat_titles[data.chat_name] = data.title;
+            me.$chat_list.find(`[data-chat-name="${data.chat_name}"] .ai-chat-title`).text(data.title);
+        });
+    }
+
     // Enhanced chat list loading with animations
     load_chat_list() {
         const me = this;
@@ -0,0 +1,467 @@
+"""
+Execution guard for generated SQL.
+
+`guard_query` runs EXPLAIN before a generated SELECT touches any data. It rejects
+queries whose estimated rows examined exceed the site's budget, and caps the
+result size by adding (or lowering) a LIMIT.
+`run_query` executes the guarded query on a dedicated read-only connection
+through an unbuffered cursor with a statement timeout. It returns a
+`QueryStream` that yields rows as tuples in batches, up to a row and byte cap.
+With `isoft_ai_use_replica` set, generated and study queries go to the read
+replica (`replica_host`) and fall back to the primary while it is unreachable
+or lagging.
+Small results are cached by normalised SQL and reused while none of the
+DocTypes they read changed (see `isoft_ai.cache.get_cached_result`).
+"""
+import itertools
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import frappe
+import pymysql
+from frappe.database import get_db
+from frappe.utils import cint
+from pymysql.cursors import DictCursor, SSCursor
+
+from isoft_ai.cache import (
+    get_cached_result, get_doctype_versions, get_sql_doctypes, seconds_until_midnight, set_cached_result
+)
+
+try:
+    import sqlparse
+except ImportError:
+    sqlparse = None
+
+# Estimated rows examined above which a query is rejected
+MAX_EXAMINED_ROWS = 2_000_000
+# Rows a generated query may return
+MAX_RESULT_ROWS = 5000
+# Bytes of row data a generated query may return (MB), and seconds it may run
+MAX_RESULT_MB = 20
+QUERY_TIMEOUT = 30
+FETCH_BATCH_SIZE = 500
+# Rows a stream closed early reads to finish its result; past this the rest of the query is killed
+DRAIN_MAX_ROWS = 10000
+
+# Results of at most this many rows / bytes are cached by normalised SQL for RESULT_CACHE_MINUTES
+RESULT_CACHE_MINUTES = 60
+RESULT_CACHE_MAX_ROWS = 5000
+RESULT_CACHE_MAX_BYTES = 2 * 1024 * 1024
+# Queries whose result depends on the clock are never cached; date-relative ones only until midnight
+VOLATILE_SQL = re.compile(r"\b(NOW|SYSDATE|CURTIME|CURRENT_TIME|CURRENT_TIMESTAMP|UNIX_TIMESTAMP|RAND|UUID)\b", re.I)
+DATE_RELATIVE_SQL = re.compile(r"\b(CURDATE|CURRENT_DATE|UTC_DATE)\b", re.I)
+
+# Read replica: lag (seconds) above which queries go to the primary, and how long a check is trusted
+REPLICA_MAX_LAG = 30
+REPLICA_CHECK_INTERVAL = 30
+
+# MariaDB: "Query execution was interrupted (max_statement_time exceeded)"
+ER_STATEMENT_TIMEOUT = 1969
+# "Query execution was interrupted" (KILL QUERY)
+ER_QUERY_INTERRUPTED = 1317
+# "Access denied; you need the REPLICATION CLIENT privilege"
+ER_ACCESS_DENIED = 1227
+
+LIMIT_PATTERN = re.compile(r"\blimit\s+(\d+)(\s*,\s*(\d+)|\s+offset\s+\d+)?\s*$", re.I)
+
+
+class QueryRejectedError(frappe.ValidationError):
+    pass
+
+
+def _max_examined_rows() -> int:
+    return frappe.conf.get("isoft_ai_max_examined_rows") or MAX_EXAMINED_ROWS
+
+
+def _max_result_rows() -> int:
+    return frappe.conf.get("isoft_ai_max_result_rows") or MAX_RESULT_ROWS
+
+
+def _max_result_bytes() -> int:
+    return int((frappe.conf.get("isoft_ai_max_result_mb") or MAX_RESULT_MB) * 1024 * 1024)
+
+
+def _query_timeout() -> float:
+    return float(frappe.conf.get("isoft_ai_query_timeout") or QUERY_TIMEOUT)
+
+
+def _timeout_error() -> QueryRejectedError:
+    return QueryRejectedError(
+        f"This query did not finish within {_query_timeout():g} seconds. "
+        f"Narrow it down with a date range or a more specific filter."
+    )
+
+
+def guard_query(sql: str, max_rows: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Returns the query with a LIMIT of at most `max_rows` (default: the result-row cap), and its
+    estimated rows examined. Raises QueryRejectedError when the estimate is over budget.
+    """
+    # One row more than the cap, so the QueryStream can tell a capped result from a complete one
+    sql = apply_row_limit(sql.strip().rstrip(";"), (max_rows or _max_result_rows()) + 1)
+    plan = frappe.db.sql(f"EXPLAIN {sql}", as_dict=True)
+    estimated_rows, largest = estimate_rows_examined(plan)
+
+    budget = _max_examined_rows()
+    if estimated_rows > budget:
+        frappe.logger().warning(f"Rejected generated SQL (~{estimated_rows} rows examined): {sql}")
+        raise QueryRejectedError(
+            f"This query would examine about {estimated_rows:,} rows, more than the allowed {budget:,}. "
+            f"The largest scan is on {largest}. Narrow it down with a date range or a more specific filter."
+        )
+    return sql, estimated_rows
+
+
+def apply_row_limit(sql: str, max_rows: int) -> str:
+    """Append LIMIT max_rows, or lower a trailing LIMIT that asks for more"""
+    match = LIMIT_PATTERN.search(sql)
+    if not match:
+        return f"{sql}\nLIMIT {max_rows}"
+    # "LIMIT offset, count" puts the row count second
+    count = int(match.group(3) or match.group(1))
+    if count <= max_rows:
+        return sql
+    if match.group(3):
+        return f"{sql[:match.start()]}LIMIT {match.group(1)}, {max_rows}"
+    return f"{sql[:match.start()]}LIMIT {max_rows}{match.group(2) or ''}"
+
+
+def estimate_rows_examined(plan: List[Dict]) -> Tuple[int, str]:
+    """
+    Nested-loop estimate from EXPLAIN: rows multiply across the tables of one SELECT
+    and add up across SELECTs. Returns the estimate and the table with the most rows.
+    """
+    per_select, largest, largest_rows = {}, "", -1
+    for row in plan:
+        rows = int(row.get("rows") or 1)
+        per_select[row.get("id")] = per_select.get(row.get("id"), 1) * rows
+        if rows > largest_rows:
+            largest, largest_rows = row.get("table") or "", rows
+    return sum(per_select.values()), largest
+
+
+class QueryStream:
+    """
+    Columns of a running query and its rows as tuples, fetched from the server in batches.
+    Iteration stops early, with `truncated` set, once the row or byte cap is reached.
+    """
+
+    def __init__(self, connection, cursor, max_rows: int, max_bytes: int,
+                 on_complete: Optional[Callable[[List[str], List[tuple]], None]] = None, target: str = "primary"):
+        self.columns = [d[0] for d in cursor.description or []]
+        self.truncated = False
+        self.row_count = 0
+        self.max_rows = max_rows
+        self._connection = connection
+        self._cursor = cursor
+        self._target = target
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._exhausted = False
+        self._buffer = []
+        # Rows kept for on_complete while the result is small enough to cache
+        self._on_complete = on_complete
+        self._recorded = [] if on_complete else None
+        self._rows = self._fetch()
+
+    def _fetch(self) -> Iterator[tuple]:
+        while True:
+            try:
+                batch = self._cursor.fetchmany(FETCH_BATCH_SIZE)
+            except pymysql.err.OperationalError as e:
+                # Unbuffered: the statement timeout can hit while rows are being read
+                if e.args and e.args[0] == ER_STATEMENT_TIMEOUT:
+                    raise _timeout_error()
+                raise
+            if not batch:
+                self._exhausted = True
+                if self._recorded is not None:
+                    self._on_complete(self.columns, self._recorded)
+                return
+            for row in batch:
+                self._bytes += sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row)
+                if self.row_count >= self.max_rows or self._bytes > self._max_bytes:
+                    self.truncated = True
+                    return
+                self.row_count += 1
+                if self._recorded is not None:
+                    if self.row_count > RESULT_CACHE_MAX_ROWS or self._bytes > RESULT_CACHE_MAX_BYTES:
+                        self._recorded = None
+                    else:
+                        self._recorded.append(row)
+                yield row
+
+    def peek(self, count: int) -> List[tuple]:
+        """First `count` rows, kept for the next iteration"""
+        while len(self._buffer) < count:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer.append(row)
+        return self._buffer[:count]
+
+    def __iter__(self) -> Iterator[tuple]:
+        buffered, self._buffer = self._buffer, []
+        yield from buffered
+        yield from self._rows
+
+    def close(self):
+        if self._exhausted or self._connection is None:
+            self._cursor.close()
+            return
+        # The connection can only run another statement once the unbuffered result is read to its end
+        try:
+            if not self._drain(DRAIN_MAX_ROWS):
+                _kill_query(self._connection.thread_id(), self._target)
+                try:
+                    self._drain()
+                except pymysql.err.OperationalError as e:
+                    if not e.args or e.args[0] != ER_QUERY_INTERRUPTED:
+                        raise
+            self._cursor.close()
+        except Exception as e:
+            frappe.logger().debug(f"Could not finish query stream, dropping its connection: {str(e)}")
+            _discard_connection(self._connection)
+
+    def _drain(self, max_rows: Optional[int] = None) -> bool:
+        """Read and drop the remaining rows, at most about `max_rows`; True once the result is finished"""
+        drained = 0
+        while max_rows is None or drained < max_rows:
+            batch = self._cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                return True
+            drained += len(batch)
+        return False
+
+
+_local = threading.local()
+# site -> (monotonic time of the last replica check, whether the replica may be used)
+_replica_health = {}
+
+
+def _replica_settings() -> Optional[Dict]:
+    if not cint(frappe.conf.get("isoft_ai_use_replica")):
+        return None
+    host = frappe.conf.get("isoft_ai_replica_host") or frappe.conf.get("replica_host")
+    if not host:
+        return None
+    return {"host": host, "port": frappe.conf.get("isoft_ai_replica_port") or frappe.conf.get("replica_db_port")}
+
+
+def _get_connection(target: str = "primary"):
+    """Per-thread autocommit, read-only connection of the current site for generated queries"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (frappe.local.site, target)
+    conn = connections.get(key)
+    if conn is not None:
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception:
+            _discard_connection(conn)
+
+    conn = _connect(target)
+    conn.autocommit(True)
+    with conn.cursor() as cursor:
+        cursor.execute("SET SESSION TRANSACTION READ ONLY")
+    connections[key] = conn
+    return conn
+
+
+def _connect(target: str):
+    if target == "replica":
+        settings = _replica_settings()
+        return get_db(host=settings["host"], user=frappe.conf.db_name, password=frappe.conf.db_password,
+                      port=settings["port"]).get_connection()
+    return frappe.db.get_connection()
+
+
+def _kill_query(thread_id: int, target: str):
+    """Stop the statement running on another connection, from a short-lived one to the same server"""
+    conn = _connect(target)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("KILL QUERY %s", (thread_id,))
+    finally:
+        conn.close()
+
+
+def _discard_connection(conn):
+    connections = getattr(_local, "connections", {})
+    for key, cached in list(connections.items()):
+        if cached is conn:
+            del connections[key]
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _get_read_connection() -> Tuple[object, str]:
+    """The replica connection when it is enabled, reachable and caught up; the primary otherwise"""
+    if _replica_settings() and _replica_usable():
+        try:
+            return _get_connection("replica"), "replica"
+        except Exception as e:
+            frappe.logger().warning(f"Read replica unavailable, using the primary: {str(e)}")
+            _replica_health[frappe.local.site] = (time.monotonic(), False)
+    return _get_connection("primary"), "primary"
+
+
+def _replica_usable() -> bool:
+    """Replica lag check, repeated at most every REPLICA_CHECK_INTERVAL seconds per worker"""
+    checked_at, usable = _replica_health.get(frappe.local.site, (0, True))
+    if time.monotonic() - checked_at < REPLICA_CHECK_INTERVAL:
+        return usable
+
+    max_lag = frappe.conf.get("isoft_ai_replica_max_lag") or REPLICA_MAX_LAG
+    try:
+        lag = replica_lag(_get_connection("replica"))
+        usable = lag is None or lag <= max_lag
+        if not usable:
+            frappe.logger().warning(f"Read replica is {lag}s behind (max {max_lag}s), using the primary")
+    except Exception as e:
+        frappe.logger().warning(f"Read replica unavailable, using the primary: {str(e)}")
+        usable = False
+    _replica_health[frappe.local.site] = (time.monotonic(), usable)
+    return usable
+
+
+def replica_lag(conn) -> Optional[float]:
+    """Seconds the replica is behind its primary; None when the server does not report it"""
+    try:
+        with conn.cursor(DictCursor) as cursor:
+            cursor.execute("SHOW SLAVE STATUS")
+            status = cursor.fetchone()
+    except pymysql.err.OperationalError as e:
+        # No REPLICATION CLIENT privilege: the lag cannot be checked
+        if e.args and e.args[0] == ER_ACCESS_DENIED:
+            return None
+        raise
+    if not status:
+        return None
+    if status.get("Slave_SQL_Running") != "Yes" or status.get("Seconds_Behind_Master") is None:
+        return float("inf")
+    return float(status["Seconds_Behind_Master"])
+
+
+def run_query(sql: str, max_rows: Optional[int] = None) -> QueryStream:
+    """
+    Execute a guarded query through an unbuffered cursor with a statement timeout, on the
+    read replica when one is configured. The caller must close() the returned stream.
+    """
+    max_rows = max_rows or _max_result_rows()
+    max_bytes = _max_result_bytes()
+
+    on_complete = None
+    ttl = _result_cache_ttl(sql)
+    if ttl > 0:
+        normalized = normalize_sql(sql)
+        cached = get_cached_result(normalized)
+        if cached:
+            description = [(column,) for column in cached["columns"]]
+            return QueryStream(None, _ListCursor(description, cached["rows"]), max_rows, max_bytes)
+        # Counters are read before the query runs, so a change made meanwhile invalidates the result
+        versions = get_doctype_versions(get_sql_doctypes(sql))
+
+        def on_complete(columns, rows):
+            set_cached_result(normalized, versions, columns, rows, ttl)
+
+    if frappe.db.db_type != "mariadb":
+        rows = frappe.db.sql(sql, as_list=True)
+        return QueryStream(None, _ListCursor(frappe.db._cursor.description, rows), max_rows, max_bytes,
+                           on_complete)
+
+    conn, target = _get_read_connection()
+    cursor = conn.cursor(SSCursor)
+    try:
+        cursor.execute(f"SET STATEMENT max_statement_time={_query_timeout()} FOR {sql}")
+    except pymysql.err.OperationalError as e:
+        _discard_connection(conn)
+        if e.args and e.args[0] == ER_STATEMENT_TIMEOUT:
+            raise _timeout_error()
+        if target != "replica":
+            raise
+        # Lost the replica mid-query: mark it down and run on the primary
+        frappe.logger().warning(f"Read replica failed, retrying on the primary: {str(e)}")
+        _replica_health[frappe.local.site] = (time.monotonic(), False)
+        return run_query(sql, max_rows)
+    except Exception:
+        _discard_connection(conn)
+        raise
+    if target == "replica":
+        # A lagging replica can return rows older than the counters read above: serve them, never cache them
+        on_complete = None
+    return QueryStream(conn, cursor, max_rows, max_bytes, on_complete, target)
+
+
+def rows_stream(columns: List[str], rows: List[tuple], max_rows: Optional[int] = None) -> QueryStream:
+    """A QueryStream over rows already in memory, with the usual byte cap and `max_rows` or the result-row cap"""
+    return QueryStream(None, _ListCursor([(column,) for column in columns], rows), max_rows or _max_result_rows(),
+                       _max_result_bytes())
+
+
+def _result_cache_ttl(sql: str) -> int:
+    minutes = frappe.conf.get("isoft_ai_result_cache_minutes", RESULT_CACHE_MINUTES)
+    if not minutes or VOLATILE_SQL.search(sql):
+        return 0
+    ttl = int(minutes * 60)
+    if DATE_RELATIVE_SQL.search(sql):
+        ttl = min(ttl, seconds_until_midnight())
+    return ttl
+
+
+def normalize_sql(sql: str) -> str:
+    """Canonical text of a query: comments dropped, keywords lower-cased, whitespace collapsed outside literals"""
+    if sqlparse is None:
+        return re.sub(r"\s+", " ", sql).strip()
+    parts = []
+    for ttype, value in sqlparse.lexer.tokenize(sql):
+        if ttype in sqlparse.tokens.Comment:
+            continue
+        if ttype in sqlparse.tokens.Whitespace:
+            value = " "
+        elif ttype in sqlparse.tokens.Keyword:
+            value = value.lower()
+        if value != " " or (parts and parts[-1] != " "):
+            parts.append(value)
+    return "".join(parts).strip()
+
+
+def read_sql(query: str, values=None) -> List[Dict]:
+    """Fixed read-only query (not generated), on the read replica when one is configured"""
+    # frappe.db.sql %-formats the query for any values other than (), even None
+    values = values or ()
+    if frappe.db.db_type != "mariadb" or not _replica_settings():
+        return frappe.db.sql(query, values, as_dict=True)
+
+    conn, target = _get_read_connection()
+    try:
+        with conn.cursor(DictCursor) as cursor:
+            cursor.execute(query, values or None)
+            return [frappe._dict(row) for row in cursor.fetchall()]
+    except pymysql.err.OperationalError as e:
+        _discard_connection(conn)
+        if target != "replica":
+            raise
+        frappe.logger().warning(f"Read replica failed, retrying on the primary: {str(e)}")
+        _replica_health[frappe.local.site] = (time.monotonic(), False)
+        return frappe.db.sql(query, values, as_dict=True)
+
+
+class _ListCursor:
+    """fetchmany() over rows that are already in memory"""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self._rows = iter(rows)
+
+    def fetchmany(self, size: int) -> List[tuple]:
+        return [tuple(row) for row in itertools.islice(self._rows, size)]
+
+    def close(self):
+        pass
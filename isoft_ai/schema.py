@@ -0,0 +1,170 @@
+"""
+Schema catalog for the SQL prompts.
+
+One entry per DocType is built from `frappe.get_meta` (fields, types, link targets,
+child tables, docstatus/is_cancelled conventions) and kept in a Redis hash.
+Entries are dropped by `invalidate_schema` (a `doc_events` hook on DocType,
+Custom Field and Property Setter) and rebuilt lazily on the next prompt.
+`get_prompt_context` renders only the candidate DocTypes of a question, with
+their fields pruned to the ones most likely to matter for it.
+`get_doctype_columns` serves the SQL validator from a per-worker cache of
+column sets.
+"""
+import re
+import time
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+import frappe
+from frappe.model import default_fields, no_value_fields
+
+SCHEMA_KEY = "isoft_ai_schema"
+
+# Columns every table has besides its DocType's fields
+STANDARD_COLUMNS = frozenset(default_fields) | {'_user_tags', '_comments', '_assign', '_liked_by', '_seen'}
+
+# Per-worker column sets live at most COLUMN_CACHE_TTL seconds so other workers' schema changes are picked up
+COLUMN_CACHE_TTL = 300
+
+# Prompt budget: DocTypes rendered per question and fields listed per DocType
+MAX_PROMPT_DOCTYPES = 8
+MAX_PROMPT_FIELDS = 30
+
+# Fields that hold free text, files or markup are never useful in generated SQL
+SKIP_FIELDTYPES = set(no_value_fields) | {
+    'Text Editor', 'HTML Editor', 'Markdown Editor', 'Code', 'Long Text', 'Small Text', 'Text', 'Attach',
+    'Attach Image', 'Signature', 'Password', 'Barcode', 'Geolocation', 'Color', 'JSON',
+}
+KEY_FIELDTYPES = {'Link', 'Dynamic Link', 'Date', 'Datetime', 'Currency', 'Float', 'Int', 'Percent', 'Select'}
+
+# Child tables that are rendered in full whenever their parent is
+PRIMARY_CHILD_FIELDS = ('items',)
+
+# Fields the customizing DocTypes use to name the DocType they change
+SCHEMA_SOURCE_FIELDS = {'DocType': 'name', 'Custom Field': 'dt', 'Property Setter': 'doc_type'}
+
+
+def get_doctype_schema(doctype: str) -> Optional[Dict]:
+    """Catalog entry for `doctype`, built from its meta on first use; None when it does not exist"""
+    try:
+        return frappe.cache().hget(SCHEMA_KEY, doctype, generator=lambda: build_doctype_schema(doctype))
+    except Exception as e:
+        frappe.logger().debug(f"Schema cache error for {doctype}: {str(e)}")
+        return build_doctype_schema(doctype)
+
+
+def build_doctype_schema(doctype: str) -> Optional[Dict]:
+    if not frappe.db.exists("DocType", doctype):
+        return None
+    meta = frappe.get_meta(doctype)
+    fields = []
+    for df in meta.fields:
+        if df.fieldtype in SKIP_FIELDTYPES or not df.fieldname:
+            continue
+        key = bool(df.reqd or df.in_list_view or df.in_standard_filter or df.fieldtype in KEY_FIELDTYPES)
+        options = df.options if df.fieldtype == 'Link' else None
+        fields.append([df.fieldname, df.fieldtype, options, key and not df.hidden])
+
+    return {
+        "doctype": doctype,
+        "istable": bool(meta.istable),
+        "submittable": bool(meta.is_submittable),
+        "is_cancelled": meta.has_field("is_cancelled"),
+        "fields": fields,
+        "children": [[df.options, df.fieldname] for df in meta.get_table_fields()],
+    }
+
+
+_column_sets = {}
+
+
+def get_doctype_columns(doctype: str) -> Optional[FrozenSet[str]]:
+    """Lower-cased column names of the DocType's table; None when it has no table"""
+    key = (frappe.local.site, doctype)
+    cached = _column_sets.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    columns = None
+    if frappe.db.exists("DocType", doctype):
+        meta = frappe.get_meta(doctype)
+        if not meta.issingle:
+            columns = STANDARD_COLUMNS | {
+                df.fieldname.lower() for df in meta.fields if df.fieldname and df.fieldtype not in no_value_fields
+            }
+    _column_sets[key] = (time.monotonic() + COLUMN_CACHE_TTL, columns)
+    return columns
+
+
+def invalidate_schema(doc, method=None):
+    """doc_events hook: drop the catalog entry of the DocType a DocType/Custom Field/Property Setter changes"""
+    doctype = doc.get(SCHEMA_SOURCE_FIELDS.get(doc.doctype, "name"))
+    if not doctype:
+        return
+    _column_sets.pop((frappe.local.site, doctype), None)
+    try:
+        frappe.cache().hdel(SCHEMA_KEY, doctype)
+    except Exception as e:
+        frappe.logger().error(f"Schema cache invalidation error for {doctype}: {str(e)}")
+
+
+def clear_schema_cache():
+    """after_migrate hook: DocTypes synced from app JSON may bypass the doc events"""
+    frappe.cache().delete_value(SCHEMA_KEY)
+
+
+def get_prompt_context(doctypes: Iterable[str], question: str = "") -> str:
+    """Schema lines for the candidate DocTypes and their main child tables, pruned for `question`"""
+    words = set(re.findall(r"[a-z0-9]+", question.lower()))
+    lines, seen = [], set()
+
+    def add(doctype: str, parent: Optional[str] = None):
+        if doctype in seen or len(seen) >= MAX_PROMPT_DOCTYPES:
+            return None
+        schema = get_doctype_schema(doctype)
+        if not schema:
+            return None
+        seen.add(doctype)
+        lines.append(_render_schema(schema, words, parent))
+        return schema
+
+    for doctype in doctypes:
+        schema = add(doctype)
+        if not schema:
+            continue
+        for child, fieldname in schema["children"]:
+            if fieldname in PRIMARY_CHILD_FIELDS or set(fieldname.split("_")) & words:
+                add(child, parent=doctype)
+
+    return "\n".join(lines)
+
+
+def _render_schema(schema: Dict, words: set, parent: Optional[str]) -> str:
+    if parent:
+        flags = f"child of {parent}: join on parent = `tab{parent}`.name"
+    elif schema["istable"]:
+        flags = "child table: join on parent"
+    elif schema["submittable"]:
+        flags = "submittable: filter docstatus = 1"
+    else:
+        flags = "not submittable"
+    if schema["is_cancelled"]:
+        flags += ", filter is_cancelled = 0"
+
+    fields = _prune_fields(schema["fields"], words)
+    columns = ", ".join(f"{name} ({ftype} {options})" if options else f"{name} ({ftype})"
+                        for name, ftype, options, _ in fields)
+    line = f"- `tab{schema['doctype']}` [{flags}]: name, {columns}"
+    if schema["children"] and not parent:
+        children = ", ".join(f"{fieldname} -> `tab{child}`" for child, fieldname in schema["children"])
+        line += f"; child tables: {children}"
+    return line
+
+
+def _prune_fields(fields: List[list], words: set) -> List[list]:
+    """Fields named in the question first, then key fields, in form order, up to MAX_PROMPT_FIELDS"""
+    def rank(field):
+        mentioned = bool(set(field[0].split("_")) & words)
+        return 0 if mentioned else 1 if field[3] else 2
+
+    ranked = sorted(range(len(fields)), key=lambda i: (rank(fields[i]), i))[:MAX_PROMPT_FIELDS]
+    return [fields[i] for i in sorted(ranked)]
@@ -0,0 +1,74 @@
+import frappe
+from frappe.utils import escape_html
+
+from isoft_ai.cache import cleanup_old_cache
+from isoft_ai.export import complete_export, export_query
+from isoft_ai.preview import export_snapshot
+from isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test import answer_coalesced, generate_ai_chat_title
+
+
+def run_ask_ai_job(ai_job_id: str, user_question: str, chat_history: list, ai_chat_name: str = "", cache_key: str = "",
+                   stream_id: str = ""):
+    """Background ask_ai pipeline; the answer is pushed to the user as an `isoft_ai_response` event"""
+    frappe.flags.isoft_ai_job_id = ai_job_id
+    frappe.flags.isoft_ai_stream_id = stream_id
+    try:
+        result_data = answer_coalesced(user_question, chat_history, ai_chat_name, cache_key)
+    except Exception as e:
+        frappe.publish_realtime("isoft_ai_response", {
+            "job_id": ai_job_id,
+            "chat_name": ai_chat_name or None,
+            "ai_response": f"<div class='alert alert-danger'>❌ <b>Unexpected error:</b> {escape_html(str(e))}<br>💬 Please try rephrasing your question or contact support.</div>"
+        }, user=frappe.session.user)
+        raise
+    finally:
+        frappe.flags.isoft_ai_job_id = None
+        frappe.flags.isoft_ai_stream_id = None
+
+    frappe.publish_realtime("isoft_ai_response", dict(result_data, job_id=ai_job_id), user=frappe.session.user, after_commit=True)
+
+
+def update_chat_title(ai_chat_name: str, first_message: str):
+    """Replace a new chat's provisional title with a generated one and push it to the sidebar"""
+    title = generate_ai_chat_title(first_message).strip().strip('"\'').strip()
+    if not title:
+        return
+    title = title[:140]
+    frappe.db.set_value("AI Chat", ai_chat_name, "title", title, update_modified=False)
+    frappe.publish_realtime("isoft_ai_chat_title", {"chat_name": ai_chat_name, "title": title},
+                            user=frappe.session.user, after_commit=True)
+
+
+def run_export_job(export_id: str, sql: str):
+    """Long-queue export of a large query result; the chat placeholder is replaced by the download link"""
+    _run_export(export_id, lambda progress: export_query(sql, progress))
+
+
+def run_preview_export_job(export_id: str, result_id: str):
+    """Long-queue export of a whole result preview, for the grid's Download button"""
+    _run_export(export_id, lambda progress: export_snapshot(result_id, progress))
+
+
+def _run_export(export_id: str, build):
+    def progress(rows: int):
+        frappe.publish_realtime("isoft_ai_export_progress", {"export_id": export_id, "rows": rows},
+                                user=frappe.session.user)
+
+    try:
+        file_url = build(progress)
+    except Exception as e:
+        error = f"<div class='alert alert-danger'>❌ <b>Export failed:</b> {escape_html(str(e))}</div>"
+        complete_export(export_id, error)
+        frappe.db.commit()
+        frappe.publish_realtime("isoft_ai_export_ready", {"export_id": export_id, "error": error},
+                                user=frappe.session.user)
+        raise
+
+    complete_export(export_id, file_url)
+    frappe.publish_realtime("isoft_ai_export_ready", {"export_id": export_id, "file_url": file_url},
+                            user=frappe.session.user, after_commit=True)
+
+
+def cleanup_ai_cache():
+    """Hourly: expire and trim the response cache"""
+    cleanup_old_cache()
@@ -0,0 +1,49 @@
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from isoft_ai.cache import (
+	_is_near_duplicate, get_cache_key, get_relations, minhash_signature, normalize_question, question_fingerprint
+)
+
+
+class TestNormalizeQuestion(unittest.TestCase):
+	def test_drops_stop_words_punctuation_and_plurals(self):
+		self.assertEqual(normalize_question("Show me the Customers' unpaid invoices, please!"),
+			["customer", "unpaid", "invoice"])
+
+	def test_strips_accents_and_keeps_codes(self):
+		self.assertEqual(normalize_question("Café sales for SINV-0001"), ["cafe", "sale", "sinv-0001"])
+
+
+class TestCacheKey(unittest.TestCase):
+	def test_filler_words_and_case_do_not_change_the_key(self):
+		self.assertEqual(get_cache_key("Show me the top customers"), get_cache_key("top customers please"))
+
+	def test_word_order_changes_the_key(self):
+		self.assertNotEqual(get_cache_key("invoices paid but not delivered"),
+			get_cache_key("invoices delivered but not paid"))
+		self.assertNotEqual(get_cache_key("top customers by item"), get_cache_key("top items by customer"))
+
+	def test_relations_keep_what_negations_and_groupings_apply_to(self):
+		self.assertEqual(get_relations(normalize_question("invoices paid but not delivered")), ["not delivered"])
+		self.assertEqual(get_relations(normalize_question("top customers by item")), ["by item"])
+
+
+class TestNearDuplicate(unittest.TestCase):
+	def is_near_duplicate(self, question, cached_question):
+		tokens, entry = normalize_question(question), question_fingerprint(normalize_question(cached_question))
+		with patch.object(frappe, "conf", {}):
+			return _is_near_duplicate(tokens, minhash_signature(tokens), entry)
+
+	def test_typos_match(self):
+		self.assertTrue(self.is_near_duplicate("unpaid sales invoces this month", "unpaid sales invoices this month"))
+
+	def test_negated_words_do_not_match(self):
+		for question, cached_question in (
+			("paid sales invoices this month", "unpaid sales invoices this month"),
+			("submitted purchase orders this month", "unsubmitted purchase orders this month"),
+			("active customers this month", "inactive customers this month"),
+		):
+			self.assertFalse(self.is_near_duplicate(question, cached_question), question)
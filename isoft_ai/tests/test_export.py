@@ -0,0 +1,27 @@
+import unittest
+from unittest.mock import patch
+
+from isoft_ai.export import CSV_EXPORT_ROWS, MAX_EXPORT_ROWS, export_result
+from isoft_ai.query import rows_stream
+
+
+class TestExportThreshold(unittest.TestCase):
+	def export(self, estimated_rows, max_rows=MAX_EXPORT_ROWS):
+		stream = rows_stream(["name"], [("a",)], max_rows)
+		with patch("isoft_ai.export.generate_csv_file", return_value="csv") as csv_file, \
+				patch("isoft_ai.export.generate_excel_file", return_value="xlsx"):
+			return export_result(stream, estimated_rows), csv_file
+
+	def test_small_estimate_is_excel(self):
+		self.assertEqual(self.export(CSV_EXPORT_ROWS)[0], "xlsx")
+
+	def test_large_estimate_is_gzipped_csv(self):
+		result, csv_file = self.export(CSV_EXPORT_ROWS + 1)
+		self.assertEqual(result, "csv")
+		self.assertTrue(csv_file.call_args[1]["compress"])
+
+	def test_estimate_is_capped_at_the_stream_row_limit(self):
+		self.assertEqual(self.export(10 * CSV_EXPORT_ROWS, max_rows=CSV_EXPORT_ROWS)[0], "xlsx")
+
+	def test_export_cap_is_above_the_csv_threshold(self):
+		self.assertGreater(MAX_EXPORT_ROWS, CSV_EXPORT_ROWS)
@@ -0,0 +1,30 @@
+import unittest
+
+from isoft_ai.intent import classify_intent
+from isoft_ai.isoft_ai.doctype.isoft_ai_test.isoft_ai_test import ERPNEXT_MODULES
+
+
+class TestClassifyIntent(unittest.TestCase):
+	def test_clear_module_question(self):
+		analysis = classify_intent("total salary slips this month", ERPNEXT_MODULES)
+		self.assertEqual(analysis["intent"], "HR")
+		self.assertEqual(analysis["suggested_doctypes"], ["Salary Slip"])
+		self.assertTrue(analysis["requires_sql"])
+
+	def test_secondary_module_doctypes_are_suggested(self):
+		analysis = classify_intent("top items sold last month", ERPNEXT_MODULES)
+		self.assertEqual(analysis["intent"], "STOCK")
+		self.assertIn("Item", analysis["suggested_doctypes"])
+		self.assertIn("Sales Invoice", analysis["suggested_doctypes"])
+
+	def test_study_question(self):
+		analysis = classify_intent("analyze customer ACME", ERPNEXT_MODULES)
+		self.assertEqual((analysis["intent"], analysis["suggested_doctypes"]), ("STUDY", ["Customer"]))
+
+	def test_knowledge_question(self):
+		analysis = classify_intent("what is double entry bookkeeping", ERPNEXT_MODULES)
+		self.assertEqual(analysis["intent"], "KNOWLEDGE")
+		self.assertFalse(analysis["requires_sql"])
+
+	def test_ambiguous_question_is_left_to_the_llm(self):
+		self.assertIsNone(classify_intent("what is a BOM", ERPNEXT_MODULES))
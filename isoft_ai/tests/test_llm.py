@@ -0,0 +1,47 @@
+import itertools
+import unittest
+from unittest.mock import patch
+
+import frappe
+import openai
+
+from isoft_ai import llm
+
+
+class TestChatCompletion(unittest.TestCase):
+	def setUp(self):
+		self.conf = {"isoft_ai_llm_backend": "mock"}
+		for patcher in (patch.object(frappe, "conf", self.conf), patch("isoft_ai.llm.time.sleep"),
+				patch.dict(llm._latency, clear=True), patch.dict(llm._downgraded_until, clear=True)):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def test_retries_transient_errors(self):
+		usage = {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4}
+		with patch("isoft_ai.llm._mock_completion", side_effect=[openai.error.Timeout("timed out"), ("ok", usage)]) as backend:
+			token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+			self.assertEqual(llm.chat_completion("sql", [{"role": "user", "content": "hi"}], token_usage=token_usage), "ok")
+		self.assertEqual(backend.call_count, 2)
+		self.assertEqual(token_usage["total_tokens"], 4)
+
+	def test_gives_up_after_the_stage_retries(self):
+		with patch("isoft_ai.llm._mock_completion", side_effect=openai.error.RateLimitError("slow down")) as backend:
+			with self.assertRaises(openai.error.RateLimitError):
+				llm.chat_completion("title", [{"role": "user", "content": "hi"}])
+		self.assertEqual(backend.call_count, llm.STAGE_SETTINGS["title"]["retries"] + 1)
+
+	def test_slow_stage_is_downgraded(self):
+		self.conf["isoft_ai_llm_stages"] = {"sql": {"latency_budget": 5}}
+		# Every clock reading is 10s later, so each call takes 10s
+		with patch("isoft_ai.llm.time.monotonic", side_effect=itertools.count(0, 10)), \
+				patch("isoft_ai.llm._mock_completion", return_value=("ok", {})) as backend:
+			llm.chat_completion("sql", [{"role": "user", "content": "hi"}])
+			llm.chat_completion("sql", [{"role": "user", "content": "hi"}])
+		self.assertEqual([call[0][2] for call in backend.call_args_list], ["gpt-4", llm.FALLBACK_MODEL])
+
+	def test_token_budget_downgrades(self):
+		self.conf["isoft_ai_llm_stages"] = {"sql": {"token_budget": 500}}
+		with patch("isoft_ai.llm.get_hourly_tokens", return_value=500):
+			self.assertEqual(llm.select_model("sql"), llm.FALLBACK_MODEL)
+		with patch("isoft_ai.llm.get_hourly_tokens", return_value=499):
+			self.assertEqual(llm.select_model("sql"), "gpt-4")
@@ -0,0 +1,47 @@
+import unittest
+from datetime import date
+from decimal import Decimal
+from unittest.mock import patch
+
+from isoft_ai.preview import build_snapshot, get_result_page
+
+
+class TestResultPreview(unittest.TestCase):
+	def setUp(self):
+		self.snapshot = build_snapshot(["customer", "amount", "posting_date"], [
+			("Beta", Decimal("250.50"), date(2024, 1, 2)),
+			("alpha", None, date(2023, 5, 1)),
+			("Gamma", Decimal("10"), None),
+		])
+
+	def page(self, **kwargs):
+		with patch("isoft_ai.preview.load_snapshot", return_value=self.snapshot):
+			return get_result_page("result", **kwargs)
+
+	def test_snapshot_is_columnar_and_json_safe(self):
+		self.assertEqual(self.snapshot["data"], [
+			["Beta", "alpha", "Gamma"],
+			[250.5, None, 10.0],
+			["2024-01-02", "2023-05-01", None],
+		])
+		self.assertEqual(self.snapshot["types"], ["text", "number", "text"])
+		self.assertEqual(self.snapshot["row_count"], 3)
+
+	def test_sort_puts_empty_values_last(self):
+		self.assertEqual([row[0] for row in self.page(sort_by="amount", sort_order="desc")["rows"]],
+			["Beta", "Gamma", "alpha"])
+		self.assertEqual([row[0] for row in self.page(sort_by="amount")["rows"]], ["Gamma", "Beta", "alpha"])
+
+	def test_text_sort_ignores_case(self):
+		self.assertEqual([row[0] for row in self.page(sort_by="customer")["rows"]], ["alpha", "Beta", "Gamma"])
+
+	def test_search_filters_any_column(self):
+		page = self.page(search="2024")
+		self.assertEqual((page["rows"], page["total"], page["row_count"]), ([["Beta", 250.5, "2024-01-02"]], 1, 3))
+
+	def test_paging(self):
+		page = self.page(sort_by="customer", start=1, page_length=1)
+		self.assertEqual((page["rows"], page["start"], page["total"]), ([["Beta", 250.5, "2024-01-02"]], 1, 3))
+
+	def test_unknown_sort_column_keeps_query_order(self):
+		self.assertEqual([row[0] for row in self.page(sort_by="nope")["rows"]], ["Beta", "alpha", "Gamma"])
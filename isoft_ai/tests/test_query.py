@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+from isoft_ai.query import (
+	DRAIN_MAX_ROWS, QueryStream, _ListCursor, apply_row_limit, estimate_rows_examined, read_sql, rows_stream
+)
+
+
+class TestApplyRowLimit(unittest.TestCase):
+	def test_adds_missing_limit(self):
+		self.assertEqual(apply_row_limit("SELECT name FROM `tabUser`", 100), "SELECT name FROM `tabUser`\nLIMIT 100")
+
+	def test_keeps_smaller_limit(self):
+		sql = "SELECT name FROM `tabUser` LIMIT 10"
+		self.assertEqual(apply_row_limit(sql, 100), sql)
+
+	def test_lowers_larger_limit(self):
+		self.assertEqual(apply_row_limit("SELECT name FROM `tabUser` LIMIT 500", 100), "SELECT name FROM `tabUser` LIMIT 100")
+
+	def test_lowers_count_of_offset_forms(self):
+		self.assertEqual(apply_row_limit("SELECT name FROM `tabUser` LIMIT 20, 500", 100),
+			"SELECT name FROM `tabUser` LIMIT 20, 100")
+		self.assertEqual(apply_row_limit("SELECT name FROM `tabUser` LIMIT 500 OFFSET 20", 100),
+			"SELECT name FROM `tabUser` LIMIT 100 OFFSET 20")
+
+	def test_limit_inside_subquery_is_not_the_outer_limit(self):
+		sql = "SELECT name FROM (SELECT name FROM `tabUser` LIMIT 5) u WHERE name != 'Guest'"
+		self.assertTrue(apply_row_limit(sql, 100).endswith("\nLIMIT 100"))
+
+
+class TestEstimateRowsExamined(unittest.TestCase):
+	def test_rows_multiply_within_a_select(self):
+		plan = [
+			{"id": 1, "table": "si", "rows": 1000},
+			{"id": 1, "table": "sii", "rows": 4},
+		]
+		self.assertEqual(estimate_rows_examined(plan), (4000, "si"))
+
+	def test_selects_add_up(self):
+		plan = [
+			{"id": 1, "table": "<derived2>", "rows": 10},
+			{"id": 2, "table": "gle", "rows": 50000},
+			{"id": 3, "table": "acc", "rows": None},
+		]
+		self.assertEqual(estimate_rows_examined(plan), (50011, "gle"))
+
+
+class TestQueryStream(unittest.TestCase):
+	def test_marks_truncation_when_over_the_cap(self):
+		stream = rows_stream(["n"], [(i,) for i in range(4)], max_rows=3)
+		self.assertEqual(list(stream), [(0,), (1,), (2,)])
+		self.assertTrue(stream.truncated)
+
+	def test_complete_result_is_not_truncated(self):
+		stream = rows_stream(["n"], [(i,) for i in range(3)], max_rows=3)
+		self.assertEqual(stream.peek(2), [(0,), (1,)])
+		self.assertEqual(list(stream), [(0,), (1,), (2,)])
+		self.assertFalse(stream.truncated)
+
+
+class TestQueryStreamClose(unittest.TestCase):
+	def close_early(self, remaining_rows):
+		cursor = MagicMock(wraps=_ListCursor([("n",)], [(i,) for i in range(remaining_rows + 1)]))
+		stream = QueryStream(MagicMock(), cursor, 100, 1 << 20)
+		stream.peek(1)
+		with patch("isoft_ai.query._discard_connection") as discard, patch("isoft_ai.query._kill_query") as kill:
+			stream.close()
+		cursor.close.assert_called_once()
+		discard.assert_not_called()
+		return kill
+
+	def test_rest_of_a_small_result_is_read_and_the_connection_kept(self):
+		self.close_early(DRAIN_MAX_ROWS // 2).assert_not_called()
+
+	def test_rest_of_a_large_result_is_killed_and_the_connection_kept(self):
+		self.close_early(DRAIN_MAX_ROWS * 2).assert_called_once()
+
+
+class TestReadSql(unittest.TestCase):
+	def read(self, query, values=None):
+		with patch("isoft_ai.query._replica_settings", return_value=None), \
+				patch.object(frappe.db, "sql", return_value=[]) as db_sql:
+			read_sql(query, values)
+		return db_sql.call_args
+
+	def test_percent_literals_are_not_formatted(self):
+		query = "SELECT DATE_FORMAT(posting_date, '%Y-%m') AS month FROM `tabSales Invoice` WHERE remarks LIKE '%box%'"
+		args, kwargs = self.read(query)
+		# frappe.db.sql only skips %-formatting for values == ()
+		self.assertEqual(args, (query, ()))
+		self.assertTrue(kwargs["as_dict"])
+
+	def test_values_are_passed_through(self):
+		args, _ = self.read("SELECT name FROM `tabItem` WHERE item_code = %s", ("a'b",))
+		self.assertEqual(args[1], ("a'b",))